@@ -0,0 +1,407 @@
+"""
+The storage that cass.py runs its statements against.
+
+A backend prepares and runs CQL statements, and knows which replicas own a
+partition.  CassandraBackend does this with the DataStax driver against a
+cluster, and MemoryBackend with the in-process engine in memcass.py, so the
+data layer can be run, and its access patterns timed, without a cluster.
+CASSANDRA_BACKEND picks which one get_backend() connects to.
+"""
+import time
+
+from cassandra import ConsistencyLevel
+from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
+from cassandra.policies import (
+    ConstantSpeculativeExecutionPolicy, DCAwareRoundRobinPolicy, HostDistance,
+    RoundRobinPolicy, TokenAwarePolicy)
+from cassandra.query import BatchStatement, BatchType, BoundStatement
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+import memcass
+import schema
+
+# The execution profile of statements configured to be speculative
+SPECULATIVE_PROFILE = 'speculative'
+
+
+class RoutedStatement(BoundStatement):
+    """
+    A bound statement with a routing key given to it, for statements the
+    driver can't work one out for, like reads of several partitions with an
+    IN clause that all live on the same replicas.
+    """
+
+    def __init__(self, prepared_statement, values, routing_key):
+        BoundStatement.__init__(self, prepared_statement)
+        self.bind(values)
+        self._routing_key = routing_key
+
+    @property
+    def routing_key(self):
+        return self._routing_key
+
+
+class Backend(object):
+    """
+    The operations cass.py needs from its storage.
+
+    Statements are the backend's own prepared statements, bound statements
+    and batches, or CQL strings.  Results are sequences of rows with the
+    selected columns as attributes, and have the driver's paging_state and
+    has_more_pages.
+    """
+
+    keyspace = None
+
+    def __init__(self):
+        # id() of each configured prepared statement -> the keyword
+        # arguments it's run with
+        self._statement_kwargs = {}
+
+    def prepare(self, query):
+        """
+        Parses a CQL statement with ? placeholders once, to be bound and run
+        any number of times.
+        """
+        raise NotImplementedError
+
+    def configure(self, statement, options):
+        """
+        Sets how a prepared statement is run from then on, from a dictionary
+        of options like StatementRegistry.options_for() gives: consistency
+        (a ConsistencyLevel name), timeout, idempotent and speculative.
+        """
+        consistency = options.get('consistency')
+        if consistency is not None:
+            try:
+                statement.consistency_level = (
+                    ConsistencyLevel.name_to_value[consistency])
+            except KeyError:
+                raise ImproperlyConfigured(
+                    'Unknown consistency level %r' % (consistency,))
+        statement.is_idempotent = bool(options.get('idempotent'))
+
+        kwargs = {}
+        if options.get('timeout') is not None:
+            kwargs['timeout'] = options['timeout']
+        # The driver only ever sends idempotent statements more than once
+        if options.get('speculative'):
+            kwargs['execution_profile'] = SPECULATIVE_PROFILE
+        self._statement_kwargs[id(statement)] = kwargs
+
+    def _kwargs(self, statement, kwargs):
+        """
+        Adds the keyword arguments a statement was configured with to the
+        ones it's being run with.
+        """
+        statement = getattr(statement, 'prepared_statement', statement)
+        configured = self._statement_kwargs.get(id(statement))
+        if not configured:
+            return kwargs
+        configured = dict(configured)
+        configured.update(kwargs)
+        return configured
+
+    def execute(self, statement, parameters=None, **kwargs):
+        """
+        Runs a statement and returns its rows.  kwargs are passed on as the
+        driver's Session.execute() takes them: timeout, paging_state and
+        host.
+        """
+        raise NotImplementedError
+
+    def execute_async(self, statement, parameters=None, **kwargs):
+        """
+        Starts running a statement, and returns a future with result() and
+        add_callbacks(callback, errback), like the driver's ResponseFuture.
+        """
+        raise NotImplementedError
+
+    def batch(self):
+        """
+        Makes an unlogged batch, to have statements add()ed to it and then
+        be run with execute() or execute_async() in one request.
+        """
+        raise NotImplementedError
+
+    def get_replicas(self, statement):
+        """
+        Gets the hosts that own the partition a bound statement touches, or
+        an empty list if that isn't known.
+        """
+        return []
+
+    def bind_routed(self, statement, values, like):
+        """
+        Binds values to a prepared statement, to be sent where the bound
+        statement like would be, to one of the replicas of its partition.
+        """
+        return statement.bind(values)
+
+    def shutdown(self):
+        pass
+
+
+class CassandraBackend(Backend):
+    """
+    Runs statements on a cluster with the DataStax driver.
+
+    protocol_version None negotiates the newest version both sides support.
+    connections_per_host is the (core, max) number of connections to open
+    to each local host, which only applies to protocol versions 1 and 2:
+    later versions multiplex every request over one connection per host.
+    Speculative statements are sent to another host if the first hasn't
+    answered within speculative_delay seconds, up to speculative_attempts
+    more times.
+    """
+
+    def __init__(self, contact_points, keyspace, port=9042,
+                 protocol_version=None, load_balancing_policy=None,
+                 request_timeout=10, connections_per_host=None,
+                 speculative_delay=0.05, speculative_attempts=1):
+        Backend.__init__(self)
+        profile = ExecutionProfile(
+            load_balancing_policy=load_balancing_policy,
+            request_timeout=request_timeout)
+        speculative = ExecutionProfile(
+            load_balancing_policy=load_balancing_policy,
+            request_timeout=request_timeout,
+            speculative_execution_policy=ConstantSpeculativeExecutionPolicy(
+                speculative_delay, speculative_attempts))
+        kwargs = {}
+        if protocol_version is not None:
+            kwargs['protocol_version'] = protocol_version
+        self.cluster = Cluster(
+            contact_points, port=port,
+            execution_profiles={
+                EXEC_PROFILE_DEFAULT: profile,
+                SPECULATIVE_PROFILE: speculative,
+            }, **kwargs)
+
+        if connections_per_host is not None and protocol_version in (1, 2):
+            core, maximum = connections_per_host
+            self.cluster.set_max_connections_per_host(
+                HostDistance.LOCAL, maximum)
+            self.cluster.set_core_connections_per_host(
+                HostDistance.LOCAL, core)
+
+        self.session = self.cluster.connect(keyspace)
+
+    @property
+    def keyspace(self):
+        return self.session.keyspace
+
+    def prepare(self, query):
+        return self.session.prepare(query)
+
+    def execute(self, statement, parameters=None, **kwargs):
+        return self.session.execute(
+            statement, parameters, **self._kwargs(statement, kwargs))
+
+    def execute_async(self, statement, parameters=None, **kwargs):
+        return self.session.execute_async(
+            statement, parameters, **self._kwargs(statement, kwargs))
+
+    def batch(self):
+        return BatchStatement(batch_type=BatchType.UNLOGGED)
+
+    def get_replicas(self, statement):
+        token_map = self.cluster.metadata.token_map
+        routing_key = statement.routing_key
+        if token_map is None or routing_key is None:
+            return []
+        return self.cluster.metadata.get_replicas(self.keyspace, routing_key)
+
+    def bind_routed(self, statement, values, like):
+        return RoutedStatement(statement, values, like.routing_key)
+
+    def shutdown(self):
+        self.cluster.shutdown()
+
+
+class MemoryBackend(Backend):
+    """
+    Keeps the keyspace in this process, and forgets it when the process
+    exits.  Every request takes latency seconds plus an exponentially
+    distributed jitter averaging jitter seconds, to stand in for the round
+    trip to a cluster.  Speculative statements are sent again like
+    CassandraBackend sends them, each copy taking its own time.
+    """
+
+    keyspace = 'twissandra'
+
+    def __init__(self, latency=0, jitter=0, denormalized=False,
+                 speculative_delay=0.05, speculative_attempts=1):
+        Backend.__init__(self)
+        self.session = memcass.MemorySession(
+            schema.get_tables(denormalized), latency, jitter)
+        self.session.set_keyspace(self.keyspace)
+        self.session.execution_profiles[SPECULATIVE_PROFILE] = ExecutionProfile(
+            speculative_execution_policy=ConstantSpeculativeExecutionPolicy(
+                speculative_delay, speculative_attempts))
+
+    def set_latency(self, latency, jitter):
+        self.session.latency = latency
+        self.session.jitter = jitter
+
+    def prepare(self, query):
+        return self.session.prepare(query)
+
+    def execute(self, statement, parameters=None, **kwargs):
+        return self.session.execute(
+            statement, parameters, **self._kwargs(statement, kwargs))
+
+    def execute_async(self, statement, parameters=None, **kwargs):
+        return self.session.execute_async(
+            statement, parameters, **self._kwargs(statement, kwargs))
+
+    def batch(self):
+        return memcass.BatchStatement()
+
+    def shutdown(self):
+        self.session.shutdown()
+
+
+class MeteredBackend(Backend):
+    """
+    Runs statements on another backend, recording how long each one takes
+    in the latency histogram and the errors it raises in the errors counter.
+    Both are labelled with the statement's name, which name_of(statement)
+    gives, or 'batch' or 'unprepared' for statements that don't have one.
+
+    If they're given, the speculative counter counts the extra copies of
+    statements that were sent because the first was slow, and the wins
+    counter the statements that one of those copies answered.
+    """
+
+    def __init__(self, backend, name_of, latency, errors, speculative=None,
+                 wins=None):
+        self.backend = backend
+        self.name_of = name_of
+        self.latency = latency
+        self.errors = errors
+        self.speculative = speculative
+        self.wins = wins
+
+    def __getattr__(self, name):
+        # Anything particular to the wrapped backend, like set_latency()
+        return getattr(self.backend, name)
+
+    @property
+    def keyspace(self):
+        return self.backend.keyspace
+
+    def _name(self, statement):
+        name = self.name_of(statement)
+        if name is None:
+            if isinstance(statement, (BatchStatement, memcass.BatchStatement)):
+                name = 'batch'
+            else:
+                name = 'unprepared'
+        return name
+
+    def prepare(self, query):
+        return self.backend.prepare(query)
+
+    def configure(self, statement, options):
+        self.backend.configure(statement, options)
+
+    def _count_speculation(self, name, future):
+        # The driver records every host a request went to, and which one
+        # answered it
+        hosts = getattr(future, 'attempted_hosts', None)
+        if not hosts or len(hosts) < 2:
+            return
+        if self.speculative is not None:
+            self.speculative.add(len(hosts) - 1, name)
+        if (self.wins is not None and
+                getattr(future, 'coordinator_host', None) != hosts[0]):
+            self.wins.inc(name)
+
+    def execute(self, statement, parameters=None, **kwargs):
+        name = self._name(statement)
+        started = time.time()
+        try:
+            results = self.backend.execute(statement, parameters, **kwargs)
+        except Exception, e:
+            self.errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            self.latency.observe(time.time() - started, name)
+        self._count_speculation(name, getattr(results, 'response_future', None))
+        return results
+
+    def execute_async(self, statement, parameters=None, **kwargs):
+        name = self._name(statement)
+        started = time.time()
+
+        def succeeded(result):
+            self.latency.observe(time.time() - started, name)
+            self._count_speculation(name, future)
+
+        def failed(error):
+            self.latency.observe(time.time() - started, name)
+            self.errors.inc(name, type(error).__name__)
+
+        try:
+            future = self.backend.execute_async(statement, parameters, **kwargs)
+        except Exception, e:
+            failed(e)
+            raise
+        future.add_callbacks(succeeded, failed)
+        return future
+
+    def batch(self):
+        return self.backend.batch()
+
+    def get_replicas(self, statement):
+        return self.backend.get_replicas(statement)
+
+    def bind_routed(self, statement, values, like):
+        return self.backend.bind_routed(statement, values, like)
+
+    def shutdown(self):
+        self.backend.shutdown()
+
+
+def _load_balancing_policy():
+    """
+    Makes the load balancing policy that CASSANDRA_LOAD_BALANCING names.
+    """
+    name = settings.CASSANDRA_LOAD_BALANCING
+    local_dc = settings.CASSANDRA_LOCAL_DC or ''
+    if name == 'round_robin':
+        return RoundRobinPolicy()
+    if name == 'dc_aware':
+        return DCAwareRoundRobinPolicy(local_dc)
+    if name == 'token_aware':
+        # Spread each partition's requests over all of its replicas
+        return TokenAwarePolicy(
+            DCAwareRoundRobinPolicy(local_dc), shuffle_replicas=True)
+    raise ImproperlyConfigured(
+        'Unknown CASSANDRA_LOAD_BALANCING %r' % (name,))
+
+
+def get_backend(name=None):
+    """
+    Connects to the backend that name, or CASSANDRA_BACKEND, says.
+    """
+    name = name or settings.CASSANDRA_BACKEND
+    if name == 'cassandra':
+        return CassandraBackend(
+            settings.CASSANDRA_HOSTS, 'twissandra',
+            port=settings.CASSANDRA_PORT,
+            protocol_version=settings.CASSANDRA_PROTOCOL_VERSION,
+            load_balancing_policy=_load_balancing_policy(),
+            request_timeout=settings.CASSANDRA_REQUEST_TIMEOUT,
+            connections_per_host=settings.CASSANDRA_CONNECTIONS_PER_HOST,
+            speculative_delay=settings.CASSANDRA_SPECULATIVE_DELAY,
+            speculative_attempts=settings.CASSANDRA_SPECULATIVE_ATTEMPTS)
+    if name == 'memory':
+        return MemoryBackend(
+            settings.MEMORY_BACKEND_LATENCY, settings.MEMORY_BACKEND_JITTER,
+            settings.DENORMALIZED_LINES,
+            speculative_delay=settings.CASSANDRA_SPECULATIVE_DELAY,
+            speculative_attempts=settings.CASSANDRA_SPECULATIVE_ATTEMPTS)
+    raise ImproperlyConfigured('Unknown CASSANDRA_BACKEND %r' % (name,))
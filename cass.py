@@ -1,37 +1,355 @@
+from collections import deque, namedtuple
 from datetime import datetime
 from uuid import uuid1, UUID
+import bisect
+import itertools
+import logging
 import random
-
-from cassandra.cluster import Cluster
-
-cluster = Cluster(['127.0.0.1'])
-session = cluster.connect('twissandra')
-
-# Prepared statements, reuse as much as possible by binding new values
-tweets_query = None
-userline_query = None
-timeline_query = None
-friends_query = None
-followers_query = None
-remove_friends_query = None
-remove_followers_query = None
-add_user_query = None
-get_tweets_query = None
-get_usernames_query = None
-get_followers_query = None
-get_friends_query = None
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+import backends
+import fanout
+from hotkeys import HotKeys
+from lrucache import LRUCache
+import metrics
+from promises import Promise, gather
+from statements import StatementRegistry
+
+log = logging.getLogger(__name__)
+
+# Connected the first time it's needed, see get_backend()
+_backend = None
+_backend_lock = threading.Lock()
+
+# Every statement this module runs.  They're all prepared together as soon as
+# the backend is connected, so that no request has to wait for one, and run
+# as CASSANDRA_STATEMENT_OPTIONS says.  Looking one up connects if nothing
+# has yet.
+statements = StatementRegistry(
+    settings.CASSANDRA_STATEMENT_OPTIONS, connect=lambda: get_backend())
+
+statements.register('add_user', """
+    INSERT INTO users (username, password)
+    VALUES (?, ?)
+    """)
+statements.register('get_user', """
+    SELECT * FROM users WHERE username=?
+    """)
+statements.register('get_many_users', """
+    SELECT * FROM users WHERE username IN ?
+    """)
+
+statements.register('add_username_prefix', """
+    INSERT INTO username_prefixes (prefix, lower_username, username)
+    VALUES (?, ?, ?)
+    """)
+statements.register('get_username_prefix', """
+    SELECT lower_username, username FROM username_prefixes
+    WHERE prefix=? LIMIT ?
+    """)
+statements.register('search_username_prefix', """
+    SELECT lower_username, username FROM username_prefixes
+    WHERE prefix=? AND lower_username>=? AND lower_username<? LIMIT ?
+    """)
+
+statements.register('add_friend', """
+    INSERT INTO friends (username, friend, since)
+    VALUES (?, ?, ?)
+    """)
+statements.register('add_follower', """
+    INSERT INTO followers (username, follower, since)
+    VALUES (?, ?, ?)
+    """)
+# Following and unfollowing go through lightweight transactions on the
+# friends row, so that only one of two at once is counted in user_stats.
+# add_friend is for loading friendships that are known to be new.
+statements.register('add_new_friend', """
+    INSERT INTO friends (username, friend, since)
+    VALUES (?, ?, ?) IF NOT EXISTS
+    """)
+statements.register('remove_friend', """
+    DELETE FROM friends WHERE username=? AND friend=? IF EXISTS
+    """)
+statements.register('remove_follower', """
+    DELETE FROM followers WHERE username=? AND follower=?
+    """)
+statements.register('get_friends', """
+    SELECT friend FROM friends WHERE username=? LIMIT ?
+    """)
+statements.register('get_friend', """
+    SELECT friend FROM friends WHERE username=? AND friend=?
+    """)
+statements.register('get_followers', """
+    SELECT follower FROM followers WHERE username=? LIMIT ?
+    """)
+statements.register('iter_friends', """
+    SELECT friend FROM friends WHERE username=?
+    """)
+statements.register('iter_followers', """
+    SELECT follower FROM followers WHERE username=?
+    """)
+
+# Counter updates aren't idempotent, so they're never retried or speculated
+statements.register('update_user_stats', """
+    UPDATE user_stats
+    SET followers = followers + ?, following = following + ?, tweets = tweets + ?
+    WHERE username=?
+    """)
+statements.register('get_user_stats', """
+    SELECT followers, following, tweets FROM user_stats WHERE username=?
+    """)
+
+statements.register('add_tweet', """
+    INSERT INTO tweets (tweet_id, username, body)
+    VALUES (?, ?, ?)
+    """)
+statements.register('get_tweet', """
+    SELECT * FROM tweets WHERE tweet_id=?
+    """)
+statements.register('get_many_tweets', """
+    SELECT * FROM tweets WHERE tweet_id IN ?
+    """)
+
+# Denormalized line rows carry their tweet with them, see DENORMALIZED_LINES
+if settings.DENORMALIZED_LINES:
+    _line_columns = 'time, tweet_id, author, body'
+else:
+    _line_columns = 'time, tweet_id'
+
+# The tables that hold lines of tweets, and the column each is partitioned
+# by.  The tagline and mentionline partitions are named by _tag_line and
+# _mention_line, plus the time bucket they're for.
+LINE_TABLES = (
+    ('userline', 'username'),
+    ('timeline', 'username'),
+    ('tagline', 'line'),
+    ('mentionline', 'line'),
+)
+
+for _table, _key in LINE_TABLES:
+    statements.register('add_to_' + _table, """
+        INSERT INTO {table} ({key}, {columns})
+        VALUES (?, ?, ?{placeholders})
+        USING TTL ?
+        """.format(table=_table, key=_key, columns=_line_columns,
+                   placeholders=', ?, ?' if settings.DENORMALIZED_LINES else ''))
+    # The first page of a line, and the pages after that
+    statements.register('get_' + _table, """
+        SELECT {columns} FROM {table} WHERE {key}=? LIMIT ?
+        """.format(table=_table, key=_key, columns=_line_columns))
+    statements.register('get_older_' + _table, """
+        SELECT {columns} FROM {table} WHERE {key}=? AND time<? LIMIT ?
+        """.format(table=_table, key=_key, columns=_line_columns))
+    # The same, only newer than a tweet the reader already has
+    statements.register('get_newer_' + _table, """
+        SELECT {columns} FROM {table} WHERE {key}=? AND time>? LIMIT ?
+        """.format(table=_table, key=_key, columns=_line_columns))
+    statements.register('get_between_' + _table, """
+        SELECT {columns} FROM {table}
+        WHERE {key}=? AND time>? AND time<? LIMIT ?
+        """.format(table=_table, key=_key, columns=_line_columns))
+statements.register('remove_from_timeline', """
+    DELETE FROM timeline WHERE username=? AND time=?
+    """)
+
+statements.register('add_line_bucket', """
+    INSERT INTO line_buckets (line, bucket)
+    VALUES (?, ?)
+    USING TTL ?
+    """)
+statements.register('get_line_buckets', """
+    SELECT bucket FROM line_buckets WHERE line=? AND bucket<=? LIMIT ?
+    """)
+statements.register('get_older_line_buckets', """
+    SELECT bucket FROM line_buckets WHERE line=? AND bucket<? LIMIT ?
+    """)
+
+statements.register('add_celebrity', """
+    INSERT INTO celebrities (username, since)
+    VALUES (?, ?)
+    """)
+statements.register('get_celebrity', """
+    SELECT username FROM celebrities WHERE username=?
+    """)
+statements.register('add_celebrity_friend', """
+    INSERT INTO celebrity_friends (username, friend)
+    VALUES (?, ?)
+    """)
+statements.register('get_celebrity_friends', """
+    SELECT friend FROM celebrity_friends WHERE username=?
+    """)
+statements.register('remove_celebrity_friend', """
+    DELETE FROM celebrity_friends WHERE username=? AND friend=?
+    """)
+
+statements.register('set_fanout_status', """
+    INSERT INTO fanout_status (tweet_id, state, attempts, delivered, error, updated)
+    VALUES (?, ?, ?, ?, ?, ?) USING TTL ?
+    """)
+statements.register('get_fanout_status', """
+    SELECT * FROM fanout_status WHERE tweet_id=?
+    """)
+statements.register('queue_fanout', """
+    INSERT INTO fanout_queue (bucket, shard, queued, time, tweet_id, username)
+    VALUES (?, ?, ?, ?, ?, ?) USING TTL ?
+    """)
+statements.register('get_queued_fanouts', """
+    SELECT bucket, shard, queued, time, tweet_id, username FROM fanout_queue
+    WHERE bucket=? AND shard=? AND queued<? LIMIT ?
+    """)
+statements.register('get_newer_queued_fanouts', """
+    SELECT bucket, shard, queued, time, tweet_id, username FROM fanout_queue
+    WHERE bucket=? AND shard=? AND queued>? AND queued<? LIMIT ?
+    """)
+statements.register('set_fanout_checkpoint', """
+    INSERT INTO fanout_checkpoints (shard, bucket, queued)
+    VALUES (?, ?, ?)
+    """)
+statements.register('get_fanout_checkpoint', """
+    SELECT bucket, queued FROM fanout_checkpoints WHERE shard=?
+    """)
 
 # NOTE: Having a single userline key to store all of the public tweets is not
-#       scalable.  This result in all public tweets being stored in a single
-#       partition, which means they must all fit on a single node.
+#       scalable.  This would result in all public tweets being stored in a
+#       single partition, which means they must all fit on a single node.
 #
-#       One fix for this is to partition the timeline by time, so we could use
-#       a key like !PUBLIC!2010-04-01 to partition it per day.  We could drill
-#       down even further into hourly keys, etc.  Since this is a demonstration
-#       and that would add quite a bit of extra code, this excercise is left to
-#       the reader.
+#       Instead, the public userline is partitioned by time.  Tweets are
+#       written to a key like !PUBLIC!2010-04-01 (or !PUBLIC!2010-04-01T13
+#       when bucketing per hour), and the buckets that actually hold tweets
+#       are recorded in the line_buckets table so that reads can walk back
+#       through them without probing empty partitions.
 PUBLIC_USERLINE_KEY = '!PUBLIC!'
 
+# Hashtags and mentions, which have to start a word.  Tweets are indexed by
+# both in the tagline and mentionline tables, bucketed by time like the public
+# userline is, see INDEX_LINE_BUCKET in settings.
+HASHTAG_RE = re.compile(r'(?<!\w)#(\w+)', re.UNICODE)
+MENTION_RE = re.compile(r'(?<!\w)@(\w+)', re.UNICODE)
+
+# How the bucketed lines are split up, see PUBLIC_USERLINE_BUCKET in settings
+BUCKET_FORMATS = {
+    'day': '%Y-%m-%d',
+    'hour': '%Y-%m-%dT%H',
+}
+
+# The number of bucket names read at a time when walking back through a line
+BUCKET_PAGE_SIZE = 10
+
+# Buckets this process has recently recorded in line_buckets.  There's one
+# for every tag and mentioned user each day, so only so many are kept, and
+# each is recorded again once LINE_BUCKET_REFRESH seconds have gone by.
+# Bucket rows expire that much later than the line rows they index, so a
+# bucket is always listed for as long as any of its rows are there.
+LINE_BUCKET_REFRESH = 60 * 60
+_known_buckets = LRUCache(10000, LINE_BUCKET_REFRESH)
+
+# The most keys read by a single IN (...) query in _multi_get
+MULTIGET_GROUP_SIZE = 20
+
+# A tweet record, as save_tweet puts it in the tweet cache
+Tweet = namedtuple('Tweet', ['tweet_id', 'username', 'body'])
+
+# How many followers, friends and tweets a user has, as kept in user_stats
+UserStats = namedtuple('UserStats', ['followers', 'following', 'tweets'])
+
+# A timeline row as kept in timeline_cache.  author and body are None when
+# they aren't known, and the tweet is looked up as for a normalized row.
+LineRow = namedtuple('LineRow', ['time', 'tweet_id', 'author', 'body'])
+
+# The newest TIMELINE_CACHE_DEPTH rows of the timelines of recently active
+# users, newest first, so that the first page of a timeline can be read
+# without going to its partition.  Fan-outs in this process add their tweet
+# to the timelines in here; ones done by fanout_worker don't, and show up
+# once the entry expires.
+timeline_cache = LRUCache(
+    settings.TIMELINE_CACHE_SIZE, settings.TIMELINE_CACHE_TTL)
+
+# A tweet as it appears in a line, along with the TimeUUID it's at
+LineEntry = namedtuple('LineEntry', ['time', 'tweet_id', 'username', 'body'])
+
+# A page of the public userline, as kept in the Django cache.  newest is the
+# TimeUUID of its first tweet and modified the UTC datetime of that, or both
+# are None if it's empty; version is the PUBLIC_PAGE_VERSION_KEY it was read
+# under.
+PublicPage = namedtuple(
+    'PublicPage', ['entries', 'next', 'newest', 'modified', 'version'])
+
+# The Django cache keys public userline pages are kept under.  save_tweet
+# changes the version, which the head page is only used with.
+PUBLIC_PAGE_KEY = 'cass.public_page.2.%s.%d'
+PUBLIC_PAGE_VERSION_KEY = 'cass.public_page.version'
+
+# Tweets never change once they've been written, so the records are cached
+# to save looking them up again on every page they show up on
+tweet_cache = LRUCache(settings.TWEET_CACHE_SIZE, settings.TWEET_CACHE_TTL)
+
+# User records are read on every request a logged in user makes.  save_user
+# drops the record from this process's cache; other processes may keep using
+# the old one for up to USER_CACHE_TTL seconds.
+user_cache = LRUCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL)
+
+# The (lower_username, username) pairs under the most searched username
+# prefixes, as sorted tuples that search_usernames can search without going
+# to Cassandra, see _load_username_prefix.  Users added since a prefix was
+# last read don't show up in it until it's read again.
+hot_prefixes = HotKeys(
+    settings.USERNAME_HOT_PREFIXES, settings.USERNAME_HOT_PREFIX_REFRESH,
+    lambda prefix: _load_username_prefix(prefix))
+
+# How long the status of a fan-out is kept around for, in seconds
+FANOUT_STATUS_TTL = 7 * 24 * 60 * 60
+
+# How long a fan-out is kept in the queue for, in seconds.  Fan-outs are
+# never deleted from the queue, which fanout_worker reads forwards through,
+# so that no read has to skip over the tombstones of the ones that are done;
+# whole buckets expire instead.
+FANOUT_QUEUE_TTL = FANOUT_STATUS_TTL
+
+# The background threads that fan tweets out when FANOUT_MODE is 'inprocess'
+_fanout_pool = None
+_fanout_pool_lock = threading.Lock()
+
+# The background threads that backfill and purge timelines when users follow
+# and unfollow each other, unless FANOUT_MODE is 'sync'
+_follow_pool = None
+_follow_pool_lock = threading.Lock()
+
+# Metrics, served at /metrics
+statement_latency = metrics.histogram(
+    'cass_statement_duration_seconds',
+    'Time taken by each statement, by name.', ['statement'])
+statement_errors = metrics.counter(
+    'cass_statement_errors_total',
+    'Statements that failed, by name and error.', ['statement', 'error'])
+speculative_executions = metrics.counter(
+    'cass_speculative_executions_total',
+    'Extra copies of statements sent because the first was slow, by name.',
+    ['statement'])
+speculative_wins = metrics.counter(
+    'cass_speculative_wins_total',
+    'Statements answered by a speculative copy rather than the first, by '
+    'name.', ['statement'])
+function_latency = metrics.histogram(
+    'cass_function_duration_seconds',
+    'Time taken by each call to a public function of cass.py.', ['function'])
+function_errors = metrics.counter(
+    'cass_function_errors_total',
+    'Exceptions raised by the public functions of cass.py.',
+    ['function', 'error'])
+fanout_size = metrics.histogram(
+    'cass_fanout_size',
+    'How many reads or writes one operation turned into: timeline_inserts '
+    'per fan-out, timeline_lines read per timeline page, line_hydration '
+    'tweets looked up per page, and tweet_reads that missed the cache.',
+    ['operation'], metrics.SIZE_BUCKETS)
+
+_timed = metrics.timed(function_latency, function_errors)
+
 
 class DatabaseError(Exception):
     """
@@ -49,214 +367,1201 @@ class InvalidDictionary(DatabaseError):
     pass
 
 
-def _get_line(table, username, start, limit):
+class ExecutionErrors(DatabaseError):
     """
-    Gets a timeline or a userline given a username, a start, and a limit.
+    Raised once all of the statements given to Executor.execute_many have
+    run, if any of them failed.  errors is a list of (index, exception)
+    pairs, in the order the statements were given.
     """
-    global get_tweets_query
-    if get_tweets_query is None:
-        get_tweets_query = session.prepare("""
-            SELECT * FROM tweets WHERE tweet_id=?
-            """)
 
-    # First we need to get the raw timeline (in the form of tweet ids)
-    query = "SELECT time, tweet_id FROM {table} WHERE username=%s {time_clause} LIMIT %s"
+    def __init__(self, errors):
+        self.errors = errors
+        DatabaseError.__init__(self, '%d statements failed, the first with: %s' % (
+            len(errors), errors[0][1]))
+
+
+class Executor(object):
+    """
+    Runs statements asynchronously, but never with more than max_in_flight
+    of them running at once across the whole process.  Anything that wants
+    to start a statement while the window is full waits for a slot, so one
+    big fan-out can't swamp the connection pool for every other request.
+
+    Statements are run on backend, or on this module's backend if that's
+    None.
+    """
+
+    def __init__(self, max_in_flight, backend=None):
+        self.max_in_flight = max_in_flight
+        self.backend = backend
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        # Statements given to submit() that are waiting for a slot
+        self._waiting = deque()
+        self._local = threading.local()
+        # Back-pressure metrics
+        self.in_flight = 0
+        self.queued = 0
+        self.executed = 0
+        self.wait_time = 0.0
+
+    def execute_async(self, query, parameters=None, **kwargs):
+        """
+        Starts running a statement, once there's a slot for it, and returns
+        its ResponseFuture.
+        """
+        with self._lock:
+            self.queued += 1
+        started = time.time()
+        self._slots.acquire()
+        waited = time.time() - started
+        with self._lock:
+            self.queued -= 1
+            self.in_flight += 1
+            self.executed += 1
+            self.wait_time += waited
+
+        try:
+            future = (self.backend or get_backend()).execute_async(
+                query, parameters, **kwargs)
+        except Exception:
+            self._release()
+            raise
+        future.add_callbacks(self._release, self._release)
+        return future
+
+    def submit(self, query, parameters=None, **kwargs):
+        """
+        Starts running a statement like execute_async, but never blocks:
+        when every slot is taken the statement waits in line for one, and is
+        started by whichever statement frees it up.  Returns a Promise of
+        the rows.
+        """
+        promise = Promise()
+        with self._lock:
+            started = self._slots.acquire(False)
+            if not started:
+                self.queued += 1
+                self._waiting.append(
+                    (promise, query, parameters, kwargs, time.time()))
+        if started:
+            self._start(promise, query, parameters, kwargs, 0.0)
+        return promise
+
+    def _start(self, promise, query, parameters, kwargs, waited):
+        # Called holding a slot
+        with self._lock:
+            self.in_flight += 1
+            self.executed += 1
+            self.wait_time += waited
+
+        def succeeded(rows):
+            self._release()
+            promise.set_result(rows)
+
+        def failed(error):
+            self._release()
+            promise.set_exception(error)
+
+        try:
+            future = (self.backend or get_backend()).execute_async(
+                query, parameters, **kwargs)
+        except Exception, e:
+            failed(e)
+            return
+        future.add_callbacks(succeeded, failed)
+
+    def _release(self, *args):
+        # The slot goes to the next statement waiting in submit(), if any.
+        # A statement that finishes as it's started releases its slot from
+        # inside _start(), so the slots freed that way are handed on by the
+        # outermost call here rather than by recursing.
+        with self._lock:
+            self.in_flight -= 1
+        local = self._local
+        if getattr(local, 'releasing', False):
+            local.freed += 1
+            return
+
+        local.releasing = True
+        local.freed = 1
+        try:
+            while local.freed:
+                local.freed -= 1
+                with self._lock:
+                    waiting = None
+                    if self._waiting:
+                        waiting = self._waiting.popleft()
+                        self.queued -= 1
+                    else:
+                        self._slots.release()
+                if waiting is not None:
+                    promise, query, parameters, kwargs, queued_at = waiting
+                    self._start(promise, query, parameters, kwargs,
+                                time.time() - queued_at)
+        finally:
+            local.releasing = False
+
+    def execute_many(self, statements_and_params):
+        """
+        Runs each of a sequence of (statement, parameters) pairs, and yields
+        their results in the same order.  Results are yielded as they come
+        in, and no more than max_in_flight of them are waited on at a time,
+        so the statements can come from a generator of any length.
+
+        A statement that fails yields None, and the errors are raised
+        together as an ExecutionErrors once everything else has run.
+        """
+        pending = deque()
+        errors = []
+        for index, (statement, parameters) in enumerate(statements_and_params):
+            if len(pending) >= self.max_in_flight:
+                yield self._collect(errors, *pending.popleft())
+            pending.append((index, self.execute_async(statement, parameters)))
+
+        while pending:
+            yield self._collect(errors, *pending.popleft())
+
+        if errors:
+            raise ExecutionErrors(errors)
+
+    def _collect(self, errors, index, future):
+        try:
+            return future.result()
+        except Exception, e:
+            errors.append((index, e))
+            return None
+
+    def execute_all(self, statements_and_params):
+        """
+        Runs each of a sequence of (statement, parameters) pairs, and returns
+        the number of statements that were run.
+        """
+        count = 0
+        for result in self.execute_many(statements_and_params):
+            count += 1
+        return count
+
+    def stats(self):
+        """
+        Gets the number of statements running and waiting for a slot, along
+        with the total run and the total seconds spent waiting for slots.
+        """
+        return {
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'executed': self.executed,
+            'wait_time': self.wait_time,
+        }
+
+
+# Every statement run asynchronously goes through this, to keep the number
+# running at once within CASSANDRA_MAX_IN_FLIGHT
+executor = Executor(settings.CASSANDRA_MAX_IN_FLIGHT)
+
+metrics.callback(
+    'cass_executor_in_flight', 'Statements running right now.', 'gauge',
+    lambda: executor.in_flight)
+metrics.callback(
+    'cass_executor_queued', 'Statements waiting for a slot to run in.',
+    'gauge', lambda: executor.queued)
+metrics.callback(
+    'cass_executor_wait_seconds_total',
+    'Total time statements have spent waiting for a slot.', 'counter',
+    lambda: executor.wait_time)
+metrics.callback(
+    'cass_executor_executed_total', 'Statements run through the executor.',
+    'counter', lambda: executor.executed)
+
+
+def _cache_metrics(name, things, cache):
+    """
+    Registers callback metrics for the size of an LRUCache (or HotKeys) and
+    its hit, miss and eviction counts.
+    """
+    prefix = 'cass_%s_cache' % (name,)
+    metrics.callback(
+        prefix + '_size', '%s in the %s cache.' % (things, name), 'gauge',
+        lambda: cache.stats()['size'])
+    metrics.callback(
+        prefix + '_hits_total', '%s found in the %s cache.' % (things, name),
+        'counter', lambda: cache.hits)
+    metrics.callback(
+        prefix + '_misses_total',
+        '%s not found in the %s cache.' % (things, name), 'counter',
+        lambda: cache.misses)
+    metrics.callback(
+        prefix + '_evictions_total',
+        '%s pushed out of the %s cache to make room.' % (things, name),
+        'counter', lambda: cache.evictions)
+
+_cache_metrics('tweet', 'Tweets', tweet_cache)
+_cache_metrics('timeline', 'Timeline heads', timeline_cache)
+_cache_metrics('user', 'Users', user_cache)
+_cache_metrics('username_prefix', 'Username prefixes', hot_prefixes)
+
+
+def get_backend():
+    """
+    Gets the backend that every statement goes through.  The first call
+    connects to it, as CASSANDRA_BACKEND and the settings for it say, and
+    prepares all of the statements, so it's best made as the process starts
+    (see wsgi.py) rather than by the first request.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                backend = backends.MeteredBackend(
+                    backends.get_backend(), statements.name_of,
+                    statement_latency, statement_errors,
+                    speculative_executions, speculative_wins)
+                statements.prepare_all(backend)
+                _backend = backend
+    return _backend
+
+
+def shutdown():
+    """
+    Waits for the background fan-outs and follow jobs to finish, and then
+    disconnects from the backend, for commands that are done with it.  Using
+    cass after this connects to it afresh.
+    """
+    global _backend, _fanout_pool, _follow_pool
+    with _fanout_pool_lock:
+        fanout_pool, _fanout_pool = _fanout_pool, None
+    with _follow_pool_lock:
+        follow_pool, _follow_pool = _follow_pool, None
+    for pool in (fanout_pool, follow_pool):
+        if pool is not None:
+            pool.stop()
+
+    with _backend_lock:
+        backend, _backend = _backend, None
+        statements.forget()
+    if backend is not None:
+        backend.shutdown()
+
+
+def _timeuuid_to_unix(timeuuid):
+    """
+    Converts a TimeUUID into the Unix timestamp it was generated at.
+    """
+    return (timeuuid.time - 0x01b21dd213814000L) / 1e7
+
+
+def _timeuuid_to_datetime(timeuuid):
+    """
+    Converts a TimeUUID into the UTC datetime it was generated at.
+    """
+    return datetime.utcfromtimestamp(_timeuuid_to_unix(timeuuid))
+
+
+def parse_timeuuid(value):
+    """
+    Parses the string form of a TimeUUID that came from outside, like a page
+    cursor, and raises ValueError if it isn't one, or if its time is too far
+    out to say which bucket it's in.
+    """
+    timeuuid = UUID(value)
+    if timeuuid.version != 1:
+        raise ValueError('%s is not a TimeUUID' % (value,))
+    try:
+        when = _timeuuid_to_datetime(timeuuid)
+    except (ValueError, OverflowError):
+        raise ValueError('%s is out of range' % (value,))
+    # strftime() can't format anything older
+    if when.year < 1900:
+        raise ValueError('%s is out of range' % (value,))
+    return timeuuid
+
+
+def _line_bucket(timeuuid, bucket_size):
+    """
+    Gets the name of the bucket that a TimeUUID falls into, for lines split
+    up into bucket_size buckets, 'day' or 'hour'.
+    """
+    bucket_format = BUCKET_FORMATS[bucket_size]
+    return _timeuuid_to_datetime(timeuuid).strftime(bucket_format)
+
+
+def _public_bucket(timeuuid):
+    """
+    Gets the name of the public userline bucket that a TimeUUID falls into.
+    """
+    return _line_bucket(timeuuid, settings.PUBLIC_USERLINE_BUCKET)
+
+
+def _tag_line(tag):
+    """
+    Gets the name of the line of tweets with a hashtag, which is the same
+    whatever case the tag is written in.
+    """
+    return '#%s!' % (tag.lower(),)
+
+
+def _mention_line(username):
+    """
+    Gets the name of the line of tweets that mention a user.
+    """
+    return '@%s!' % (username,)
+
+
+def _index_lines(body):
+    """
+    Gets the (table, line) of each tagline and mentionline that a tweet with
+    the given body goes into.
+    """
+    lines = set()
+    for tag in HASHTAG_RE.findall(body):
+        lines.add(('tagline', _tag_line(tag)))
+    for username in MENTION_RE.findall(body):
+        lines.add(('mentionline', _mention_line(username)))
+    return sorted(lines)
+
 
+def _get_line_rows_async(table, username, start, limit, since=None):
+    """
+    Starts fetching the raw (time, tweet_id) rows of a single line partition,
+    newest first, older than start and newer than since if they're given.
+    """
     # See if we need to start our page at the beginning or further back
-    if not start:
-        time_clause = ''
+    if not start and not since:
+        query = statements['get_' + table]
         params = (username, limit)
+    elif not since:
+        query = statements['get_older_' + table]
+        params = (username, start, limit)
+    elif not start:
+        query = statements['get_newer_' + table]
+        params = (username, since, limit)
     else:
-        time_clause = 'AND time < %s'
-        params = (username, UUID(start), limit)
+        query = statements['get_between_' + table]
+        params = (username, since, start, limit)
 
-    query = query.format(table=table, time_clause=time_clause)
+    return executor.submit(query, params).then(list)
 
-    results = session.execute(query, params)
-    if not results:
-        return [], None
 
-    # If we didn't get to the end, return a starting point for the next page
-    if len(results) == limit:
-        # Find the oldest ID
-        oldest_timeuuid = min(row.time for row in results)
+def _get_line_rows(table, username, start, limit, since=None):
+    """
+    Gets the raw (time, tweet_id) rows of a single line partition, newest
+    first.
+    """
+    return _get_line_rows_async(table, username, start, limit, since).result()
+
+
+def _time_key(timeuuid):
+    # The order Cassandra sorts TimeUUIDs in
+    return (timeuuid.time, timeuuid.bytes)
 
-        # Present the string version of the oldest_timeuuid for the UI
-        next_timeuuid = oldest_timeuuid.urn[len('urn:uuid:'):]
+
+def _merge_line_rows(lines, limit):
+    """
+    Merges several newest-first lists of line rows into a single one, keeping
+    at most limit rows.  A tweet can be in more than one of the lines, so
+    rows with the same time are only kept once.
+    """
+    rows = sorted(itertools.chain(*lines),
+                  key=lambda row: _time_key(row.time),
+                  reverse=True)
+
+    merged = []
+    for row in rows:
+        if merged and merged[-1].time == row.time:
+            continue
+        merged.append(row)
+        if len(merged) == limit:
+            break
+    return merged
+
+
+def _get_timeline_rows_async(username, start, limit, since=None):
+    """
+    Gets a promise of the raw (time, tweet_id) rows of a user's timeline.
+    Tweets from
+    celebrities aren't fanned out to their followers, so they are pulled
+    from the userlines of the celebrities the user follows and merged in.
+
+    The first page of the timeline partition comes from timeline_cache when
+    it's there, and goes into it when it isn't.  So do the rows newer than
+    since, as long as the cached rows go back that far.
+    """
+    depth = settings.TIMELINE_CACHE_DEPTH
+    cacheable = not start and limit <= depth
+    own = None
+    fill = False
+    if cacheable:
+        head = timeline_cache.get(username)
+        if head is None:
+            fill = not since
+        elif (not since or len(head) < depth or
+              _time_key(head[-1].time) <= _time_key(since)):
+            own = [row for row in head
+                   if not since or _time_key(row.time) > _time_key(since)]
+            own = own[:limit]
+
+    # The timeline partition is read while the celebrities are looked up
+    if own is None:
+        own = _get_line_rows_async(
+            'timeline', username, start, depth if fill else limit, since)
     else:
-        next_timeuuid = None
+        own = Promise.resolved(own)
 
-    # Now we fetch the tweets themselves
-    futures = []
-    for row in results:
-        futures.append(session.execute_async(
-            get_tweets_query, (row.tweet_id,)))
+    def read(celebrities):
+        promises = [own]
+        for celebrity in celebrities:
+            promises.append(
+                _get_line_rows_async('userline', celebrity, start, limit, since))
+        fanout_size.observe(len(promises), 'timeline_lines')
+        return gather(promises).then(merge)
 
-    tweets = [f.result()[0] for f in futures]
-    return (tweets, next_timeuuid)
+    def merge(lines):
+        if fill:
+            timeline_cache.set(username, tuple(
+                LineRow(row.time, row.tweet_id, getattr(row, 'author', None),
+                        getattr(row, 'body', None))
+                for row in lines[0]))
+            lines[0] = lines[0][:limit]
 
+        if len(lines) == 1:
+            return lines[0]
+        return _merge_line_rows(lines, limit)
+
+    return get_celebrity_friend_usernames_async(username).then(read)
 
-# QUERYING APIs
 
-def get_user_by_username(username):
+def _push_timeline_row(username, row):
     """
-    Given a username, this gets the user record.
+    Adds a row to the head of a user's timeline in timeline_cache, if it's
+    there, dropping the oldest row once there are TIMELINE_CACHE_DEPTH.
     """
-    global get_usernames_query
-    if get_usernames_query is None:
-        get_usernames_query = session.prepare("""
-            SELECT * FROM users WHERE username=?
-            """)
+    def push(rows):
+        if any(existing.time == row.time for existing in rows):
+            return rows
+        rows = sorted(rows + (row,),
+                      key=lambda line_row: _time_key(line_row.time),
+                      reverse=True)
+        return tuple(rows[:settings.TIMELINE_CACHE_DEPTH])
 
-    rows = session.execute(get_usernames_query, (username,))
-    if not rows:
-        raise NotFound('User %s not found' % (username,))
+    timeline_cache.update(username, push)
+
+
+def _get_line_buckets_async(line, before, inclusive):
+    """
+    Gets a promise of the next page of bucket names for a line, newest
+    first, starting at (or just before) the bucket named by before.
+    """
+    if inclusive:
+        query = statements['get_line_buckets']
+    else:
+        query = statements['get_older_line_buckets']
+
+    return executor.submit(query, (line, before, BUCKET_PAGE_SIZE)).then(
+        lambda rows: [row.bucket for row in rows])
+
+
+def _get_bucketed_rows_async(table, line, bucket_size, start, limit,
+                             since=None):
+    """
+    Gets a promise of the raw (time, tweet_id) rows of a line split up into
+    bucket_size buckets, walking backwards through its buckets until the
+    page is full, or the buckets run out or get older than since.
+    """
+    oldest = None
+    if since:
+        oldest = _line_bucket(since, bucket_size)
+
+    if start:
+        before = _line_bucket(start, bucket_size)
+    else:
+        # A bucket name that sorts after every real bucket
+        before = '~'
+
+    rows = []
+
+    def read_buckets(before, inclusive):
+        return _get_line_buckets_async(line, before, inclusive).then(
+            lambda buckets: read_bucket(buckets, 0))
+
+    def read_bucket(buckets, i):
+        if not buckets:
+            return rows
+        if i == len(buckets):
+            return read_buckets(buckets[-1], False)
+        if oldest is not None and buckets[i] < oldest:
+            return rows
+
+        def add(found):
+            rows.extend(found)
+            if len(rows) == limit:
+                return rows
+            return read_bucket(buckets, i + 1)
+
+        return _get_line_rows_async(
+            table, line + buckets[i], start, limit - len(rows), since).then(add)
+
+    return read_buckets(before, True)
+
+
+def line_bucket_ttl(table):
+    """
+    Gets the TTL that the line_buckets rows of the lines in a table are
+    written with, or 0 if they're kept for good like the lines.
+    """
+    ttl = line_ttl(table)
+    if not ttl:
+        return 0
+    return ttl + LINE_BUCKET_REFRESH
+
+
+def _save_line_bucket_async(table, line, bucket):
+    """
+    Records that a bucket of a time bucketed line in a table holds tweets,
+    and returns a promise of when that's done.
+    """
+    # The bucket only has to be recorded once, so skip the write if we've
+    # already done it
+    if _known_buckets.get((line, bucket)):
+        return Promise.resolved(None)
+
+    def saved(rows):
+        _known_buckets.set((line, bucket), True)
+
+    return executor.submit(
+        statements['add_line_bucket'],
+        (line, bucket, line_bucket_ttl(table))).then(saved)
+
+
+def _replica_groups(query, keys):
+    """
+    Splits keys up into lists of keys owned by the same replicas, and
+    returns a list of the groups.  query is a prepared statement that reads
+    a single key, and is used to work out the routing keys.  If the backend
+    doesn't know the replicas all the keys end up in one group.
+    """
+    backend = get_backend()
+    groups = {}
+    for key in keys:
+        replicas = frozenset(backend.get_replicas(query.bind((key,))))
+        groups.setdefault(replicas, []).append(key)
+    return groups.values()
+
+
+def _multi_get_async(one_query, many_query, key_column, keys):
+    """
+    Reads the rows for a list of primary keys, and returns a promise of a
+    dictionary of the rows that were found by their key.
+
+    The keys owned by the same replicas are read together,
+    MULTIGET_GROUP_SIZE at a time, by many_query (which takes a list of keys
+    for an IN clause), and they're all run concurrently.  Each of those
+    queries is routed like one_query for its first key would be, so the load
+    balancing policy sends it to one of the replicas that own all its keys,
+    spreads them over the replicas, and can retry or speculate on another.
+    """
+    backend = get_backend()
+    promises = []
+    for group in _replica_groups(one_query, set(keys)):
+        for i in range(0, len(group), MULTIGET_GROUP_SIZE):
+            chunk = group[i:i + MULTIGET_GROUP_SIZE]
+            statement = backend.bind_routed(
+                many_query, (chunk,), one_query.bind((chunk[0],)))
+            promises.append(executor.submit(statement))
+
+    def collect(results):
+        rows = {}
+        for result in results:
+            for row in result:
+                rows[getattr(row, key_column)] = row
+        return rows
+
+    return gather(promises).then(collect)
+
+
+def _get_tweets_async(tweet_ids):
+    """
+    Gets a promise of the tweet records for a list of tweet ids, in the same
+    order, with None for any tweet that doesn't exist.  Only the tweets that
+    aren't in the tweet cache are read from Cassandra.
+    """
+    tweets = tweet_cache.get_many(tweet_ids)
+
+    missing = set(tweet_ids).difference(tweets)
+    fanout_size.observe(len(missing), 'tweet_reads')
+    if not missing:
+        return Promise.resolved(
+            [tweets.get(tweet_id) for tweet_id in tweet_ids])
+
+    def collect(found):
+        for tweet_id, tweet in found.items():
+            tweets[tweet_id] = tweet
+            tweet_cache.set(tweet_id, tweet)
+        return [tweets.get(tweet_id) for tweet_id in tweet_ids]
+
+    return _multi_get_async(
+        statements['get_tweet'], statements['get_many_tweets'], 'tweet_id',
+        missing).then(collect)
+
+
+def _get_line_entries_async(rows):
+    """
+    Gets a promise of the LineEntry for each of the rows of a line, skipping
+    any tweets that don't exist.  Denormalized rows already hold their
+    tweet, so only the rows written before the line was denormalized need
+    looking up.
+    """
+    missing = [row.tweet_id for row in rows if getattr(row, 'body', None) is None]
+    fanout_size.observe(len(missing), 'line_hydration')
+
+    def collect(tweets):
+        found = dict(zip(missing, tweets))
+        entries = []
+        for row in rows:
+            if getattr(row, 'body', None) is not None:
+                entries.append(
+                    LineEntry(row.time, row.tweet_id, row.author, row.body))
+            elif found.get(row.tweet_id) is not None:
+                tweet = found[row.tweet_id]
+                entries.append(
+                    LineEntry(row.time, row.tweet_id, tweet.username,
+                              tweet.body))
+        return entries
+
+    return _get_tweets_async(missing).then(collect)
+
+
+def _line_insert(table, username, time, tweet_id, author, body):
+    """
+    Gets the (statement, parameters) that insert a tweet into one of the
+    LINE_TABLES.  The tweet's author and body are only stored in the row if
+    DENORMALIZED_LINES is on.
+    """
+    if settings.DENORMALIZED_LINES:
+        params = (username, time, tweet_id, author, body, line_ttl(table))
+    else:
+        params = (username, time, tweet_id, line_ttl(table))
+    return statements['add_to_' + table], params
+
+
+def line_ttl(table):
+    """
+    Gets the TTL that rows are written to a line table with, TIMELINE_TTL
+    for timelines and USERLINE_TTL for the rest, which like the userline
+    index a user's own tweets.  0 means they're kept for good.
+    """
+    if table == 'timeline':
+        return settings.TIMELINE_TTL or 0
+    return settings.USERLINE_TTL or 0
+
+
+def _get_line_async(table, username, start, limit, since=None):
+    """
+    Gets a promise of a line given its table, the key of its partition (a
+    username, or the name of a tagline or mentionline), a start, and a
+    limit, as LineEntry tuples.  Given since, only tweets newer than
+    it are got.
+    """
+    return _get_line_page_async(table, username, start, limit, since).then(
+        lambda page: page[:2])
+
+
+def _get_line_page_async(table, username, start, limit, since=None):
+    """
+    Gets a promise of a page of a line like _get_line_async, along with the
+    TimeUUID of the newest tweet on it, or None if there are no tweets.
+    """
+    if start:
+        start = parse_timeuuid(start)
+    if since:
+        since = parse_timeuuid(since)
+
+    # First we need to get the raw timeline (in the form of tweet ids)
+    if table == 'userline' and username == PUBLIC_USERLINE_KEY:
+        rows = _get_bucketed_rows_async(
+            table, username, settings.PUBLIC_USERLINE_BUCKET, start, limit,
+            since)
+    elif table in ('tagline', 'mentionline'):
+        rows = _get_bucketed_rows_async(
+            table, username, settings.INDEX_LINE_BUCKET, start, limit, since)
+    elif table == 'timeline':
+        rows = _get_timeline_rows_async(username, start, limit, since)
     else:
+        rows = _get_line_rows_async(table, username, start, limit, since)
+
+    def page(results):
+        if not results:
+            return [], None, None
+
+        # If we didn't get to the end, return a starting point for the next
+        # page
+        if len(results) == limit:
+            # Find the oldest ID, rows come back newest first
+            oldest_timeuuid = results[-1].time
+
+            # Present the string version of the oldest_timeuuid for the UI
+            next_timeuuid = oldest_timeuuid.urn[len('urn:uuid:'):]
+        else:
+            next_timeuuid = None
+
+        # Now we fetch the tweets themselves
+        return _get_line_entries_async(results).then(
+            lambda entries: (entries, next_timeuuid, results[0].time))
+
+    return rows.then(page)
+
+
+# QUERYING APIs
+
+# Each of the functions with an _async twin just waits for the twin's
+# promise.  The promises don't hold up a thread while the queries run, so a
+# view can start several of them and wait for them all at once.
+
+@_timed
+def get_user_by_username_async(username, cached=True):
+    """
+    Given a username, this gets a promise of the user record.  The record may
+    come from the user cache, unless cached is False, in which case it's read
+    from the users table and the cache is refreshed with it.
+    """
+    if cached:
+        user = user_cache.get(username)
+        if user is not None:
+            return Promise.resolved(user)
+
+    def found(rows):
+        if not rows:
+            raise NotFound('User %s not found' % (username,))
+        user_cache.set(username, rows[0])
         return rows[0]
 
+    return executor.submit(statements['get_user'], (username,)).then(found)
+
+
+@_timed
+def get_user_by_username(username, cached=True):
+    return get_user_by_username_async(username, cached).result()
+
+
+def _load_username_prefix(prefix):
+    """
+    Gets a promise of the (lower_username, username) pairs under a prefix,
+    up to USERNAME_HOT_PREFIX_DEPTH of them, for hot_prefixes.  The pairs
+    are in a sorted tuple, along with whether that's all of them.
+    """
+    depth = settings.USERNAME_HOT_PREFIX_DEPTH
+    return executor.submit(
+        statements['get_username_prefix'], (prefix, depth)).then(
+            lambda rows: (tuple(sorted((row.lower_username, row.username)
+                                       for row in rows)),
+                          len(rows) < depth))
+
 
+@_timed
+def search_usernames_async(prefix, limit=10):
+    """
+    Gets a promise of up to limit usernames that start with prefix, whatever
+    their case, in order.  They come from hot_prefixes if the prefix's
+    partition of the index is one of the most searched, or else from the
+    index.
+    """
+    lower_prefix = prefix.lower()
+    if not lower_prefix:
+        return Promise.resolved([])
+    partition = lower_prefix[:settings.USERNAME_PREFIX_LENGTH]
+
+    hot = hot_prefixes.get(partition)
+    if hot is not None:
+        pairs, complete = hot
+        usernames = []
+        i = bisect.bisect_left(pairs, (lower_prefix,))
+        for lower_username, username in pairs[i:]:
+            if not lower_username.startswith(lower_prefix):
+                return Promise.resolved(usernames)
+            usernames.append(username)
+            if len(usernames) == limit:
+                return Promise.resolved(usernames)
+        # The rest of the usernames could be past the ones that were kept
+        if complete:
+            return Promise.resolved(usernames)
+
+    if lower_prefix == partition:
+        promise = executor.submit(
+            statements['get_username_prefix'], (partition, limit))
+    else:
+        # Past the last character that can follow the prefix
+        end = lower_prefix + u'\uffff'
+        promise = executor.submit(statements['search_username_prefix'], (
+            partition, lower_prefix, end, limit))
+    return promise.then(lambda rows: [row.username for row in rows])
+
+
+@_timed
+def search_usernames(prefix, limit=10):
+    return search_usernames_async(prefix, limit).result()
+
+
+@_timed
 def get_friend_usernames(username, count=5000):
     """
     Given a username, gets the usernames of the people that the user is
     following.
     """
-    global get_friends_query
-    if get_friends_query is None:
-        get_friends_query = session.prepare("""
-            SELECT friend FROM friends WHERE username=? LIMIT ?
-            """)
-
-    rows = session.execute(get_friends_query, (username, count))
+    rows = get_backend().execute(statements['get_friends'], (username, count))
     return [row.friend for row in rows]
 
 
+@_timed
+def is_following_async(username, friend_username):
+    """
+    Given two usernames, gets a promise of whether the first user is
+    following the second, by looking up that one friendship.
+    """
+    return executor.submit(
+        statements['get_friend'], (username, friend_username)).then(bool)
+
+
+@_timed
+def is_following(username, friend_username):
+    return is_following_async(username, friend_username).result()
+
+
+@_timed
 def get_follower_usernames(username, count=5000):
     """
     Given a username, gets the usernames of the people following that user.
     """
-    global get_followers_query
-    if get_followers_query is None:
-        get_followers_query = session.prepare("""
-            SELECT follower FROM followers WHERE username=? LIMIT ?
-            """)
-
-    rows = session.execute(get_followers_query, (username, count))
+    rows = get_backend().execute(statements['get_followers'], (username, count))
     return [row.follower for row in rows]
 
 
-def get_users_for_usernames(usernames):
+def _iter_rows(query, params, fetch_size):
+    """
+    Yields the rows of a prepared query, reading them fetch_size at a time
+    by following the driver's paging state, so that only one page is ever
+    held in memory.
+    """
+    paging_state = None
+    while True:
+        statement = query.bind(params)
+        statement.fetch_size = fetch_size
+        results = get_backend().execute(statement, paging_state=paging_state)
+        for row in results.current_rows:
+            yield row
+        if not results.has_more_pages:
+            break
+        paging_state = results.paging_state
+
+
+def _chunks(iterable, size):
     """
-    Given a list of usernames, this gets the associated user object for each
-    one.
+    Splits an iterable up into lists of up to size items.
     """
-    global get_usernames_query
-    if get_usernames_query is None:
-        get_usernames_query = session.prepare("""
-            SELECT * FROM users WHERE username=?
-            """)
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
 
-    futures = []
-    for user in usernames:
-        future = session.execute_async(get_usernames_query, (user, ))
-        futures.append(future)
 
-    users = []
-    for user, future in zip(usernames, futures):
-        results = future.result()
-        if not results:
-            raise NotFound('User %s not found' % (user,))
-        users.append(results[0])
+@_timed
+def iter_friend_usernames(username, fetch_size=None):
+    """
+    Given a username, yields the usernames of all of the people that the user
+    is following, reading them a page at a time.
+    """
+    fetch_size = fetch_size or settings.FOLLOWER_FETCH_SIZE
+    for row in _iter_rows(statements['iter_friends'], (username,), fetch_size):
+        yield row.friend
+
+
+@_timed
+def iter_follower_usernames(username, fetch_size=None):
+    """
+    Given a username, yields the usernames of all of the people following
+    that user, reading them a page at a time.
+    """
+    fetch_size = fetch_size or settings.FOLLOWER_FETCH_SIZE
+    for row in _iter_rows(
+            statements['iter_followers'], (username,), fetch_size):
+        yield row.follower
 
-    return users
 
+@_timed
+def is_celebrity(username):
+    """
+    Given a username, finds out whether the user has so many followers that
+    their tweets are pulled into timelines at read time instead of being
+    fanned out.
+    """
+    return bool(get_backend().execute(statements['get_celebrity'], (username,)))
+
+
+@_timed
+def get_celebrity_friend_usernames_async(username):
+    """
+    Given a username, gets a promise of the usernames of the celebrities
+    that the user is following.
+    """
+    return executor.submit(
+        statements['get_celebrity_friends'], (username,)).then(
+            lambda rows: [row.friend for row in rows])
+
+
+@_timed
+def get_celebrity_friend_usernames(username):
+    return get_celebrity_friend_usernames_async(username).result()
+
+
+@_timed
+def get_users_for_usernames_async(usernames):
+    """
+    Given a list of usernames, this gets a promise of the associated user
+    object for each one.
+    """
+    def collect(found):
+        users = []
+        for user in usernames:
+            if user not in found:
+                raise NotFound('User %s not found' % (user,))
+            users.append(found[user])
+        return users
+
+    return _multi_get_async(
+        statements['get_user'], statements['get_many_users'], 'username',
+        usernames).then(collect)
+
+
+@_timed
+def get_users_for_usernames(usernames):
+    return get_users_for_usernames_async(usernames).result()
 
+
+@_timed
 def get_friends(username, count=5000):
     """
-    Given a username, gets the people that the user is following.
+    Given a username, gets the people that the user is following.  This is a
+    generator, and the users are looked up a page at a time as it goes.
     """
-    friend_usernames = get_friend_usernames(username, count=count)
-    return get_users_for_usernames(friend_usernames)
+    friend_usernames = itertools.islice(iter_friend_usernames(username), count)
+    for chunk in _chunks(friend_usernames, settings.FOLLOWER_FETCH_SIZE):
+        for user in get_users_for_usernames(chunk):
+            yield user
 
 
+@_timed
 def get_followers(username, count=5000):
     """
-    Given a username, gets the people following that user.
+    Given a username, gets the people following that user.  This is a
+    generator, and the users are looked up a page at a time as it goes.
     """
-    follower_usernames = get_follower_usernames(username, count=count)
-    return get_users_for_usernames(follower_usernames)
+    follower_usernames = itertools.islice(
+        iter_follower_usernames(username), count)
+    for chunk in _chunks(follower_usernames, settings.FOLLOWER_FETCH_SIZE):
+        for user in get_users_for_usernames(chunk):
+            yield user
 
 
-def get_timeline(username, start=None, limit=40):
+@_timed
+def get_user_stats_async(username):
     """
-    Given a username, get their tweet timeline (tweets from people they follow).
+    Given a username, gets a promise of the UserStats of that user, from a
+    single row of counters.  They're kept up to date as users tweet and
+    follow each other, and are all 0 for a user who hasn't yet.
     """
-    return _get_line("timeline", username, start, limit)
+    def found(rows):
+        if not rows:
+            return UserStats(0, 0, 0)
+        row = rows[0]
+        return UserStats(
+            row.followers or 0, row.following or 0, row.tweets or 0)
+
+    return executor.submit(
+        statements['get_user_stats'], (username,)).then(found)
+
 
+@_timed
+def get_user_stats(username):
+    return get_user_stats_async(username).result()
 
-def get_userline(username, start=None, limit=40):
+
+@_timed
+def get_timeline_async(username, start=None, limit=40, since=None):
     """
-    Given a username, get their userline (their tweets).
+    Given a username, get a promise of their tweet timeline (tweets from
+    people they follow).  Tweets from celebrities they follow are merged in
+    as the timeline is read.
     """
-    return _get_line("userline", username, start, limit)
+    return _get_line_async("timeline", username, start, limit, since)
 
 
-def get_tweet(tweet_id):
+@_timed
+def get_timeline(username, start=None, limit=40, since=None):
+    return get_timeline_async(username, start, limit, since).result()
+
+
+@_timed
+def get_userline_async(username, start=None, limit=40, since=None):
+    """
+    Given a username, get a promise of their userline (their tweets).
+    """
+    return _get_line_async("userline", username, start, limit, since)
+
+
+@_timed
+def get_userline(username, start=None, limit=40, since=None):
+    return get_userline_async(username, start, limit, since).result()
+
+
+@_timed
+def get_tagline_async(tag, start=None, limit=40, since=None):
+    """
+    Given a hashtag, without the #, get a promise of the tweets tagged with
+    it.
+    """
+    return _get_line_async("tagline", _tag_line(tag), start, limit, since)
+
+
+@_timed
+def get_tagline(tag, start=None, limit=40, since=None):
+    return get_tagline_async(tag, start, limit, since).result()
+
+
+@_timed
+def get_mentions_async(username, start=None, limit=40, since=None):
     """
-    Given a tweet id, this gets the entire tweet record.
+    Given a username, get a promise of the tweets that mention them.
     """
-    global get_tweets_query
-    if get_tweets_query is None:
-        get_tweets_query = session.prepare("""
-            SELECT * FROM tweets WHERE tweet_id=?
-            """)
+    return _get_line_async(
+        "mentionline", _mention_line(username), start, limit, since)
+
 
-    results = session.execute(get_tweets_query, (tweet_id, ))
-    if not results:
-        raise NotFound('Tweet %s not found' % (tweet_id,))
+@_timed
+def get_mentions(username, start=None, limit=40, since=None):
+    return get_mentions_async(username, start, limit, since).result()
+
+
+def _get_public_page_async(key, start, limit):
+    """
+    Gets a promise of a page of the public userline for get_public_page, and
+    the TTL to cache it for, or None if it came from the cache.
+    """
+    if start:
+        page = cache.get(key)
+        version = None
     else:
-        return results[0]
+        found = cache.get_many([key, PUBLIC_PAGE_VERSION_KEY])
+        page = found.get(key)
+        version = found.get(PUBLIC_PAGE_VERSION_KEY)
+        if page is not None and page.version != version:
+            page = None
+    if page is not None:
+        return Promise.resolved((page, None))
+
+    def read(line_page):
+        entries, next_timeuuid, newest = line_page
+        modified = None
+        if newest is not None:
+            modified = _timeuuid_to_datetime(newest)
+        page = PublicPage(entries, next_timeuuid, newest, modified, version)
+        if start:
+            return page, settings.PUBLIC_OLD_PAGE_CACHE_TTL
+        return page, settings.PUBLIC_PAGE_CACHE_TTL
+
+    return _get_line_page_async(
+        'userline', PUBLIC_USERLINE_KEY, start, limit).then(read)
+
+
+@_timed
+def get_public_page(start=None, limit=40):
+    """
+    Gets a page of the public userline, like get_userline does, as a
+    PublicPage from the Django cache if it's there.  start must be the
+    string form of a TimeUUID; it's checked before it goes into a cache key.
 
+    The first page is kept for PUBLIC_PAGE_CACHE_TTL seconds, but is read
+    again as soon as save_tweet has added a tweet.  Pages given a start only
+    hold tweets older than it, which don't change, so they're kept for
+    PUBLIC_OLD_PAGE_CACHE_TTL seconds.
 
-def get_tweets_for_tweet_ids(tweet_ids):
+    There's no promise based version, because the cache may be over the
+    network, and mustn't be written to from a callback.
     """
-    Given a list of tweet ids, this gets the associated tweet object for each
-    one.
+    if start:
+        start = str(parse_timeuuid(start))
+    key = PUBLIC_PAGE_KEY % (start or 'head', limit)
+    page, ttl = _get_public_page_async(key, start, limit).result()
+    if ttl is not None:
+        cache.set(key, page, ttl)
+    return page
+
+
+@_timed
+def get_tweet_async(tweet_id):
+    """
+    Given a tweet id, this gets a promise of the entire tweet record.
     """
-    global get_tweets_query
-    if get_tweets_query is None:
-        get_tweets_query = session.prepare("""
-            SELECT * FROM tweets WHERE tweet_id=?
-            """)
+    return get_tweets_for_tweet_ids_async([tweet_id]).then(
+        lambda tweets: tweets[0])
 
-    futures = []
-    for tweet_id in tweet_ids:
-        futures.append(session.execute_async(get_tweets_query, (tweet_id,)))
 
-    tweets = []
-    for tweet_id, future in zip(tweet_id, futures):
-        result = future.result()
-        if not result:
-            raise NotFound('Tweet %s not found' % (tweet_id,))
-        else:
-            tweets.append(result[0])
+@_timed
+def get_tweet(tweet_id):
+    return get_tweet_async(tweet_id).result()
 
-    return tweets
+
+@_timed
+def get_tweets_for_tweet_ids_async(tweet_ids):
+    """
+    Given a list of tweet ids, this gets a promise of the associated tweet
+    object for each one.
+    """
+    def check(tweets):
+        for tweet_id, tweet in zip(tweet_ids, tweets):
+            if tweet is None:
+                raise NotFound('Tweet %s not found' % (tweet_id,))
+        return tweets
+
+    return _get_tweets_async(tweet_ids).then(check)
+
+
+@_timed
+def get_tweets_for_tweet_ids(tweet_ids):
+    return get_tweets_for_tweet_ids_async(tweet_ids).result()
 
 
 # INSERTING APIs
 
+def _username_prefix_inserts(username):
+    """
+    Gets the (statement, parameters) that add a username to the prefix
+    index, under each of its first USERNAME_PREFIX_LENGTH prefixes.
+    """
+    lower_username = username.lower()
+    for length in range(1, settings.USERNAME_PREFIX_LENGTH + 1):
+        if length > len(lower_username):
+            break
+        yield (statements['add_username_prefix'],
+               (lower_username[:length], lower_username, username))
+
+
+@_timed
 def save_user(username, password):
     """
-    Saves the user record.
+    Saves the user record, and adds the username to the prefix index.
     """
-    global add_user_query
-    if add_user_query is None:
-        add_user_query = session.prepare("""
-            INSERT INTO users (username, password)
-            VALUES (?, ?)
-            """)
+    get_backend().execute(statements['add_user'], (username, password))
+    user_cache.delete(username)
+    executor.execute_all(_username_prefix_inserts(username))
 
-    session.execute(add_user_query, (username, password))
+
+def _user_stats_update(username, followers=0, following=0, tweets=0):
+    """
+    Gets the (statement, parameters) that add to the counters in a user's
+    UserStats.
+    """
+    return (statements['update_user_stats'],
+            (followers, following, tweets, username))
 
 
 def _timestamp_to_uuid(time_arg):
@@ -277,113 +1582,475 @@ def _timestamp_to_uuid(time_arg):
         version=1)
 
 
+def _save_tweet_async(tweet_id, username, tweet, timestamp=None):
+    """
+    Saves the tweet record for save_tweet, and returns a promise of its
+    TimeUUID once it's in the userlines and the user's own timeline.
+    Inserting it into the followers'
+    timelines is handed over as FANOUT_MODE says before this returns, so in
+    'sync' mode, or 'inprocess' mode with a full queue, this blocks while
+    the fan-out is done.
+    """
+    if timestamp is None:
+        now = uuid1()
+    else:
+        now = _timestamp_to_uuid(timestamp)
+
+    # Insert the tweet
+    added = executor.submit(statements['add_tweet'], (tweet_id, username, tweet,))
+    tweet_cache.set(tweet_id, Tweet(tweet_id, username, tweet))
+    # Insert tweet into the user's timeline
+    writes = [added, executor.submit(*_line_insert(
+        'userline', username, now, tweet_id, username, tweet))]
+    # Insert tweet into the public timeline, in the bucket for its time
+    bucket = _public_bucket(now)
+    writes.append(executor.submit(*_line_insert(
+        'userline', PUBLIC_USERLINE_KEY + bucket, now, tweet_id, username,
+        tweet)))
+    writes.append(_save_line_bucket_async(
+        'userline', PUBLIC_USERLINE_KEY, bucket))
+    # Index the tweet by its hashtags and mentions
+    bucket = _line_bucket(now, settings.INDEX_LINE_BUCKET)
+    for table, line in _index_lines(tweet):
+        writes.append(executor.submit(*_line_insert(
+            table, line + bucket, now, tweet_id, username, tweet)))
+        writes.append(_save_line_bucket_async(table, line, bucket))
+    # Insert tweet into the user's own timeline
+    writes.append(executor.submit(*_line_insert(
+        'timeline', username, now, tweet_id, username, tweet)))
+    writes.append(executor.submit(*_user_stats_update(username, tweets=1)))
+
+    # The timeline cache is only told about the tweet once it can be read
+    # back
+    def saved(results):
+        _push_timeline_row(username, LineRow(now, tweet_id, username, tweet))
+
+    writes = [gather(writes).then(saved)]
+
+    # Inserting the tweet into all of the followers' timelines can take a
+    # while, so it's usually left to a background worker
+    mode = settings.FANOUT_MODE
+    if mode == 'queue':
+        # The worker may read the tweet back, so it mustn't see it first
+        writes.append(added.then(
+            lambda rows: queue_fan_out_async(tweet_id, username, now)))
+    elif mode == 'inprocess':
+        queued = _set_fanout_status_async(
+            tweet_id, fanout.QUEUED, 0, 0, None)
+        writes.append(queued)
+        pool = get_fanout_pool()
+        args = (queued, tweet_id, username, now, tweet)
+        if not pool.submit(tweet_id, _fan_out_queued_tweet, args):
+            # The queue is full, do the work here rather than lose the tweet
+            delivered = _fan_out_queued_tweet(*args)
+            _set_fanout_status(tweet_id, fanout.DONE, 1, delivered, None)
+    else:
+        fan_out_tweet(tweet_id, username, now, tweet)
+
+    return gather(writes).then(lambda results: now)
+
+
+@_timed
 def save_tweet(tweet_id, username, tweet, timestamp=None):
     """
-    Saves the tweet record.
+    Saves a tweet, and has the public page read again now that it's there.
+    The writes are all made at once, but the Django cache is written to
+    here rather than from a callback, since it may be over the network.
     """
+    now = _save_tweet_async(tweet_id, username, tweet, timestamp).result()
+    cache.set(PUBLIC_PAGE_VERSION_KEY, str(now),
+              settings.PUBLIC_PAGE_CACHE_TTL)
 
-    global tweets_query
-    global userline_query
-    global timeline_query
 
-    # Prepare the statements required for adding the tweet into the various timelines
-    # Initialise only once, and then re-use by binding new values
-    if tweets_query is None:
-        tweets_query = session.prepare("""
-            INSERT INTO tweets (tweet_id, username, body)
-            VALUES (?, ?, ?)
-            """)
+@_timed
+def fan_out_tweet(tweet_id, username, now, body=None):
+    """
+    Inserts a tweet into the timelines of the user's followers, and returns
+    the number of timelines it was inserted into.  The body of the tweet is
+    looked up if it isn't given and the timelines are denormalized.
+    """
+    # Celebrities have too many followers to write to all of their
+    # timelines, their tweets get pulled in when the timelines are read
+    if is_celebrity(username):
+        return 0
 
-    if userline_query is None:
-        userline_query = session.prepare("""
-            INSERT INTO userline (username, time, tweet_id)
-            VALUES (?, ?, ?)
-            """)
+    # Get the user's followers, and insert the tweet into all of their
+    # streams.  They're read a page at a time, so there's no limit on how
+    # many there can be.
+    follower_usernames = iter_follower_usernames(username)
 
-    if timeline_query is None:
-        timeline_query = session.prepare("""
-            INSERT INTO timeline (username, time, tweet_id)
-            VALUES (?, ?, ?)
-            """)
+    threshold = settings.CELEBRITY_FOLLOWER_THRESHOLD
+    if threshold is not None:
+        first = list(itertools.islice(follower_usernames, threshold + 1))
+        if len(first) > threshold:
+            make_celebrity(username)
+            return 0
+        follower_usernames = itertools.chain(first, follower_usernames)
 
-    if timestamp is None:
-        now = uuid1()
+    if body is None and settings.DENORMALIZED_LINES:
+        body = get_tweet(tweet_id).body
+
+    row = LineRow(now, tweet_id, username, body)
+
+    def inserts():
+        for follower_username in follower_usernames:
+            _push_timeline_row(follower_username, row)
+            yield _line_insert(
+                'timeline', follower_username, now, tweet_id, username, body)
+
+    delivered = executor.execute_all(inserts())
+    fanout_size.observe(delivered, 'timeline_inserts')
+    return delivered
+
+
+def _fan_out_queued_tweet(queued, tweet_id, username, now, body=None):
+    """
+    Fans a tweet out like fan_out_tweet, once the promise of its QUEUED
+    status has been kept, so that the status can't land on top of the one
+    the fan-out ends up with.
+    """
+    try:
+        queued.result()
+    except Exception:
+        # save_tweet fails with this, but the tweet is still saved
+        log.exception('Could not record that fan-out %s is queued', tweet_id)
+    return fan_out_tweet(tweet_id, username, now, body)
+
+
+def get_fanout_pool():
+    """
+    Gets the pool of threads that fans tweets out in the background, starting
+    it if need be.  Calling join() on it waits for the fan-outs to finish.
+    """
+    global _fanout_pool
+    with _fanout_pool_lock:
+        if _fanout_pool is None:
+            _fanout_pool = make_fanout_pool()
+    return _fanout_pool
+
+
+def make_fanout_pool(num_workers=None):
+    """
+    Starts a new pool of fan-out threads that records the status of each
+    fan-out in the fanout_status table.
+    """
+    pool = fanout.FanoutPool(
+        num_workers or settings.FANOUT_WORKERS,
+        settings.FANOUT_QUEUE_SIZE,
+        settings.FANOUT_RETRIES,
+        status=_set_fanout_status)
+    pool.start()
+    return pool
+
+
+def get_follow_pool():
+    """
+    Gets the pool of threads that backfills and purges timelines in the
+    background, starting it if need be.  It's kept apart from the fan-out
+    pool so that a burst of follows can't hold up new tweets.
+    """
+    global _follow_pool
+    with _follow_pool_lock:
+        if _follow_pool is None:
+            _follow_pool = fanout.FanoutPool(
+                settings.FOLLOW_WORKERS, settings.FANOUT_QUEUE_SIZE,
+                settings.FANOUT_RETRIES)
+            _follow_pool.start()
+    return _follow_pool
+
+
+def _set_fanout_status_async(tweet_id, state, attempts, delivered, error):
+    """
+    Records how far the fan-out of a tweet has got, and returns a promise of
+    when that's done.
+    """
+    return executor.submit(statements['set_fanout_status'], (
+        tweet_id, state, attempts, delivered, error, datetime.utcnow(),
+        FANOUT_STATUS_TTL,))
+
+
+def _set_fanout_status(tweet_id, state, attempts, delivered, error):
+    _set_fanout_status_async(
+        tweet_id, state, attempts, delivered, error).result()
+
+
+@_timed
+def get_fanout_status(tweet_id):
+    """
+    Given a tweet id, this gets the status of inserting the tweet into its
+    author's followers' timelines.
+    """
+    rows = get_backend().execute(statements['get_fanout_status'], (tweet_id,))
+    if not rows:
+        raise NotFound('No fan-out status for tweet %s' % (tweet_id,))
     else:
-        now = _timestamp_to_uuid(timestamp)
+        return rows[0]
 
-    # Insert the tweet
-    session.execute(tweets_query, (tweet_id, username, tweet,))
-    # Insert tweet into the user's timeline
-    session.execute(userline_query, (username, now, tweet_id,))
-    # Insert tweet into the public timeline
-    session.execute(userline_query, (PUBLIC_USERLINE_KEY, now, tweet_id,))
 
-    # Get the user's followers, and insert the tweet into all of their streams
-    futures = []
-    follower_usernames = [username] + get_follower_usernames(username)
-    for follower_username in follower_usernames:
-        futures.append(session.execute_async(
-            timeline_query, (follower_username, now, tweet_id,)))
+def _fanout_queue_bucket(timestamp):
+    """
+    Gets the fan-out queue bucket that a Unix timestamp falls into.
+    """
+    return int(timestamp // settings.FANOUT_QUEUE_BUCKET)
+
 
-    for future in futures:
-        future.result()
+@_timed
+def queue_fan_out_async(tweet_id, username, now):
+    """
+    Queues up the fan-out of a tweet, to be done by a fanout_worker process,
+    and returns a promise of when it's queued.
+    """
+    shard = tweet_id.int % settings.FANOUT_QUEUE_SHARDS
 
+    def queue(rows):
+        # The time it's queued at, rather than the tweet's, so that it's only
+        # FANOUT_QUEUE_DELAY seconds at most before it's in the queue
+        queued = uuid1()
+        bucket = _fanout_queue_bucket(_timeuuid_to_unix(queued))
+        return executor.submit(statements['queue_fanout'], (
+            bucket, shard, queued, now, tweet_id, username,
+            FANOUT_QUEUE_TTL,))
 
-def add_friends(from_username, to_usernames):
+    # The status goes first, so a quick worker can't be overtaken
+    return _set_fanout_status_async(
+        tweet_id, fanout.QUEUED, 0, 0, None).then(queue)
+
+
+@_timed
+def queue_fan_out(tweet_id, username, now):
+    queue_fan_out_async(tweet_id, username, now).result()
+
+
+@_timed
+def get_queued_fan_outs(shard, cursor=None, limit=100):
+    """
+    Gets the fan-outs queued in a shard of the fan-out queue after a cursor,
+    oldest first, along with the cursor to get the ones after them with.
+    Given no cursor, this starts from the oldest bucket that hasn't expired.
+
+    Only the fan-outs queued more than FANOUT_QUEUE_DELAY seconds ago are
+    got, and a cursor doesn't move on to the next bucket until then either,
+    so that none that were still being written get skipped.
+    """
+    settled = time.time() - settings.FANOUT_QUEUE_DELAY
+    before = _timestamp_to_uuid(settled)
+    last_bucket = _fanout_queue_bucket(settled)
+    if cursor is None:
+        cursor = (_fanout_queue_bucket(settled - FANOUT_QUEUE_TTL), None)
+
+    backend = get_backend()
+    bucket, after = cursor
+    while True:
+        if after is None:
+            rows = backend.execute(
+                statements['get_queued_fanouts'],
+                (bucket, shard, before, limit))
+        else:
+            rows = backend.execute(
+                statements['get_newer_queued_fanouts'],
+                (bucket, shard, after, before, limit))
+        rows = list(rows)
+        if rows:
+            return rows, (bucket, rows[-1].queued)
+        if bucket >= last_bucket:
+            return rows, (bucket, after)
+        bucket, after = bucket + 1, None
+
+
+@_timed
+def get_fanout_checkpoint(shard):
+    """
+    Gets the cursor that a fanout_worker had done every fan-out in a shard
+    of the queue up to, or None if none has worked on it.
+    """
+    rows = get_backend().execute(
+        statements['get_fanout_checkpoint'], (shard,))
+    if not rows:
+        return None
+    return (rows[0].bucket, rows[0].queued)
+
+
+@_timed
+def set_fanout_checkpoint(shard, cursor):
+    """
+    Records that every fan-out in a shard of the queue up to a cursor that
+    get_queued_fan_outs() gave is done.
+    """
+    bucket, queued = cursor
+    get_backend().execute(
+        statements['set_fanout_checkpoint'], (shard, bucket, queued))
+
+
+@_timed
+def make_celebrity(username):
+    """
+    Stops fanning out the user's tweets to their followers.  Each follower is
+    recorded as following a celebrity instead, so that the user's tweets can
+    be merged into their timelines when they're read.
+    """
+    # Record the followers before the user, so that no follower misses out
+    # on tweets in between
+    executor.execute_all(
+        (statements['add_celebrity_friend'], (follower_username, username,))
+        for follower_username in iter_follower_usernames(username))
+
+    get_backend().execute(
+        statements['add_celebrity'], (username, datetime.utcnow(),))
+
+
+def _change_friendships(name, username, friend_usernames, *parameters):
     """
-    Adds a friendship relationship from one user to some others.
+    Runs the named lightweight transaction on the user's row in the friends
+    table for each of friend_usernames, and returns the ones that it was
+    applied to.
     """
-    global friends_query
-    global followers_query
+    friend_usernames = list(friend_usernames)
+    results = gather(
+        executor.submit(
+            statements[name], (username, friend) + parameters)
+        for friend in friend_usernames).result()
+    return [friend for friend, rows in zip(friend_usernames, results)
+            if rows[0].applied]
 
-    if friends_query is None:
-        friends_query = session.prepare("""
-            INSERT INTO friends (username, friend, since)
-            VALUES (?, ?, ?)
-            """)
 
-    if followers_query is None:
-        followers_query = session.prepare("""
-            INSERT INTO followers (username, follower, since)
-            VALUES (?, ?, ?)
-            """)
+@_timed
+def add_friends(from_username, to_usernames):
+    """
+    Adds a friendship relationship from one user to some others, and counts
+    the ones that are new in both users' UserStats.
 
+    Only the follows whose friends row was written are counted, so that
+    following someone again, even from two requests at once, doesn't count
+    them twice.  A counter update that times out may or may not have been
+    counted, which reconcile_stats puts right.
+    """
+    to_usernames = list(to_usernames)
     now = datetime.utcnow()
-    futures = []
+    new = _change_friendships(
+        'add_new_friend', from_username, to_usernames, now)
+
+    writes = []
     for to_user in to_usernames:
-        # Start following user
-        futures.append(session.execute_async(
-            friends_query, (from_username, to_user, now,)))
         # Add yourself as a follower of the user
-        futures.append(session.execute_async(
-            followers_query, (to_user, from_username, now,)))
+        writes.append(
+            (statements['add_follower'], (to_user, from_username, now,)))
+        # Celebrities' tweets are read from their userline
+        if is_celebrity(to_user):
+            writes.append(
+                (statements['add_celebrity_friend'], (from_username, to_user,)))
+    for to_user in new:
+        writes.append(_user_stats_update(to_user, followers=1))
+    if new:
+        writes.append(_user_stats_update(from_username, following=len(new)))
+
+    executor.execute_all(writes)
+    _run_follow_jobs(backfill_timeline, from_username, to_usernames)
+
+
+@_timed
+def remove_friends(from_username, to_usernames):
+    """
+    Removes a friendship relationship from one user to some others, and
+    takes the ones that were there off both users' UserStats, counting them
+    like add_friends does.
+    """
+    to_usernames = list(to_usernames)
+    removed = _change_friendships(
+        'remove_friend', from_username, to_usernames)
+
+    writes = []
+    for to_user in to_usernames:
+        writes.append(
+            (statements['remove_follower'], (to_user, from_username,)))
+        writes.append(
+            (statements['remove_celebrity_friend'], (from_username, to_user,)))
+    for to_user in removed:
+        writes.append(_user_stats_update(to_user, followers=-1))
+    if removed:
+        writes.append(
+            _user_stats_update(from_username, following=-len(removed)))
 
-    for future in futures:
-        future.result()
+    executor.execute_all(writes)
+    _run_follow_jobs(purge_timeline, from_username, to_usernames)
 
 
-def remove_friends(from_username, to_usernames):
+def _run_follow_jobs(func, username, friend_usernames):
     """
-    Removes a friendship relationship from one user to some others.
+    Runs func(username, friend_username) for each of the friends, in the
+    follow pool unless FANOUT_MODE is 'sync'.  Jobs that don't fit in the
+    pool's queue are skipped, rather than holding up the request.
     """
-    global remove_friends_query
-    global remove_followers_query
-
-    if remove_friends_query is None:
-        remove_friends_query = session.prepare("""
-            DELETE FROM friends WHERE username=? AND friend=?
-            """)
-    if remove_followers_query is None:
-        remove_followers_query = session.prepare("""
-            DELETE FROM followers WHERE username=? AND follower=?
-            """)
+    if not settings.FOLLOW_BACKFILL_SIZE:
+        return
+    if settings.FANOUT_MODE == 'sync':
+        for friend_username in friend_usernames:
+            func(username, friend_username)
+        return
+    pool = get_follow_pool()
+    for friend_username in friend_usernames:
+        job_id = '%s %s %s' % (func.__name__, username, friend_username)
+        if not pool.submit(job_id, func, (username, friend_username)):
+            log.warning('The follow queue is full, skipped %s', job_id)
+
+
+def _batched(writes, batch_size):
+    """
+    Groups (statement, parameters) pairs that all write to the same partition
+    into unlogged batches of up to batch_size statements.
+    """
+    backend = get_backend()
+    for i in range(0, len(writes), batch_size):
+        batch = backend.batch()
+        for statement, params in writes[i:i + batch_size]:
+            batch.add(statement, params)
+        yield batch, None
 
-    futures = []
-    for to_user in to_usernames:
-        futures.append(session.execute_async(
-            remove_friends_query, (from_username, to_user,)))
-        futures.append(session.execute_async(
-            remove_followers_query, (to_user, from_username,)))
 
-    for future in futures:
-        future.result()
+@_timed
+def backfill_timeline(username, friend_username, count=None):
+    """
+    Copies the newest count (by default FOLLOW_BACKFILL_SIZE) tweets of a
+    user into the timeline of someone who has started following them, and
+    returns the number copied.  Nothing is copied if they've stopped
+    following them since, or if the user is a celebrity, whose tweets are
+    merged into timelines when they're read.
+    """
+    count = count or settings.FOLLOW_BACKFILL_SIZE
+    backend = get_backend()
+    if not backend.execute(statements['get_friend'], (username, friend_username)):
+        return 0
+    if is_celebrity(friend_username):
+        return 0
+
+    rows = backend.execute(statements['get_userline'], (friend_username, count))
+    writes = [
+        _line_insert('timeline', username, row.time, row.tweet_id,
+                     friend_username, getattr(row, 'body', None))
+        for row in rows]
+    executor.execute_all(_batched(writes, settings.FOLLOW_BATCH_SIZE))
+    timeline_cache.delete(username)
+    fanout_size.observe(len(writes), 'backfill_inserts')
+    return len(writes)
+
+
+@_timed
+def purge_timeline(username, friend_username, count=None):
+    """
+    Deletes the newest count (by default FOLLOW_BACKFILL_SIZE) tweets of a
+    user from the timeline of someone who has stopped following them, and
+    returns the number of rows deleted.  Nothing is deleted if they've
+    started following them again since.
+    """
+    count = count or settings.FOLLOW_BACKFILL_SIZE
+    backend = get_backend()
+    if backend.execute(statements['get_friend'], (username, friend_username)):
+        return 0
+
+    rows = backend.execute(statements['get_userline'], (friend_username, count))
+    writes = [
+        (statements['remove_from_timeline'], (username, row.time))
+        for row in rows]
+    executor.execute_all(_batched(writes, settings.FOLLOW_BATCH_SIZE))
+    timeline_cache.delete(username)
+    fanout_size.observe(len(writes), 'purge_deletes')
+    return len(writes)
@@ -0,0 +1,114 @@
+"""
+A pool of background threads that does the slow part of posting a tweet:
+inserting it into the timeline of every follower.
+
+Jobs go through a bounded queue.  A job that raises is retried a few times
+with a growing delay before it is given up on, and every change of state is
+reported to a status callback, so that the progress of each tweet's fan-out
+can be looked up.  Recording that a job is queued is left to whatever
+submits it, which can do that along with its other writes.
+"""
+import logging
+import Queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RETRYING = 'retrying'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class FanoutPool(object):
+
+    def __init__(self, num_workers, queue_size, retries, retry_delay=0.5,
+                 status=None):
+        self.num_workers = num_workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.status = status
+        self.queue = Queue.Queue(queue_size)
+        self.threads = []
+
+    def start(self):
+        """
+        Starts the worker threads.
+        """
+        for i in range(self.num_workers):
+            thread = threading.Thread(
+                target=self._run, name='fanout-%d' % (i,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """
+        Waits for the queued jobs to finish and then stops the worker threads.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def join(self):
+        """
+        Blocks until every job submitted so far has finished.
+        """
+        self.queue.join()
+
+    def submit(self, job_id, func, args=(), on_done=None, block=False):
+        """
+        Queues up func(*args) to be run by a worker.  Returns False instead
+        of queueing the job if the queue is full and block is False.
+
+        func should return the number of rows it wrote, and on_done is called
+        with no arguments once the job has either succeeded or run out of
+        retries.  The QUEUED state isn't reported here, so that submitting a
+        job never waits on the status callback.
+        """
+        try:
+            self.queue.put((job_id, func, args, on_done), block)
+        except Queue.Full:
+            return False
+        return True
+
+    def _report(self, job_id, state, attempts, delivered=0, error=None):
+        if self.status is None:
+            return
+        try:
+            self.status(job_id, state, attempts, delivered, error)
+        except Exception:
+            log.exception('Could not record the status of fan-out %s', job_id)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self._attempt(*job)
+            finally:
+                self.queue.task_done()
+
+    def _attempt(self, job_id, func, args, on_done):
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                delivered = func(*args)
+            except Exception, e:
+                if attempts > self.retries:
+                    log.exception('Fan-out %s failed', job_id)
+                    self._report(job_id, FAILED, attempts, error=str(e))
+                    break
+                self._report(job_id, RETRYING, attempts, error=str(e))
+                time.sleep(self.retry_delay * attempts)
+            else:
+                self._report(job_id, DONE, attempts, delivered or 0)
+                break
+
+        if on_done is not None:
+            on_done()
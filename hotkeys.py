@@ -0,0 +1,105 @@
+"""
+An in-process copy of the values of the most used keys, reloaded every so
+often, for things that are too big to cache whole.
+
+Every get() counts as a use of its key.  Once refresh seconds have gone by,
+the next get() picks out the size keys that were used most since the last
+refresh, and calls load(key) for each of them.  load returns a Promise of
+the key's value, so nothing waits for the reload: the old values are served
+until the new ones are all there, and then replaced all at once.  The counts
+start again from nothing, so keys that stop being used drop out.
+"""
+import logging
+import threading
+import time
+
+from promises import gather
+
+log = logging.getLogger(__name__)
+
+
+class HotKeys(object):
+
+    def __init__(self, size, refresh, load):
+        self.size = size
+        self.refresh = refresh
+        self.load = load
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshes = 0
+        self._values = {}
+        self._counts = {}
+        self._refreshed = time.time()
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key, default=None):
+        """
+        Gets the value for a key, or default if it isn't one of the hot keys.
+        """
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+            if key in self._values:
+                self.hits += 1
+                value = self._values[key]
+            else:
+                self.misses += 1
+                value = default
+
+            counts = None
+            if (not self._refreshing and self.size > 0 and
+                    time.time() - self._refreshed >= self.refresh):
+                self._refreshing = True
+                counts, self._counts = self._counts, {}
+
+        if counts is not None:
+            self._reload(counts)
+        return value
+
+    def _reload(self, counts):
+        keys = sorted(counts, key=counts.get, reverse=True)[:self.size]
+
+        def loaded(values):
+            with self._lock:
+                self.evictions += len(set(self._values).difference(keys))
+                self._values = dict(zip(keys, values))
+                self._finish()
+
+        def failed(error):
+            # Keep serving the old values, and try again next time
+            log.warning('Could not reload the hot keys: %s', error)
+            with self._lock:
+                self._finish()
+
+        try:
+            promise = gather([self.load(key) for key in keys])
+        except Exception, e:
+            failed(e)
+            return
+        promise.add_callbacks(loaded, failed)
+
+    def _finish(self):
+        # Called with the lock held
+        self._refreshed = time.time()
+        self._refreshing = False
+        self.refreshes += 1
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._counts.clear()
+
+    def stats(self):
+        """
+        Gets the number of hot keys and their hit, miss and eviction counts.
+        """
+        return {
+            'size': len(self._values),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
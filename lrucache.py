@@ -0,0 +1,121 @@
+"""
+A size bounded, thread safe, in-process cache.
+
+Entries are evicted least recently used first once the cache is full, and
+can optionally expire a fixed number of seconds after they were set.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key, now):
+        """
+        Gets the entry for a key, marking it as the most recently used.
+        Must be called with the lock held.
+        """
+        value, expires = self._entries.pop(key)
+        if expires is not None and expires <= now:
+            raise KeyError(key)
+        self._entries[key] = (value, expires)
+        return value
+
+    def get(self, key, default=None):
+        """
+        Gets the value for a key, or default if it isn't in the cache.
+        """
+        with self._lock:
+            try:
+                value = self._lookup(key, time.time())
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def get_many(self, keys):
+        """
+        Gets a dictionary of the values for those keys that are in the cache.
+        """
+        found = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                if key in found:
+                    continue
+                try:
+                    found[key] = self._lookup(key, now)
+                except KeyError:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+        return found
+
+    def set(self, key, value):
+        """
+        Adds a value to the cache, evicting the least recently used entry if
+        the cache is full.
+        """
+        if self.max_size <= 0:
+            return
+        expires = None
+        if self.ttl:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, key, func):
+        """
+        Replaces the value for a key with func(value), if the key is in the
+        cache.  This doesn't count as a use of the entry, so it doesn't keep
+        the entry from being evicted, and doesn't change when it expires.
+        func is called with the lock held, so it should be quick.
+        """
+        with self._lock:
+            try:
+                value, expires = self._entries[key]
+            except KeyError:
+                return
+            if expires is not None and expires <= time.time():
+                return
+            self._entries[key] = (func(value), expires)
+
+    def delete(self, key):
+        """
+        Removes a key from the cache, if it's there.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Gets the size of the cache and its hit, miss and eviction counts.
+        """
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,1076 @@
+"""
+An in-process stand-in for a Cassandra session.
+
+It understands the subset of CQL that cass.py and the management commands
+use, and keeps every table in memory with each partition sorted by its
+clustering columns, so the data layer can be exercised without a cluster.
+backends.MemoryBackend wraps it for cass.py.  Nothing is persisted, and
+there is no replication or consistency to speak of: it's for development and
+benchmarks, not for keeping data in.
+
+Each request can be made to take a while, like a round trip to a cluster
+would: a fixed latency plus an exponentially distributed jitter, which gives
+the long tail of slow requests that real clusters have.  Asynchronous
+requests are completed by a background thread once their time is up, so
+requests that are in flight together overlap.
+
+Execution profiles with a speculative execution policy are honoured for
+idempotent statements, like the driver does: if a request hasn't finished
+when the policy says, it's sent again, and whichever copy finishes first
+is the result.  There's only one "host", but each copy gets its own
+latency, so this shows what speculation does for the tail.
+"""
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple
+import hashlib
+import heapq
+import itertools
+import logging
+import random
+import re
+import struct
+import threading
+import time
+from uuid import UUID
+
+import cassandra
+
+log = logging.getLogger(__name__)
+
+class InvalidRequest(cassandra.InvalidRequest):
+    pass
+
+
+class _Max(object):
+    """
+    Sorts after everything, for bisecting past every key with a given prefix.
+    """
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return other is not self
+
+    def __eq__(self, other):
+        return other is self
+
+    def __ne__(self, other):
+        return other is not self
+
+_MAX = _Max()
+
+
+class _Desc(object):
+    """
+    Inverts the ordering of a value, for DESC clustering columns.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        if isinstance(other, _Desc):
+            return other.value < self.value
+        return other is _MAX
+
+    def __gt__(self, other):
+        if isinstance(other, _Desc):
+            return self.value < other.value
+        return False
+
+    def __eq__(self, other):
+        return isinstance(other, _Desc) and self.value == other.value
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __le__(self, other):
+        return self.__lt__(other) or self.__eq__(other)
+
+    def __ge__(self, other):
+        return self.__gt__(other) or self.__eq__(other)
+
+
+def _sort_key(value):
+    """
+    The key a clustering value sorts by.  TimeUUIDs sort by their timestamp
+    first, like Cassandra's TimeUUIDType.
+    """
+    if isinstance(value, UUID):
+        if value.version == 1:
+            return (value.time, value.bytes)
+        return (0, value.bytes)
+    return value
+
+
+def token(values):
+    """
+    The token of a partition key, standing in for the Murmur3 partitioner.
+    """
+    digest = hashlib.md5(repr(tuple(values)).encode('utf-8')).digest()
+    return struct.unpack('>q', digest[:8])[0]
+
+
+class ResultSet(list):
+    """
+    The rows of one page of a query result.
+    """
+    paging_state = None
+
+    @property
+    def current_rows(self):
+        return self
+
+    @property
+    def has_more_pages(self):
+        return self.paging_state is not None
+
+
+class Future(object):
+    """
+    The result of an execute_async() call, shaped like the driver's
+    ResponseFuture.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        # Names for each copy of the request that was sent, and for the one
+        # that answered, like the driver's hosts
+        self.attempted_hosts = []
+        self.coordinator_host = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def _set(self, result=None, error=None, host=None):
+        with self._lock:
+            # A speculative copy of the request has already answered
+            if self._event.is_set():
+                return
+            self.coordinator_host = host
+            self._result = result
+            self._error = error
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback, errback in callbacks:
+            self._fire(callback, errback)
+
+    def _fire(self, callback, errback):
+        # A callback that raises mustn't stop the others, or kill the
+        # scheduler thread, so it's logged like the driver logs it
+        try:
+            if self._error is not None:
+                if errback is not None:
+                    errback(self._error)
+            elif callback is not None:
+                callback(self._result)
+        except Exception:
+            log.exception('Callback for a request failed')
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise cassandra.OperationTimedOut(
+                'No response after %s seconds' % (timeout,))
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def add_callbacks(self, callback, errback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append((callback, errback))
+                return
+        self._fire(callback, errback)
+
+    def add_callback(self, callback):
+        self.add_callbacks(callback, None)
+
+    def add_errback(self, errback):
+        self.add_callbacks(None, errback)
+
+
+class PreparedStatement(object):
+
+    consistency_level = None
+    is_idempotent = False
+
+    def __init__(self, query_string, parsed):
+        self.query_string = query_string
+        self.parsed = parsed
+
+    def bind(self, values):
+        return BoundStatement(self, values)
+
+
+class BoundStatement(object):
+
+    fetch_size = None
+
+    def __init__(self, prepared_statement, values):
+        self.prepared_statement = prepared_statement
+        self.values = values
+        self.consistency_level = prepared_statement.consistency_level
+        self.is_idempotent = prepared_statement.is_idempotent
+
+
+class BatchStatement(object):
+    """
+    Statements that are applied together, with nothing else in between.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    def add(self, statement, parameters=None):
+        self.statements.append((statement, parameters))
+
+    def __len__(self):
+        return len(self.statements)
+
+
+class _Scheduler(object):
+    """
+    Runs functions on a background thread once their delay is up.
+    """
+
+    # Condition.wait() with a timeout polls every 50ms or so in Python 2,
+    # which is far too coarse, so the thread sleeps in short steps instead
+    # while anything is waiting
+    step = 0.0005
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def schedule(self, delay, func):
+        with self._condition:
+            heapq.heappush(
+                self._heap, (time.time() + delay, next(self._counter), func))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='memcass-scheduler')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                due, _, func = self._heap[0]
+                wait = due - time.time()
+                if wait <= 0:
+                    heapq.heappop(self._heap)
+            if wait > 0:
+                time.sleep(min(wait, self.step))
+                continue
+            try:
+                func()
+            except Exception:
+                log.exception('Scheduled function failed')
+
+    def stop(self):
+        """
+        Stops the background thread and waits for it to exit, so that it
+        isn't killed half way through something when the interpreter exits.
+        Anything still scheduled is run if schedule() starts it again.
+        """
+        with self._condition:
+            thread = self._thread
+            if thread is None:
+                return
+            self._stopping = True
+            self._condition.notify()
+        thread.join()
+        with self._condition:
+            self._stopping = False
+            self._thread = None
+
+
+# Parsing ----------------------------------------------------------------
+
+_TOKENS = re.compile(r"""\s*(?:
+      (?P<param>\?|%s)
+    | (?P<string>'(?:[^']|'')*')
+    | (?P<number>-?\d+(?:\.\d+)?)
+    | (?P<name>[A-Za-z_][\w.]*)
+    | (?P<symbol><=|>=|!=|[(),=<>+\-*;{}:])
+    )""", re.VERBOSE)
+
+
+class _Parser(object):
+
+    def __init__(self, query):
+        self.tokens = []
+        position = 0
+        query = query.strip()
+        while position < len(query):
+            match = _TOKENS.match(query, position)
+            if match is None or match.end() == position:
+                if query[position:].strip() == '':
+                    break
+                raise InvalidRequest('Cannot parse %r' % (query[position:],))
+            kind = match.lastgroup
+            self.tokens.append((kind, match.group(kind)))
+            position = match.end()
+        self.position = 0
+        self.num_params = 0
+
+    def peek(self, offset=0):
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def keyword(self, *words):
+        kind, value = self.peek()
+        if kind == 'name' and value.upper() in words:
+            self.position += 1
+            return value.upper()
+        return None
+
+    def expect(self, value):
+        kind, got = self.next()
+        if got is None or got.upper() != value.upper():
+            raise InvalidRequest('Expected %s, got %s' % (value, got))
+
+    def name(self):
+        kind, value = self.next()
+        if kind != 'name':
+            raise InvalidRequest('Expected a name, got %s' % (value,))
+        return value.split('.')[-1].lower()
+
+    def term(self):
+        kind, value = self.next()
+        if kind == 'param':
+            index = self.num_params
+            self.num_params += 1
+            return ('param', index)
+        if kind == 'string':
+            return ('literal', value[1:-1].replace("''", "'"))
+        if kind == 'number':
+            if '.' in value:
+                return ('literal', float(value))
+            return ('literal', int(value))
+        if kind == 'name' and value.lower() in ('true', 'false'):
+            return ('literal', value.lower() == 'true')
+        if kind == 'name' and value.lower() == 'null':
+            return ('literal', None)
+        if value == '(':
+            terms = []
+            while self.peek()[1] != ')':
+                terms.append(self.term())
+                if self.peek()[1] == ',':
+                    self.next()
+            self.next()
+            return ('list', terms)
+        if value == '{':
+            # Map literals only show up in CREATE KEYSPACE, which is ignored
+            depth = 1
+            while depth:
+                value = self.next()[1]
+                depth += {'{': 1, '}': -1}.get(value, 0)
+            return ('literal', None)
+        raise InvalidRequest('Unexpected %s' % (value,))
+
+    def where(self):
+        conditions = []
+        if not self.keyword('WHERE'):
+            return conditions
+        while True:
+            if self.keyword('TOKEN'):
+                self.expect('(')
+                columns = []
+                while self.peek()[1] != ')':
+                    columns.append(self.name())
+                    if self.peek()[1] == ',':
+                        self.next()
+                self.next()
+                column = ('token', tuple(columns))
+            else:
+                column = self.name()
+            kind, op = self.next()
+            if kind == 'name' and op.upper() == 'IN':
+                op = 'IN'
+            conditions.append((column, op, self.term()))
+            if not self.keyword('AND'):
+                return conditions
+
+    def using(self):
+        ttl = None
+        if self.keyword('USING'):
+            while True:
+                if self.keyword('TTL'):
+                    ttl = self.term()
+                elif self.keyword('TIMESTAMP'):
+                    self.term()
+                if not self.keyword('AND'):
+                    break
+        return ttl
+
+    def parse(self):
+        verb = self.keyword('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'CREATE',
+                            'DROP', 'ALTER', 'TRUNCATE', 'USE')
+        if verb is None:
+            raise InvalidRequest('Unsupported statement')
+        statement = getattr(self, 'parse_' + verb.lower())()
+        statement['num_params'] = self.num_params
+        return statement
+
+    def parse_select(self):
+        distinct = bool(self.keyword('DISTINCT'))
+        columns = []
+        while not self.keyword('FROM'):
+            kind, value = self.next()
+            if value == ',':
+                continue
+            if kind == 'name' and value.upper() == 'COUNT':
+                self.expect('(')
+                self.next()
+                self.expect(')')
+                columns.append('count')
+            elif kind == 'name' and value.upper() == 'TTL':
+                self.expect('(')
+                columns.append(('ttl', self.name()))
+                self.expect(')')
+            elif value == '*':
+                columns = '*'
+            else:
+                columns.append(value.lower())
+        table = self.name()
+        where = self.where()
+        limit = None
+        if self.keyword('LIMIT'):
+            limit = self.term()
+        self.keyword('ALLOW')
+        self.keyword('FILTERING')
+        return {'verb': 'select', 'table': table, 'columns': columns,
+                'distinct': distinct, 'where': where, 'limit': limit}
+
+    def parse_insert(self):
+        self.expect('INTO')
+        table = self.name()
+        self.expect('(')
+        columns = []
+        while True:
+            columns.append(self.name())
+            if self.next()[1] == ')':
+                break
+        self.expect('VALUES')
+        values = self.term()[1]
+        if_not_exists = False
+        if self.keyword('IF'):
+            self.expect('NOT')
+            self.expect('EXISTS')
+            if_not_exists = True
+        ttl = self.using()
+        return {'verb': 'insert', 'table': table, 'columns': columns,
+                'values': values, 'ttl': ttl, 'if_not_exists': if_not_exists}
+
+    def parse_update(self):
+        table = self.name()
+        ttl = self.using()
+        self.expect('SET')
+        assignments = []
+        while True:
+            column = self.name()
+            self.expect('=')
+            if self.peek()[0] == 'name' and self.peek()[1].lower() == column:
+                self.next()
+                sign = self.next()[1]
+                assignments.append((column, sign, self.term()))
+            else:
+                assignments.append((column, '=', self.term()))
+            if self.peek()[1] != ',':
+                break
+            self.next()
+        where = self.where()
+        return {'verb': 'update', 'table': table, 'ttl': ttl,
+                'assignments': assignments, 'where': where}
+
+    def parse_delete(self):
+        columns = []
+        while not self.keyword('FROM'):
+            kind, value = self.next()
+            if kind == 'name':
+                columns.append(value.lower())
+        table = self.name()
+        where = self.where()
+        if_exists = False
+        if self.keyword('IF'):
+            self.expect('EXISTS')
+            if_exists = True
+        return {'verb': 'delete', 'table': table, 'columns': columns,
+                'where': where, 'if_exists': if_exists}
+
+    def parse_create(self):
+        if self.keyword('KEYSPACE'):
+            while self.next()[0] is not None:
+                pass
+            return {'verb': 'noop'}
+        self.expect('TABLE')
+        if self.keyword('IF'):
+            self.expect('NOT')
+            self.expect('EXISTS')
+        table = self.name()
+        self.expect('(')
+        columns = []
+        primary_key = None
+        while True:
+            if self.keyword('PRIMARY'):
+                self.expect('KEY')
+                primary_key = self._primary_key()
+            else:
+                column = self.name()
+                self.name()
+                columns.append(column)
+                if self.keyword('PRIMARY'):
+                    self.expect('KEY')
+                    primary_key = ([column], [])
+            if self.next()[1] == ')':
+                break
+        descending = set()
+        if self.keyword('WITH'):
+            while self.peek()[0] is not None:
+                if self.keyword('CLUSTERING'):
+                    self.expect('ORDER')
+                    self.expect('BY')
+                    self.expect('(')
+                    while True:
+                        column = self.name()
+                        if self.keyword('DESC'):
+                            descending.add(column)
+                        else:
+                            self.keyword('ASC')
+                        if self.next()[1] == ')':
+                            break
+                else:
+                    self.next()
+        return {'verb': 'create', 'table': table, 'columns': columns,
+                'partition_key': primary_key[0], 'clustering': primary_key[1],
+                'descending': descending}
+
+    def _primary_key(self):
+        self.expect('(')
+        if self.peek()[1] == '(':
+            self.next()
+            partition_key = []
+            while True:
+                partition_key.append(self.name())
+                if self.next()[1] == ')':
+                    break
+        else:
+            partition_key = [self.name()]
+        clustering = []
+        while self.next()[1] != ')':
+            clustering.append(self.name())
+        return (partition_key, clustering)
+
+    def parse_alter(self):
+        self.expect('TABLE')
+        table = self.name()
+        self.expect('ADD')
+        column = self.name()
+        self.name()
+        return {'verb': 'alter', 'table': table, 'column': column}
+
+    def parse_drop(self):
+        kind = self.keyword('KEYSPACE', 'TABLE')
+        if self.keyword('IF'):
+            self.expect('EXISTS')
+        name = self.name()
+        return {'verb': 'drop', 'kind': kind, 'name': name}
+
+    def parse_truncate(self):
+        self.keyword('TABLE')
+        return {'verb': 'truncate', 'table': self.name()}
+
+    def parse_use(self):
+        return {'verb': 'noop', 'keyspace': self.name()}
+
+
+def parse(query):
+    return _Parser(query).parse()
+
+
+# Storage ----------------------------------------------------------------
+
+class Table(object):
+
+    def __init__(self, name, columns, partition_key, clustering, descending):
+        self.name = name
+        self.columns = list(columns)
+        self.partition_key = list(partition_key)
+        self.clustering = list(clustering)
+        self.descending = set(descending)
+        # partition key tuple -> [sorted clustering keys, {clustering key: row}]
+        self.partitions = {}
+        self.row_types = {}
+
+    def star_columns(self):
+        keys = self.partition_key + self.clustering
+        return keys + sorted(c for c in self.columns if c not in keys)
+
+    def clustering_key(self, row):
+        key = []
+        for column in self.clustering:
+            value = _sort_key(row[column])
+            if column in self.descending:
+                value = _Desc(value)
+            key.append(value)
+        return tuple(key)
+
+    def row_type(self, columns):
+        columns = tuple(columns)
+        if columns not in self.row_types:
+            self.row_types[columns] = namedtuple('Row', columns)
+        return self.row_types[columns]
+
+
+def _live(row, now):
+    expires = row.get('__expires')
+    return expires is None or expires > now
+
+
+def _ttl(row, column, now):
+    # Whole rows expire here rather than single cells, so every column that
+    # has a value has the row's TTL
+    expires = row.get('__expires')
+    if expires is None or row.get(column) is None:
+        return None
+    return max(int(expires - now), 1)
+
+
+class MemorySession(object):
+    """
+    Implements the parts of cassandra.cluster.Session that the data layer
+    uses: prepare(), execute() and execute_async().
+
+    Every request takes latency seconds, plus a random jitter averaging
+    jitter seconds.
+    """
+
+    def __init__(self, schema=(), latency=0, jitter=0):
+        self.tables = {}
+        self.keyspace = None
+        self.default_fetch_size = 5000
+        self.latency = latency
+        self.jitter = jitter
+        self._parsed = {}
+        self._lock = threading.RLock()
+        # Its own generator, so that seeding the global one is unaffected
+        self._random = random.Random()
+        self._scheduler = _Scheduler()
+        # Like the driver's Cluster.profile_manager.profiles
+        self.execution_profiles = {}
+        for statement in schema:
+            self._execute(statement)
+
+    def set_keyspace(self, keyspace):
+        self.keyspace = keyspace
+
+    def shutdown(self):
+        self._scheduler.stop()
+
+    def prepare(self, query):
+        return PreparedStatement(query, self._parse(query))
+
+    def _parse(self, query):
+        parsed = self._parsed.get(query)
+        if parsed is None:
+            parsed = self._parsed[query] = parse(query)
+        return parsed
+
+    def delay(self):
+        """
+        How long the next request should take.
+        """
+        delay = self.latency
+        if self.jitter:
+            delay += self._random.expovariate(1.0 / self.jitter)
+        return delay
+
+    def _speculative_plan(self, query, execution_profile):
+        """
+        Gets the speculative execution plan for a query, or None if it's
+        only to be sent once.
+        """
+        profile = self.execution_profiles.get(execution_profile)
+        policy = getattr(profile, 'speculative_execution_policy', None)
+        if policy is None or not getattr(query, 'is_idempotent', False):
+            return None
+        return policy.new_plan(self.keyspace, query)
+
+    def execute(self, query, parameters=None, timeout=None, paging_state=None,
+                fetch_size=None, host=None, execution_profile=None):
+        if self._speculative_plan(query, execution_profile) is not None:
+            return self.execute_async(
+                query, parameters, timeout, paging_state, fetch_size, host,
+                execution_profile).result()
+        delay = self.delay()
+        if delay:
+            time.sleep(delay)
+        return self._execute(query, parameters, paging_state, fetch_size)
+
+    def execute_async(self, query, parameters=None, timeout=None,
+                      paging_state=None, fetch_size=None, host=None,
+                      execution_profile=None):
+        future = Future()
+        plan = self._speculative_plan(query, execution_profile)
+
+        def run(host):
+            if future.done():
+                return
+            try:
+                result = self._execute(
+                    query, parameters, paging_state, fetch_size)
+            except Exception, error:
+                future._set(error=error, host=host)
+            else:
+                future._set(result=result, host=host)
+
+        def send():
+            host = 'memory-%d' % (len(future.attempted_hosts) + 1,)
+            future.attempted_hosts.append(host)
+            delay = self.delay()
+            if delay:
+                self._scheduler.schedule(delay, lambda: run(host))
+            else:
+                run(host)
+
+            # Send another copy if this one is still going when it's due
+            if plan is not None and not future.done():
+                delay = plan.next_execution(host)
+                if delay >= 0:
+                    self._scheduler.schedule(delay, speculate)
+
+        def speculate():
+            if not future.done():
+                send()
+
+        send()
+        return future
+
+    def _execute(self, query, parameters=None, paging_state=None,
+                 fetch_size=None):
+        if isinstance(query, BatchStatement):
+            with self._lock:
+                for statement, statement_parameters in query.statements:
+                    self._execute(statement, statement_parameters)
+            return ResultSet()
+        if isinstance(query, BoundStatement):
+            parsed = query.prepared_statement.parsed
+            parameters = query.values
+            fetch_size = fetch_size or query.fetch_size
+        elif isinstance(query, PreparedStatement):
+            parsed = query.parsed
+        else:
+            parsed = self._parse(getattr(query, 'query_string', query))
+            fetch_size = fetch_size or getattr(query, 'fetch_size', None)
+        parameters = list(parameters or ())
+        if len(parameters) != parsed['num_params']:
+            raise InvalidRequest('Expected %d parameters, got %d' % (
+                parsed['num_params'], len(parameters)))
+        with self._lock:
+            return getattr(self, '_' + parsed['verb'])(
+                parsed, parameters, paging_state, fetch_size)
+
+    # Statement execution ------------------------------------------------
+
+    def _table(self, name):
+        try:
+            return self.tables[name]
+        except KeyError:
+            raise InvalidRequest('unconfigured table %s' % (name,))
+
+    def _value(self, term, parameters):
+        kind, value = term
+        if kind == 'param':
+            return parameters[value]
+        if kind == 'list':
+            return [self._value(t, parameters) for t in value]
+        return value
+
+    def _bind_where(self, where, parameters):
+        return [(column, op, self._value(term, parameters))
+                for column, op, term in where]
+
+    def _noop(self, parsed, parameters, paging_state, fetch_size):
+        if parsed.get('keyspace'):
+            self.keyspace = parsed['keyspace']
+        return ResultSet()
+
+    def _create(self, parsed, parameters, paging_state, fetch_size):
+        if parsed['table'] not in self.tables:
+            self.tables[parsed['table']] = Table(
+                parsed['table'], parsed['columns'], parsed['partition_key'],
+                parsed['clustering'], parsed['descending'])
+        return ResultSet()
+
+    def _alter(self, parsed, parameters, paging_state, fetch_size):
+        table = self._table(parsed['table'])
+        if parsed['column'] not in table.columns:
+            table.columns.append(parsed['column'])
+            table.row_types = {}
+        return ResultSet()
+
+    def _drop(self, parsed, parameters, paging_state, fetch_size):
+        if parsed['kind'] == 'KEYSPACE':
+            self.tables = {}
+        else:
+            self.tables.pop(parsed['name'], None)
+        return ResultSet()
+
+    def _truncate(self, parsed, parameters, paging_state, fetch_size):
+        self._table(parsed['table']).partitions = {}
+        return ResultSet()
+
+    def _partition_keys(self, table, conditions):
+        """
+        The partition keys a query restricts itself to, or None if it scans
+        every partition.
+        """
+        values = {}
+        for column, op, value in conditions:
+            if column in table.partition_key:
+                if op == '=':
+                    values[column] = [value]
+                elif op == 'IN':
+                    values[column] = list(value)
+        if len(values) != len(table.partition_key):
+            return None
+        keys = [()]
+        for column in table.partition_key:
+            keys = [key + (value,) for key in keys for value in values[column]]
+        return keys
+
+    def _clustering_range(self, table, keys, conditions):
+        """
+        Bisects the sorted clustering keys of a partition down to the slice
+        that the restrictions on the first clustering column allow.
+        """
+        low, high = 0, len(keys)
+        if not table.clustering:
+            return low, high
+        first = table.clustering[0]
+        descending = first in table.descending
+        for column, op, value in conditions:
+            if column != first or op not in ('=', '<', '<=', '>', '>='):
+                continue
+            value = _sort_key(value)
+            if descending:
+                value = _Desc(value)
+                op = {'<': '>', '<=': '>=', '>': '<', '>=': '<='}.get(op, op)
+            before = bisect_left(keys, (value,))
+            after = bisect_right(keys, (value, _MAX))
+            if op == '=':
+                low, high = max(low, before), min(high, after)
+            elif op == '<':
+                high = min(high, before)
+            elif op == '<=':
+                high = min(high, after)
+            elif op == '>':
+                low = max(low, after)
+            elif op == '>=':
+                low = max(low, before)
+        return low, high
+
+    def _matches(self, table, partition_key, row, conditions):
+        for column, op, value in conditions:
+            if isinstance(column, tuple):
+                actual = token(partition_key)
+            else:
+                actual = row.get(column)
+            if op == 'IN':
+                if actual not in value:
+                    return False
+                continue
+            if op == '=':
+                if actual != value:
+                    return False
+                continue
+            actual, value = _sort_key(actual), _sort_key(value)
+            if actual is None:
+                return False
+            if op == '<' and not actual < value:
+                return False
+            if op == '<=' and not actual <= value:
+                return False
+            if op == '>' and not actual > value:
+                return False
+            if op == '>=' and not actual >= value:
+                return False
+            if op == '!=' and actual == value:
+                return False
+        return True
+
+    def _scan(self, table, conditions):
+        """
+        Yields (partition key, row) for every live row a query matches, in
+        token order and then clustering order.
+        """
+        now = time.time()
+        keys = self._partition_keys(table, conditions)
+        if keys is None:
+            keys = sorted(table.partitions, key=token)
+        for partition_key in keys:
+            partition = table.partitions.get(partition_key)
+            if partition is None:
+                continue
+            clustering_keys, rows = partition
+            low, high = self._clustering_range(table, clustering_keys, conditions)
+            for index in xrange(low, high):
+                row = rows[clustering_keys[index]]
+                if _live(row, now) and self._matches(
+                        table, partition_key, row, conditions):
+                    yield partition_key, row
+
+    def _select(self, parsed, parameters, paging_state, fetch_size):
+        table = self._table(parsed['table'])
+        conditions = self._bind_where(parsed['where'], parameters)
+        limit = None
+        if parsed['limit'] is not None:
+            limit = self._value(parsed['limit'], parameters)
+
+        columns = parsed['columns']
+        if columns == '*':
+            columns = table.star_columns()
+
+        if columns == ['count']:
+            count = sum(1 for _ in self._scan(table, conditions))
+            result = ResultSet([table.row_type(['count'])(count)])
+            return result
+
+        # TTL(column) comes back as ttl_column, like the driver names it
+        row_type = table.row_type(
+            'ttl_' + c[1] if isinstance(c, tuple) else c for c in columns)
+        now = time.time()
+        offset = int(paging_state or 0)
+        fetch_size = fetch_size or self.default_fetch_size
+        result = ResultSet()
+        seen = set()
+        position = 0
+        for partition_key, row in self._scan(table, conditions):
+            if parsed['distinct']:
+                if partition_key in seen:
+                    continue
+                seen.add(partition_key)
+            if limit is not None and position >= limit:
+                break
+            position += 1
+            if position <= offset:
+                continue
+            if len(result) == fetch_size:
+                result.paging_state = str(offset + fetch_size)
+                break
+            result.append(row_type(*[
+                _ttl(row, c[1], now) if isinstance(c, tuple) else row.get(c)
+                for c in columns]))
+        return result
+
+    def _write(self, table, key, values, ttl, counters=()):
+        partition_key = tuple(key[c] for c in table.partition_key)
+        partition = table.partitions.setdefault(partition_key, [[], {}])
+        clustering_keys, rows = partition
+        clustering_key = table.clustering_key(key)
+        row = rows.get(clustering_key)
+        if row is None or not _live(row, time.time()):
+            if row is None:
+                insort(clustering_keys, clustering_key)
+            row = rows[clustering_key] = dict(key)
+        for column, value in values.items():
+            if column not in table.columns:
+                raise InvalidRequest('Undefined column name %s' % (column,))
+            row[column] = value
+        for column, delta in counters:
+            row[column] = (row.get(column) or 0) + delta
+        if ttl:
+            row['__expires'] = time.time() + ttl
+        else:
+            row.pop('__expires', None)
+
+    def _insert(self, parsed, parameters, paging_state, fetch_size):
+        table = self._table(parsed['table'])
+        values = dict(zip(
+            parsed['columns'],
+            [self._value(term, parameters) for term in parsed['values']]))
+        ttl = None
+        if parsed['ttl'] is not None:
+            ttl = self._value(parsed['ttl'], parameters)
+        key_columns = table.partition_key + table.clustering
+        key = dict((c, values.pop(c)) for c in key_columns)
+        if parsed['if_not_exists']:
+            existing = list(self._scan(
+                table, [(c, '=', key[c]) for c in key_columns]))
+            if existing:
+                applied = table.row_type(['applied'])(False)
+                return ResultSet([applied])
+        self._write(table, key, values, ttl)
+        if parsed['if_not_exists']:
+            return ResultSet([table.row_type(['applied'])(True)])
+        return ResultSet()
+
+    def _update(self, parsed, parameters, paging_state, fetch_size):
+        table = self._table(parsed['table'])
+        conditions = self._bind_where(parsed['where'], parameters)
+        ttl = None
+        if parsed['ttl'] is not None:
+            ttl = self._value(parsed['ttl'], parameters)
+        values = {}
+        counters = []
+        for column, sign, term in parsed['assignments']:
+            value = self._value(term, parameters)
+            if sign == '=':
+                values[column] = value
+            elif sign == '+':
+                counters.append((column, value))
+            else:
+                counters.append((column, -value))
+        keys = self._partition_keys(table, conditions)
+        for partition_key in keys or ():
+            key = dict(zip(table.partition_key, partition_key))
+            for column, op, value in conditions:
+                if column in table.clustering:
+                    key[column] = value
+            self._write(table, key, values, ttl, counters)
+        return ResultSet()
+
+    def _delete(self, parsed, parameters, paging_state, fetch_size):
+        table = self._table(parsed['table'])
+        conditions = self._bind_where(parsed['where'], parameters)
+        doomed = list(self._scan(table, conditions))
+        if parsed['if_exists'] and not doomed:
+            return ResultSet([table.row_type(['applied'])(False)])
+        for partition_key, row in doomed:
+            clustering_keys, rows = table.partitions[partition_key]
+            if parsed['columns']:
+                for column in parsed['columns']:
+                    row[column] = None
+                continue
+            clustering_key = table.clustering_key(row)
+            del rows[clustering_key]
+            del clustering_keys[bisect_left(clustering_keys, clustering_key)]
+            if not rows:
+                del table.partitions[partition_key]
+        if parsed['if_exists']:
+            return ResultSet([table.row_type(['applied'])(True)])
+        return ResultSet()
+
@@ -0,0 +1,275 @@
+"""
+Counters and histograms kept in memory, and served in the Prometheus text
+format by metrics_view at /metrics.
+
+Every process keeps its own numbers, so each web and worker process has to
+be scraped on its own.  MetricsMiddleware times every view.
+"""
+import functools
+import inspect
+import threading
+import time
+
+from django.http import HttpResponse
+
+# Bucket bounds for durations, in seconds
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1, 2.5, 5, 10)
+
+# Bucket bounds for counts of things, like the rows written by a fan-out
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                10000, 20000, 50000)
+
+_metrics = []
+_metrics_lock = threading.Lock()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        escaped.append('%s="%s"' % (name, value.replace('\n', '\\n')))
+    return '{%s}' % (','.join(escaped),)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    """
+    A count that only goes up, kept separately for each combination of
+    label values.
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values):
+        self.add(1, *label_values)
+
+    def add(self, amount, *label_values):
+        with self._lock:
+            self._values[label_values] = (
+                self._values.get(label_values, 0) + amount)
+
+    def get(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Histogram(object):
+    """
+    Counts of observed values by the bucket they fall into, along with
+    their sum, kept separately for each combination of label values.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # label values -> [count in each bucket, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = (
+                    [0] * len(self.buckets) + [0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def count(self, *label_values):
+        counts = self._values.get(label_values)
+        return counts[-1] if counts else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        for label_values, counts in values:
+            # Prometheus buckets are cumulative
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(
+                    self.labels, label_values, [('le', _format_value(bound))])
+                yield self.name + '_bucket', labels, cumulative
+            labels = _format_labels(self.labels, label_values)
+            yield self.name + '_sum', labels, counts[-2]
+            yield self.name + '_count', labels, counts[-1]
+
+
+class Callback(object):
+    """
+    A metric whose value is read from a function when it's scraped, for
+    numbers that are already kept somewhere else.
+    """
+
+    def __init__(self, name, help, type, func):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.func = func
+
+    def samples(self):
+        yield self.name, '', self.func()
+
+
+def _register(metric):
+    with _metrics_lock:
+        for existing in _metrics:
+            if existing.name == metric.name:
+                raise ValueError('Metric %s already exists' % (metric.name,))
+        _metrics.append(metric)
+    return metric
+
+
+def counter(name, help, labels=()):
+    return _register(Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=DURATION_BUCKETS):
+    return _register(Histogram(name, help, labels, buckets))
+
+
+def callback(name, help, type, func):
+    """
+    Registers a metric of the given Prometheus type ('counter' or 'gauge')
+    whose value is func().
+    """
+    return _register(Callback(name, help, type, func))
+
+
+def timed(latency, errors):
+    """
+    Decorates a function to record how long each call takes in the latency
+    histogram, and the exceptions it raises in the errors counter, both
+    labelled with the function's name.  For a generator, the time spent
+    producing its items is what's recorded, not the time in between, and
+    for a function that returns a promise it's the time until the promise
+    is settled.
+    """
+    def decorator(func):
+        name = func.__name__
+
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                elapsed = 0.0
+                generator = func(*args, **kwargs)
+                try:
+                    while True:
+                        started = time.time()
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            elapsed += time.time() - started
+                            break
+                        except Exception, e:
+                            errors.inc(name, type(e).__name__)
+                            raise
+                        elapsed += time.time() - started
+                        yield item
+                finally:
+                    latency.observe(elapsed, name)
+            return wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception, e:
+                errors.inc(name, type(e).__name__)
+                latency.observe(time.time() - started, name)
+                raise
+            if not hasattr(result, 'add_callbacks'):
+                latency.observe(time.time() - started, name)
+                return result
+
+            # A promise or a future, which is timed until it's settled
+            def succeeded(value):
+                latency.observe(time.time() - started, name)
+
+            def failed(error):
+                errors.inc(name, type(error).__name__)
+                latency.observe(time.time() - started, name)
+
+            result.add_callbacks(succeeded, failed)
+            return result
+        return wrapper
+
+    return decorator
+
+
+def render():
+    """
+    Gets every metric in the Prometheus text format.
+    """
+    with _metrics_lock:
+        metrics = list(_metrics)
+    lines = []
+    for metric in metrics:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type))
+        for name, labels, value in metric.samples():
+            lines.append('%s%s %s' % (name, labels, _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+view_latency = histogram(
+    'django_view_duration_seconds',
+    'Time taken to respond to a request, by view.', ['view'])
+view_responses = counter(
+    'django_view_responses_total',
+    'Responses sent, by view and status code.', ['view', 'status'])
+
+
+class MetricsMiddleware(object):
+    """
+    Times each request from when its view is called until the response has
+    been through the middleware below this one.  Should come first in
+    MIDDLEWARE_CLASSES.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics_view = '%s.%s' % (
+            view_func.__module__, view_func.__name__)
+        request._metrics_started = time.time()
+
+    def process_response(self, request, response):
+        view = getattr(request, '_metrics_view', None)
+        if view is not None:
+            view_latency.observe(time.time() - request._metrics_started, view)
+            view_responses.inc(view, response.status_code)
+        return response
+
+
+def metrics_view(request):
+    return HttpResponse(
+        render(), content_type='text/plain; version=0.0.4; charset=utf-8')
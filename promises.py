@@ -0,0 +1,140 @@
+"""
+Results that aren't there yet, to chain work onto without blocking a thread.
+
+A Promise is settled once, with a value or an exception.  add_callbacks()
+works like the driver's ResponseFuture.add_callbacks(), so the two can be
+used in the same places, and then() chains on whatever comes next: the
+callback may return a plain value or another Promise to wait for.
+
+Callbacks run in whichever thread settles the promise, which is often the
+driver's event loop, so they must never block.  Only result() blocks, and
+it's for code that has nothing else to do until the value is there.
+"""
+import sys
+import threading
+
+
+class Promise(object):
+
+    def __init__(self):
+        self._settled = threading.Event()
+        self._lock = threading.Lock()
+        self._value = None
+        self._exc_info = None
+        self._callbacks = []
+
+    @classmethod
+    def resolved(cls, value):
+        promise = cls()
+        promise.set_result(value)
+        return promise
+
+    @classmethod
+    def rejected(cls, exception):
+        promise = cls()
+        promise.set_exception(exception)
+        return promise
+
+    def set_result(self, value):
+        self._settle(value, None)
+
+    def set_exception(self, exception, traceback=None):
+        self._settle(None, (type(exception), exception, traceback))
+
+    def _settle(self, value, exc_info):
+        with self._lock:
+            if self._settled.is_set():
+                return
+            self._value = value
+            self._exc_info = exc_info
+            self._settled.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback, errback in callbacks:
+            self._run(callback, errback)
+
+    def _run(self, callback, errback):
+        if self._exc_info is None:
+            callback(self._value)
+        else:
+            errback(self._exc_info[1])
+
+    def add_callbacks(self, callback, errback):
+        """
+        Calls callback(value) or errback(exception) once the promise is
+        settled, straight away if it already is.
+        """
+        with self._lock:
+            if not self._settled.is_set():
+                self._callbacks.append((callback, errback))
+                return
+        self._run(callback, errback)
+
+    def then(self, callback, errback=None):
+        """
+        Gets a promise of callback(value), or of errback(exception) if this
+        promise fails and errback is given.  If they return a Promise, the
+        new promise settles when that one does.
+        """
+        chained = Promise()
+
+        def run(func, arg):
+            try:
+                value = func(arg)
+            except Exception, e:
+                chained.set_exception(e, sys.exc_info()[2])
+            else:
+                if isinstance(value, Promise):
+                    value.add_callbacks(
+                        chained.set_result, chained.set_exception)
+                else:
+                    chained.set_result(value)
+
+        def failed(exception):
+            if errback is None:
+                chained.set_exception(exception)
+            else:
+                run(errback, exception)
+
+        self.add_callbacks(lambda value: run(callback, value), failed)
+        return chained
+
+    def result(self, timeout=None):
+        """
+        Blocks until the promise is settled, and returns its value or raises
+        its exception.
+        """
+        if not self._settled.wait(timeout):
+            raise RuntimeError('Timed out waiting for a result')
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+
+def gather(promises):
+    """
+    Gets a promise of the list of the values of some promises, in the same
+    order, which fails as soon as any of them does.
+    """
+    promises = list(promises)
+    gathered = Promise()
+    if not promises:
+        gathered.set_result([])
+        return gathered
+
+    values = [None] * len(promises)
+    remaining = [len(promises)]
+    lock = threading.Lock()
+
+    def make_callback(index):
+        def callback(value):
+            values[index] = value
+            with lock:
+                remaining[0] -= 1
+                done = not remaining[0]
+            if done:
+                gathered.set_result(values)
+        return callback
+
+    for index, promise in enumerate(promises):
+        promise.add_callbacks(make_callback(index), gathered.set_exception)
+    return gathered
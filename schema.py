@@ -0,0 +1,153 @@
+"""
+The CQL that creates the twissandra keyspace and its tables.
+
+It's shared by the sync_cassandra command, which runs it against a cluster,
+and by memcass.py, which builds its in-memory tables from it.
+"""
+
+KEYSPACE = """
+    CREATE KEYSPACE twissandra
+    WITH replication = {'class': 'SimpleStrategy', 'replication_factor': '1'}
+    """
+
+# The extra columns of the line tables for DENORMALIZED_LINES
+TWEET_COLUMNS = """
+        author text,
+        body text,"""
+
+TABLES = (
+    """
+    CREATE TABLE users (
+        username text PRIMARY KEY,
+        password text
+    )
+    """,
+    """
+    CREATE TABLE username_prefixes (
+        prefix text,
+        lower_username text,
+        username text,
+        PRIMARY KEY (prefix, lower_username, username)
+    )
+    """,
+    """
+    CREATE TABLE friends (
+        username text,
+        friend text,
+        since timestamp,
+        PRIMARY KEY (username, friend)
+    )
+    """,
+    """
+    CREATE TABLE followers (
+        username text,
+        follower text,
+        since timestamp,
+        PRIMARY KEY (username, follower)
+    )
+    """,
+    """
+    CREATE TABLE user_stats (
+        username text PRIMARY KEY,
+        followers counter,
+        following counter,
+        tweets counter
+    )
+    """,
+    """
+    CREATE TABLE tweets (
+        tweet_id uuid PRIMARY KEY,
+        username text,
+        body text
+    )
+    """,
+    """
+    CREATE TABLE userline (
+        username text,
+        time timeuuid,
+        tweet_id uuid,{tweet_columns}
+        PRIMARY KEY (username, time)
+    ) WITH CLUSTERING ORDER BY (time DESC)
+    """,
+    """
+    CREATE TABLE timeline (
+        username text,
+        time timeuuid,
+        tweet_id uuid,{tweet_columns}
+        PRIMARY KEY (username, time)
+    ) WITH CLUSTERING ORDER BY (time DESC)
+    """,
+    """
+    CREATE TABLE tagline (
+        line text,
+        time timeuuid,
+        tweet_id uuid,{tweet_columns}
+        PRIMARY KEY (line, time)
+    ) WITH CLUSTERING ORDER BY (time DESC)
+    """,
+    """
+    CREATE TABLE mentionline (
+        line text,
+        time timeuuid,
+        tweet_id uuid,{tweet_columns}
+        PRIMARY KEY (line, time)
+    ) WITH CLUSTERING ORDER BY (time DESC)
+    """,
+    """
+    CREATE TABLE line_buckets (
+        line text,
+        bucket text,
+        PRIMARY KEY (line, bucket)
+    ) WITH CLUSTERING ORDER BY (bucket DESC)
+    """,
+    """
+    CREATE TABLE celebrities (
+        username text PRIMARY KEY,
+        since timestamp
+    )
+    """,
+    """
+    CREATE TABLE celebrity_friends (
+        username text,
+        friend text,
+        PRIMARY KEY (username, friend)
+    )
+    """,
+    """
+    CREATE TABLE fanout_queue (
+        bucket int,
+        shard int,
+        queued timeuuid,
+        time timeuuid,
+        tweet_id uuid,
+        username text,
+        PRIMARY KEY ((bucket, shard), queued)
+    )
+    """,
+    """
+    CREATE TABLE fanout_checkpoints (
+        shard int PRIMARY KEY,
+        bucket int,
+        queued timeuuid
+    )
+    """,
+    """
+    CREATE TABLE fanout_status (
+        tweet_id uuid PRIMARY KEY,
+        state text,
+        attempts int,
+        delivered int,
+        error text,
+        updated timestamp
+    )
+    """,
+)
+
+
+def get_tables(denormalized=False):
+    """
+    Gets the CREATE TABLE statement for each table, with the author and body
+    in the rows of the line tables if denormalized is True.
+    """
+    tweet_columns = TWEET_COLUMNS if denormalized else ''
+    return [table.format(tweet_columns=tweet_columns) for table in TABLES]
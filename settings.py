@@ -65,6 +65,7 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'metrics.MetricsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'users.middleware.UserMiddleware',
@@ -72,6 +73,9 @@ MIDDLEWARE_CLASSES = (
 
 ROOT_URLCONF = 'urls'
 
+# Connects to Cassandra as the server starts, see wsgi.py
+WSGI_APPLICATION = 'wsgi.application'
+
 TEMPLATE_DIRS = (
     # Put strings here, like "/home/html/django_templates" or "C:/www/django/templates".
     # Always use forward slashes, even on Windows.
@@ -82,6 +86,163 @@ TEMPLATE_DIRS = (
 SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
 CACHE_BACKEND = 'locmem:///'
 
+# Where cass.py keeps its data: 'cassandra' for the cluster on localhost, or
+# 'memory' for the in-process stand-in in memcass.py, which needs no cluster
+# but forgets everything when the process exits.  See backends.py.
+CASSANDRA_BACKEND = 'cassandra'
+
+# How the 'cassandra' backend connects: the hosts it first contacts to find
+# the rest of the cluster, and the native protocol port and version (None
+# picks the newest version that both the driver and the cluster speak).
+CASSANDRA_HOSTS = ['127.0.0.1']
+CASSANDRA_PORT = 9042
+CASSANDRA_PROTOCOL_VERSION = None
+
+# Which hosts each statement is sent to:
+#   'token_aware' - a replica of the partition it touches, in the local DC
+#   'dc_aware'    - any host in the local DC, in turn
+#   'round_robin' - any host, in turn
+# The local DC is worked out from the contact points when it's None.
+CASSANDRA_LOAD_BALANCING = 'token_aware'
+CASSANDRA_LOCAL_DC = None
+
+# Seconds to wait for a statement before giving up on it.
+CASSANDRA_REQUEST_TIMEOUT = 10
+
+# The (core, max) number of connections to each local host.  Only protocol
+# versions 1 and 2 use more than one, later versions multiplex every request
+# over a single connection per host.
+CASSANDRA_CONNECTIONS_PER_HOST = (2, 8)
+
+# How each of the statements in cass.py is run, as (pattern, options) pairs.
+# The options of every pair whose pattern matches the statement's name (as
+# fnmatch does) are applied in order, so later pairs win:
+#   'consistency' - a cassandra.ConsistencyLevel name, like 'LOCAL_QUORUM'
+#   'timeout'     - seconds to wait, instead of CASSANDRA_REQUEST_TIMEOUT
+#   'idempotent'  - whether running the statement twice does no harm
+#   'speculative' - whether to send an idempotent statement to another
+#                   replica too, if the first hasn't answered within
+#                   CASSANDRA_SPECULATIVE_DELAY seconds, up to
+#                   CASSANDRA_SPECULATIVE_ATTEMPTS more times
+CASSANDRA_STATEMENT_OPTIONS = (
+    ('*', {'consistency': 'LOCAL_ONE'}),
+    # Reads can be sent more than once
+    ('get_*', {'idempotent': True}),
+    ('iter_*', {'idempotent': True}),
+    ('search_*', {'idempotent': True}),
+    # The reads that every page of tweets waits on, where one slow replica
+    # holds up the whole page
+    ('get_*line', {'speculative': True}),
+    ('get_many_*', {'speculative': True}),
+)
+CASSANDRA_SPECULATIVE_DELAY = 0.05
+CASSANDRA_SPECULATIVE_ATTEMPTS = 1
+
+# How many seconds each request to the 'memory' backend takes, plus a random
+# jitter that averages MEMORY_BACKEND_JITTER seconds, to time access patterns
+# as if there were a network round trip to a cluster.
+MEMORY_BACKEND_LATENCY = 0
+MEMORY_BACKEND_JITTER = 0
+
+# The most statements this process will have running against Cassandra at
+# once.  Anything that wants to run more waits for a free slot.
+CASSANDRA_MAX_IN_FLIGHT = 256
+
+# The public userline is split into one partition per time bucket, so that it
+# doesn't have to fit on a single node.  Either 'day' or 'hour'.
+PUBLIC_USERLINE_BUCKET = 'day'
+
+# The lines of tweets with each hashtag and of tweets mentioning each user are
+# split up the same way, so that a popular tag doesn't end up with one huge
+# partition.  Either 'day' or 'hour'.
+INDEX_LINE_BUCKET = 'day'
+
+# Users with more followers than this become celebrities: their tweets are no
+# longer copied into every follower's timeline, but are merged into the
+# timeline when it is read.  None turns this off.
+CELEBRITY_FOLLOWER_THRESHOLD = 5000
+
+# The number of friends or followers read from Cassandra at a time when going
+# through all of them.
+FOLLOWER_FETCH_SIZE = 1000
+
+# How new tweets get inserted into their author's followers' timelines:
+#   'sync'      - before save_tweet returns
+#   'inprocess' - by a pool of background threads in the web process
+#   'queue'     - by a separate `manage.py fanout_worker` process
+FANOUT_MODE = 'inprocess'
+FANOUT_WORKERS = 4
+FANOUT_QUEUE_SIZE = 1000
+FANOUT_RETRIES = 3
+FANOUT_QUEUE_SHARDS = 16
+
+# The fan-out queue is split up into FANOUT_QUEUE_BUCKET second time buckets
+# of FANOUT_QUEUE_SHARDS partitions each, which fanout_worker reads forwards
+# through.  It only picks up fan-outs queued more than FANOUT_QUEUE_DELAY
+# seconds ago, which must be longer than writing one to the queue can take,
+# so that it never reads past one that's still being written.
+FANOUT_QUEUE_BUCKET = 3600
+FANOUT_QUEUE_DELAY = 30
+
+# The number of a user's newest tweets copied into the timeline of someone
+# who starts following them, and deleted from it when they stop; 0 turns
+# this off.  It's done FOLLOW_BATCH_SIZE rows to a batch, by FOLLOW_WORKERS
+# background threads in the web process, or before add_friends and
+# remove_friends return if FANOUT_MODE is 'sync'.
+FOLLOW_BACKFILL_SIZE = 50
+FOLLOW_BATCH_SIZE = 25
+FOLLOW_WORKERS = 2
+
+# Usernames are indexed by their first one to USERNAME_PREFIX_LENGTH letters,
+# whatever their case, for cass.search_usernames.  The usernames under the
+# USERNAME_HOT_PREFIXES most searched prefixes (up to USERNAME_HOT_PREFIX_DEPTH
+# of them each) are kept in memory, and read again every
+# USERNAME_HOT_PREFIX_REFRESH seconds.
+USERNAME_PREFIX_LENGTH = 3
+USERNAME_HOT_PREFIXES = 100
+USERNAME_HOT_PREFIX_DEPTH = 1000
+USERNAME_HOT_PREFIX_REFRESH = 60
+
+# The number of tweet records cass.py keeps in memory, and for how many
+# seconds (None to keep them until they're evicted).
+TWEET_CACHE_SIZE = 10000
+TWEET_CACHE_TTL = None
+
+# The number of user records cass.py keeps in memory, and for how many
+# seconds.  A password changed by another process takes up to this long to
+# end the sessions that logged in with the old one.
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 60
+
+# The number of users whose newest TIMELINE_CACHE_DEPTH timeline rows cass.py
+# keeps in memory, so that the first page of their timeline doesn't read the
+# timeline partition, and for how many seconds.  The depth should be at least
+# a page of tweets.  Fan-outs done by fanout_worker rather than in the web
+# process take up to the TTL to show up.
+TIMELINE_CACHE_SIZE = 10000
+TIMELINE_CACHE_DEPTH = 50
+TIMELINE_CACHE_TTL = 300
+
+# How many seconds the pages of the public userline are kept in the Django
+# cache for: the first page, which save_tweet invalidates, and older pages,
+# which don't change.  Invalidation only reaches other processes if they share
+# the cache, as with memcached; with locmem they keep the first page for up to
+# PUBLIC_PAGE_CACHE_TTL.
+PUBLIC_PAGE_CACHE_TTL = 60
+PUBLIC_OLD_PAGE_CACHE_TTL = 24 * 60 * 60
+
+# Whether userline and timeline rows hold the author and body of their tweet,
+# so that a page of tweets can be read from a single partition.  This needs
+# `manage.py sync_cassandra --denormalized`, or `manage.py denormalize_lines`
+# to convert an existing keyspace.
+DENORMALIZED_LINES = False
+
+# How many seconds rows written to the userline and timeline tables are kept
+# for, None to keep them for good.  `manage.py trim_lines` caps how many rows
+# each partition holds instead, or as well.
+USERLINE_TTL = None
+TIMELINE_TTL = None
+
 INSTALLED_APPS = (
     'django.contrib.sessions',
     'tweets',
@@ -0,0 +1,117 @@
+"""
+A registry of named CQL statements.
+
+Statements are registered when a module is loaded, and prepared all together
+as soon as there's a backend to prepare them on, so that no request waits on
+a statement being prepared and no statement is parsed again per request.
+
+Each statement is also configured with its options as it's prepared: how
+consistent it has to be, how long to wait for it, whether it's idempotent,
+and whether it's sent to a second replica when the first is slow.  They
+come from (pattern, options) pairs matched against its name.
+
+Given a connect function, the first statement looked up before then calls it
+to connect, which is expected to call prepare_all(), so that code that runs
+before anything else has connected doesn't have to do it first.
+"""
+from fnmatch import fnmatchcase
+import threading
+
+
+class StatementRegistry(object):
+
+    def __init__(self, options=(), connect=None):
+        self.queries = {}
+        self.options = options
+        self.connect = connect
+        self._prepared = {}
+        # id() of each prepared statement -> its name
+        self._names = {}
+        self._backend = None
+        self._lock = threading.Lock()
+
+    def register(self, name, query):
+        """
+        Adds a statement.  If the registry has already been prepared, the
+        statement is prepared the first time it's used.
+        """
+        with self._lock:
+            self.queries[name] = query
+            self._prepared.pop(name, None)
+
+    def options_for(self, name):
+        """
+        Gets the options for the statement with that name.  They're merged
+        from every (pattern, options) pair whose fnmatch pattern matches the
+        name, with the later pairs winning.
+        """
+        merged = {}
+        for pattern, options in self.options:
+            if fnmatchcase(name, pattern):
+                merged.update(options)
+        return merged
+
+    def _prepare(self, backend, name):
+        statement = backend.prepare(self.queries[name])
+        backend.configure(statement, self.options_for(name))
+        return statement
+
+    def prepare_all(self, backend):
+        """
+        Prepares and configures every statement on a backend, which is used
+        from then on.
+        """
+        prepared = {}
+        for name in self.queries:
+            prepared[name] = self._prepare(backend, name)
+        with self._lock:
+            self._backend = backend
+            self._prepared = prepared
+            self._names = dict(
+                (id(statement), name) for name, statement in prepared.items())
+
+    def forget(self):
+        """
+        Drops the prepared statements, when the backend they were prepared
+        on has been shut down.
+        """
+        with self._lock:
+            self._backend = None
+            self._prepared = {}
+            self._names = {}
+
+    def __getitem__(self, name):
+        """
+        Gets the prepared statement with that name, connecting first if
+        nothing has yet.
+        """
+        try:
+            return self._prepared[name]
+        except KeyError:
+            pass
+        # Outside the lock, since connecting calls prepare_all()
+        if self._backend is None and self.connect is not None:
+            self.connect()
+        with self._lock:
+            if name not in self._prepared:
+                if self._backend is None:
+                    raise LookupError(
+                        'Statement %s has not been prepared yet' % (name,))
+                statement = self._prepare(self._backend, name)
+                self._prepared[name] = statement
+                self._names[id(statement)] = name
+            return self._prepared[name]
+
+    def name_of(self, statement):
+        """
+        Gets the name of a prepared statement, or of the statement a bound
+        statement was bound from, or None if it isn't one of these.
+        """
+        statement = getattr(statement, 'prepared_statement', statement)
+        return self._names.get(id(statement))
+
+    def __contains__(self, name):
+        return name in self.queries
+
+    def __len__(self):
+        return len(self.queries)
@@ -0,0 +1,301 @@
+from bisect import bisect
+import json
+from optparse import make_option
+import random
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+
+import cass
+from tweets.management.commands.fake_data import FakeDataset, default_until
+
+OPERATIONS = ('save_tweet', 'get_timeline', 'get_userline', 'add_friends',
+              'get_friends')
+
+DEFAULT_MIX = 'save_tweet=10,get_timeline=40,get_userline=25,add_friends=5,get_friends=20'
+
+PERCENTILES = (50, 95, 99)
+
+
+def parse_mix(mix):
+    """
+    Parses a mix like 'save_tweet=10,get_timeline=90' into a list of
+    (operation, weight) pairs.
+    """
+    weights = []
+    for part in mix.split(','):
+        try:
+            operation, weight = part.split('=')
+            weight = float(weight)
+        except ValueError:
+            raise CommandError('Bad operation weight %r' % (part,))
+        if operation not in OPERATIONS:
+            raise CommandError('Unknown operation %r, expected one of %s' % (
+                operation, ', '.join(OPERATIONS)))
+        weights.append((operation, weight))
+    return weights
+
+
+def percentile(sorted_values, percent):
+    """
+    The nearest-rank percentile of a sorted list.
+    """
+    if not sorted_values:
+        return None
+    rank = int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+class Command(NoArgsCommand):
+    help = ('Replays a mix of reads and writes through cass.py against a '
+            'generated dataset, and reports the throughput and latency of '
+            'each kind of call as JSON.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--backend', dest='backend', default='memory',
+            help="The CASSANDRA_BACKEND to run against, 'memory' (the "
+                 "default) needs no cluster."),
+        make_option('--latency', type='float', dest='latency', default=None,
+            help='Seconds each request to the memory backend takes, '
+                 'defaults to MEMORY_BACKEND_LATENCY.'),
+        make_option('--jitter', type='float', dest='jitter', default=None,
+            help='Average seconds of random jitter added to each request to '
+                 'the memory backend, defaults to MEMORY_BACKEND_JITTER.'),
+        make_option('--users', type='int', dest='users', default=1000,
+            help='Number of users in the dataset.'),
+        make_option('--tweets', type='int', dest='tweets', default=20,
+            help='Most tweets a user has in the dataset.'),
+        make_option('--follows', type='int', dest='follows', default=20,
+            help='Average number of people each user follows.'),
+        make_option('--skew', type='float', dest='skew', default=1.0,
+            help='Zipf exponent of how followers are spread over users.'),
+        make_option('--seed', type='int', dest='seed', default=0,
+            help='Seed for the dataset and the operations run against it.'),
+        make_option('--skip-load', action='store_true', dest='skip_load',
+            default=False,
+            help='Use the data already in the keyspace, as loaded by '
+                 '`fake_data --bulk` with the same sizes, skew and seed.'),
+        make_option('--operations', type='int', dest='operations',
+            default=10000,
+            help='Number of calls to make.'),
+        make_option('--mix', dest='mix', default=DEFAULT_MIX,
+            help='Relative weight of each call, default %s.' % (DEFAULT_MIX,)),
+        make_option('--threads', type='int', dest='threads', default=4,
+            help='Number of threads making calls at once.'),
+        make_option('--output', dest='output', default=None,
+            help='File to write the JSON results to, instead of stdout.'),
+    )
+
+    def handle_noargs(self, **options):
+        # cass connects the first time it's used, so the backend has to be
+        # chosen before then
+        settings.CASSANDRA_BACKEND = options['backend']
+        if options['latency'] is not None:
+            settings.MEMORY_BACKEND_LATENCY = options['latency']
+        if options['jitter'] is not None:
+            settings.MEMORY_BACKEND_JITTER = options['jitter']
+        backend = cass.get_backend()
+
+        mix = parse_mix(options['mix'])
+        dataset = FakeDataset(
+            options['users'], options['tweets'], options['follows'],
+            options['seed'], default_until(), options['skew'])
+
+        load_time = None
+        if not options['skip_load']:
+            # The injected latency is only meant for the calls being timed
+            memory = hasattr(backend, 'set_latency')
+            if memory:
+                backend.set_latency(0, 0)
+            started = time.time()
+            self.load(dataset)
+            load_time = time.time() - started
+            if memory:
+                backend.set_latency(
+                    settings.MEMORY_BACKEND_LATENCY,
+                    settings.MEMORY_BACKEND_JITTER)
+
+        operations = self.generate_operations(dataset, mix, options)
+        latencies, errors, duration = self.run(
+            operations, options['threads'])
+        # Stops memcass's background thread before the interpreter exits
+        cass.shutdown()
+
+        results = {}
+        for operation, weight in mix:
+            times = sorted(latencies[operation])
+            calls = len(times) + errors[operation]
+            result = {
+                'calls': calls,
+                'errors': errors[operation],
+                'throughput': calls / duration,
+                'mean_ms': sum(times) / len(times) * 1000 if times else None,
+                'max_ms': times[-1] * 1000 if times else None,
+            }
+            for percent in PERCENTILES:
+                value = percentile(times, percent)
+                result['p%d_ms' % (percent,)] = (
+                    value * 1000 if value is not None else None)
+            results[operation] = result
+
+        report = {
+            'config': dict(
+                (name, options[name]) for name in (
+                    'backend', 'users', 'tweets', 'follows', 'skew', 'seed',
+                    'operations', 'mix', 'threads')),
+            'settings': dict(
+                (name, getattr(settings, name)) for name in (
+                    'MEMORY_BACKEND_LATENCY', 'MEMORY_BACKEND_JITTER',
+                    'CASSANDRA_MAX_IN_FLIGHT', 'FANOUT_MODE',
+                    'CELEBRITY_FOLLOWER_THRESHOLD', 'DENORMALIZED_LINES',
+                    'PUBLIC_USERLINE_BUCKET', 'TWEET_CACHE_SIZE',
+                    'CASSANDRA_SPECULATIVE_DELAY',
+                    'CASSANDRA_SPECULATIVE_ATTEMPTS')),
+            'load_seconds': load_time,
+            'duration_seconds': duration,
+            'throughput': len(operations) / duration,
+            'operations': results,
+            'executor': cass.executor.stats(),
+            'tweet_cache': cass.tweet_cache.stats(),
+            'speculative': {
+                'executions': sum(
+                    value for _, _, value in
+                    cass.speculative_executions.samples()),
+                'wins': sum(
+                    value for _, _, value in cass.speculative_wins.samples()),
+            },
+        }
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.print_summary(report)
+        else:
+            print output
+
+    def load(self, dataset):
+        """
+        Writes the dataset through cass.py, so every table is filled in the
+        way the site would fill it.
+        """
+        # Follows go in first, so that saving the tweets fills the timelines
+        for i in range(dataset.num_users):
+            cass.save_user(dataset.username(i), dataset.password(i))
+        for i in range(dataset.num_users):
+            friends = [dataset.username(j) for j in dataset.friends[i]]
+            if friends:
+                cass.add_friends(dataset.username(i), friends)
+
+        # Fan out as the tweets are saved, so they're all in place before
+        # the clock starts
+        mode = settings.FANOUT_MODE
+        settings.FANOUT_MODE = 'sync'
+        try:
+            for i in range(dataset.num_users):
+                username = dataset.username(i)
+                for tweet_time, tweet_id, body in dataset.tweets(i):
+                    # TimeUUIDs count 100ns intervals since October 1582
+                    timestamp = (tweet_time.time - 0x01b21dd213814000L) / 1e7
+                    cass.save_tweet(tweet_id, username, body,
+                                    timestamp=timestamp)
+        finally:
+            settings.FANOUT_MODE = mode
+
+    def generate_operations(self, dataset, mix, options):
+        """
+        Picks the calls to make, and who to make them as, up front so that
+        the same seed always runs the same workload.
+        """
+        rng = random.Random('%d:benchmark' % (options['seed'],))
+        total = 0.0
+        cumulative_weights = []
+        for operation, weight in mix:
+            total += weight
+            cumulative_weights.append(total)
+
+        operations = []
+        for _ in range(options['operations']):
+            operation = mix[bisect(cumulative_weights, rng.random() * total)][0]
+            username = dataset.username(rng.randrange(dataset.num_users))
+            if operation == 'save_tweet':
+                args = (uuid.UUID(int=rng.getrandbits(128), version=4),
+                        username, 'Benchmark tweet %d' % (len(operations),))
+            elif operation == 'add_friends':
+                args = (username,
+                        [dataset.username(dataset.popular_user(rng))])
+            else:
+                args = (username,)
+            operations.append((operation, args))
+        return operations
+
+    def run(self, operations, num_threads):
+        """
+        Makes the calls from num_threads threads, and returns the latencies
+        of each kind of call, the number of each that failed, and how long
+        they all took.
+        """
+        calls = {
+            'save_tweet': cass.save_tweet,
+            'get_timeline': cass.get_timeline,
+            'get_userline': cass.get_userline,
+            'add_friends': cass.add_friends,
+            # get_friends is a generator, so it has to be read to the end
+            'get_friends': lambda username: list(cass.get_friends(username)),
+        }
+        latencies = dict((operation, []) for operation in OPERATIONS)
+        errors = dict((operation, 0) for operation in OPERATIONS)
+        lock = threading.Lock()
+
+        def worker(operations):
+            thread_latencies = []
+            thread_errors = []
+            for operation, args in operations:
+                started = time.time()
+                try:
+                    calls[operation](*args)
+                except Exception:
+                    thread_errors.append(operation)
+                else:
+                    thread_latencies.append(
+                        (operation, time.time() - started))
+            with lock:
+                for operation, latency in thread_latencies:
+                    latencies[operation].append(latency)
+                for operation in thread_errors:
+                    errors[operation] += 1
+
+        threads = [
+            threading.Thread(target=worker, args=(operations[i::num_threads],))
+            for i in range(num_threads)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.time() - started
+        # Let the background fan-outs finish rather than cutting them off
+        # when the command exits
+        if settings.FANOUT_MODE == 'inprocess':
+            cass.get_fanout_pool().join()
+        if settings.FANOUT_MODE != 'sync':
+            cass.get_follow_pool().join()
+        return latencies, errors, duration
+
+    def print_summary(self, report):
+        print '%.0f calls/s over %.1fs' % (
+            report['throughput'], report['duration_seconds'])
+        print '%-14s %8s %8s %9s %9s %9s %7s' % (
+            'operation', 'calls', 'calls/s', 'p50 ms', 'p95 ms', 'p99 ms',
+            'errors')
+        for operation in OPERATIONS:
+            result = report['operations'].get(operation)
+            if result is None or not result['calls']:
+                continue
+            print '%-14s %8d %8.0f %9.2f %9.2f %9.2f %7d' % (
+                operation, result['calls'], result['throughput'],
+                result['p50_ms'] or 0, result['p95_ms'] or 0,
+                result['p99_ms'] or 0, result['errors'])
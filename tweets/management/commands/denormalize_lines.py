@@ -0,0 +1,69 @@
+from cassandra import InvalidRequest
+from cassandra.query import SimpleStatement
+from django.core.management.base import BaseCommand
+
+import cass
+
+# The number of rows read from Cassandra, and filled in, at a time
+CHUNK_SIZE = 500
+
+class Command(BaseCommand):
+    help = ('Adds the author and body columns to the userline, timeline, '
+            'tagline and mentionline tables, and fills them in for the rows '
+            'that are already there.')
+
+    def handle(self, *args, **options):
+        for table, key in cass.LINE_TABLES:
+            self.add_columns(table)
+            self.backfill(table, key)
+        print 'All done! Now set DENORMALIZED_LINES = True.'
+
+    def add_columns(self, table):
+        for column in ('author', 'body'):
+            try:
+                cass.get_backend().execute(
+                    'ALTER TABLE %s ADD %s text' % (table, column))
+            except InvalidRequest:
+                # The column is already there
+                pass
+
+    def backfill(self, table, key):
+        # The columns are given the rest of the row's TTL, so that they
+        # don't outlive it; a TTL of 0 is none at all
+        update_query = cass.get_backend().prepare("""
+            UPDATE {table} USING TTL ? SET author=?, body=?
+            WHERE {key}=? AND time=?
+            """.format(table=table, key=key))
+
+        # The driver fetches the next page as the rows are iterated over
+        statement = SimpleStatement(
+            'SELECT %s, time, tweet_id, body, TTL(tweet_id) FROM %s' % (
+                key, table),
+            fetch_size=CHUNK_SIZE)
+
+        chunk = []
+        filled = 0
+        for row in cass.get_backend().execute(statement):
+            if row.body is None:
+                chunk.append(row)
+            if len(chunk) == CHUNK_SIZE:
+                filled += self.fill(update_query, key, chunk)
+                chunk = []
+                print '%s: filled in %d rows' % (table, filled)
+        filled += self.fill(update_query, key, chunk)
+        print '%s: filled in %d rows' % (table, filled)
+
+    def fill(self, update_query, key, rows):
+        tweets = cass._get_tweets_async(
+            [row.tweet_id for row in rows]).result()
+
+        statements = []
+        for row, tweet in zip(rows, tweets):
+            # The tweet has gone, leave the row for _get_line_async to skip
+            if tweet is None:
+                continue
+            statements.append((update_query, (
+                row.ttl_tweet_id or 0, tweet.username, tweet.body,
+                getattr(row, key), row.time)))
+
+        return cass.executor.execute_all(statements)
@@ -1,26 +1,65 @@
+from bisect import bisect
 import datetime
 import loremipsum
+import multiprocessing
+from optparse import make_option
 import random
 import string
 import time
 import uuid
 
+from django.conf import settings
+
 import cass
 
 from django.core.management.base import BaseCommand
 
+# The dataset and backend connection used by each bulk loading process
+_dataset = None
+_loader = None
+
 class Command(BaseCommand):
+    args = '<num_users> <max_tweets>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--bulk', action='store_true', dest='bulk', default=False,
+            help='Write the data straight to the tables from several '
+                 'processes, in batches, with a generated follow graph.'),
+        make_option('--processes', type='int', dest='processes',
+            default=multiprocessing.cpu_count(),
+            help='Number of processes to load the data with (bulk mode).'),
+        make_option('--seed', type='int', dest='seed', default=0,
+            help='Seed for the random data, the same seed always generates '
+                 'the same dataset (bulk mode).'),
+        make_option('--until', type='int', dest='until', default=None,
+            help='Unix time of the newest possible tweet, defaults to '
+                 'midnight UTC today (bulk mode).'),
+        make_option('--follows', type='int', dest='follows', default=20,
+            help='Average number of people each user follows (bulk mode).'),
+        make_option('--skew', type='float', dest='skew', default=1.0,
+            help='Zipf exponent of how followers are spread over users, '
+                 'higher makes the most popular users more popular '
+                 '(bulk mode).'),
+        make_option('--concurrency', type='int', dest='concurrency',
+            default=32,
+            help='Number of writes each process has in flight (bulk mode).'),
+        make_option('--batch-size', type='int', dest='batch_size', default=50,
+            help='Most rows written to a partition in one batch (bulk mode).'),
+    )
 
     def handle(self, *args, **options):
+        num_users = int(args[0])
+        max_tweets = int(args[1])
+
+        if options['bulk']:
+            return self.bulk_load(num_users, max_tweets, options)
+
         # Oldest account is 10 years
         origin = int(
             time.time() +
             datetime.timedelta(days=365.25 * 10).total_seconds() * 1e6)
         now = int(time.time() * 1e6)
 
-        num_users = int(args[0])
-        max_tweets = int(args[1])
-
         # Generate number of tweets based on a Zipfian distribution
         sample = [random.paretovariate(15) - 1 for x in range(max_tweets)]
         normalizer = 1 / float(max(sample)) * max_tweets
@@ -41,3 +80,276 @@ class Command(BaseCommand):
 
     def get_random_string(self):
         return ''.join(random.sample(string.letters, 10))
+
+    def bulk_load(self, num_users, max_tweets, options):
+        global _dataset
+
+        until = options['until']
+        if until is None:
+            until = default_until()
+
+        print 'Generating the follow graph...'
+        _dataset = FakeDataset(
+            num_users, max_tweets, options['follows'], options['seed'], until,
+            options['skew'])
+
+        # The processes are forked with the dataset already built
+        pool = multiprocessing.Pool(
+            options['processes'], _init_loader,
+            (options['concurrency'], options['batch_size']))
+
+        tasks = [range(i, min(i + 100, num_users))
+                 for i in range(0, num_users, 100)]
+
+        started = last_report = time.time()
+        users = rows = 0
+        for task_users, task_rows in pool.imap_unordered(_load_users, tasks):
+            users += task_users
+            rows += task_rows
+            if time.time() - last_report >= 1 or users == num_users:
+                last_report = time.time()
+                elapsed = last_report - started
+                print '%d/%d users, %d rows, %.0f rows/s' % (
+                    users, num_users, rows, rows / elapsed)
+
+        pool.close()
+        pool.join()
+
+
+def default_until():
+    """
+    Midnight UTC today, as a Unix time, so that datasets generated on the
+    same day line up.
+    """
+    today = datetime.datetime.utcnow().date()
+    return int((today - datetime.date(1970, 1, 1)).total_seconds())
+
+
+def _init_loader(concurrency, batch_size):
+    global _loader
+    _loader = BulkLoader(concurrency, batch_size)
+
+
+def _load_users(user_ids):
+    rows = 0
+    for i in user_ids:
+        rows += _loader.load_user(_dataset, i)
+    return len(user_ids), rows
+
+
+class FakeDataset(object):
+    """
+    A generated set of users, tweets and follows.  Everything is derived
+    from the seed, so any process can regenerate any part of it and get the
+    same answer.
+
+    The number of people each user follows and the number of tweets they make
+    are Pareto distributed, and who gets followed is Zipf distributed over a
+    shuffled popularity ranking, so there are a few users with a great many
+    followers.
+    """
+
+    def __init__(self, num_users, max_tweets, follows, seed, until, skew=1.0):
+        self.num_users = num_users
+        self.max_tweets = max_tweets
+        self.follows = follows
+        self.seed = seed
+        self.until = until
+        self._tweets = {}
+
+        rng = random.Random(seed)
+        ranking = range(num_users)
+        rng.shuffle(ranking)
+        self.ranking = ranking
+
+        total = 0.0
+        self.cumulative_weights = []
+        for rank in range(num_users):
+            total += 1.0 / (rank + 1) ** skew
+            self.cumulative_weights.append(total)
+
+        self.friends = [self._generate_friends(i) for i in range(num_users)]
+        self.followers = [[] for i in range(num_users)]
+        for i, friends in enumerate(self.friends):
+            for j in friends:
+                self.followers[j].append(i)
+
+    def _rng(self, i, purpose):
+        return random.Random('%d:%d:%s' % (self.seed, i, purpose))
+
+    def _generate_friends(self, i):
+        rng = self._rng(i, 'friends')
+        wanted = int(self.follows / 2.0 * rng.paretovariate(2))
+        wanted = min(wanted, self.num_users - 1)
+
+        friends = set()
+        for attempt in range(wanted * 3):
+            if len(friends) == wanted:
+                break
+            friend = self.popular_user(rng)
+            if friend != i:
+                friends.add(friend)
+        return sorted(friends)
+
+    def popular_user(self, rng):
+        """
+        Picks a user with the Zipf distribution that follows are made with.
+        """
+        total = self.cumulative_weights[-1]
+        rank = bisect(self.cumulative_weights, rng.random() * total)
+        return self.ranking[min(rank, self.num_users - 1)]
+
+    def username(self, i):
+        rng = self._rng(i, 'username')
+        return ''.join(rng.sample(string.letters, 6)) + str(i)
+
+    def password(self, i):
+        rng = self._rng(i, 'password')
+        return ''.join(rng.sample(string.letters, 10))
+
+    def tweets(self, i):
+        """
+        Gets the (time, tweet_id, body) of each of a user's tweets.
+        """
+        if i in self._tweets:
+            return self._tweets[i]
+
+        # loremipsum and cass._timestamp_to_uuid use the global random
+        random.seed('%d:%d:tweets' % (self.seed, i))
+
+        # Oldest account is 10 years
+        origin = self.until - int(datetime.timedelta(days=365.25 * 10).total_seconds())
+        creation_date = random.randint(origin, self.until)
+        # Pareto distributed, so most users tweet a little and a few a lot
+        num_tweets = min(
+            self.max_tweets, int(random.paretovariate(1.2) * self.max_tweets / 10.0))
+
+        tweets = []
+        for _ in range(num_tweets):
+            timestamp = random.uniform(creation_date, self.until)
+            tweets.append((
+                cass._timestamp_to_uuid(timestamp),
+                uuid.UUID(int=random.getrandbits(128), version=4),
+                loremipsum.get_sentence()))
+
+        # Tweets are regenerated for every follower, keep a few around
+        if len(self._tweets) > 10000:
+            self._tweets.clear()
+        self._tweets[i] = tweets
+        return tweets
+
+
+class BulkLoader(object):
+    """
+    Writes the rows for users of a FakeDataset straight to the tables, in
+    unlogged batches that each only touch a single partition.
+    """
+
+    def __init__(self, concurrency, batch_size):
+        self.batch_size = batch_size
+        self.threshold = settings.CELEBRITY_FOLLOWER_THRESHOLD
+
+        # cass connects the first time it's used, so each process gets a
+        # connection of its own after it has been forked
+        self.backend = cass.get_backend()
+        self.executor = cass.Executor(concurrency)
+
+        statements = cass.statements
+        self.users_query = statements['add_user']
+        self.friends_query = statements['add_friend']
+        self.followers_query = statements['add_follower']
+        self.tweets_query = statements['add_tweet']
+        self.line_buckets_query = statements['add_line_bucket']
+        self.celebrity_query = statements['add_celebrity']
+        self.celebrity_friends_query = statements['add_celebrity_friend']
+        self.userline_query = statements['add_to_userline']
+        self.timeline_query = statements['add_to_timeline']
+
+    def is_celebrity(self, dataset, i):
+        return (self.threshold is not None and
+                len(dataset.followers[i]) > self.threshold)
+
+    def line_params(self, table, key, time, tweet_id, author, body):
+        ttl = cass.line_ttl(table)
+        if settings.DENORMALIZED_LINES:
+            return (key, time, tweet_id, author, body, ttl)
+        return (key, time, tweet_id, ttl)
+
+    def batches(self, query, params):
+        """
+        Splits the rows for a single partition up into unlogged batches.
+        """
+        for i in range(0, len(params), self.batch_size):
+            batch = self.backend.batch()
+            for row_params in params[i:i + self.batch_size]:
+                batch.add(query, row_params)
+            yield batch, None
+
+    def load_user(self, dataset, i):
+        """
+        Writes all of the partitions that belong to a user, and returns the
+        number of rows written.
+        """
+        username = dataset.username(i)
+        since = datetime.datetime.utcfromtimestamp(dataset.until)
+        statements = [(self.users_query, (username, dataset.password(i)))]
+        statements.extend(cass._username_prefix_inserts(username))
+        rows = len(statements)
+
+        def add(query, params):
+            statements.extend(self.batches(query, params))
+            return len(params)
+
+        rows += add(self.friends_query, [
+            (username, dataset.username(j), since) for j in dataset.friends[i]])
+        rows += add(self.followers_query, [
+            (username, dataset.username(j), since) for j in dataset.followers[i]])
+
+        tweets = dataset.tweets(i)
+        for tweet_time, tweet_id, body in tweets:
+            statements.append((self.tweets_query, (tweet_id, username, body)))
+        rows += len(tweets)
+        rows += add(self.userline_query, [
+            self.line_params('userline', username, tweet_time, tweet_id, username, body)
+            for tweet_time, tweet_id, body in tweets])
+
+        # The public userline, a batch for each bucket
+        buckets = {}
+        for tweet_time, tweet_id, body in tweets:
+            bucket = cass._public_bucket(tweet_time)
+            buckets.setdefault(bucket, []).append(self.line_params(
+                'userline', cass.PUBLIC_USERLINE_KEY + bucket, tweet_time, tweet_id, username, body))
+        for bucket, params in buckets.items():
+            statements.append(
+                (self.line_buckets_query, (cass.PUBLIC_USERLINE_KEY, bucket,
+                                           cass.line_bucket_ttl('userline'))))
+            rows += add(self.userline_query, params) + 1
+
+        # The timeline has the user's own tweets, and the tweets of everyone
+        # they follow bar the celebrities
+        timeline = [self.line_params('timeline', username, tweet_time, tweet_id, username, body)
+                    for tweet_time, tweet_id, body in tweets]
+        celebrities = []
+        for j in dataset.friends[i]:
+            if self.is_celebrity(dataset, j):
+                celebrities.append((username, dataset.username(j)))
+                continue
+            friend = dataset.username(j)
+            timeline.extend(
+                self.line_params('timeline', username, tweet_time, tweet_id, friend, body)
+                for tweet_time, tweet_id, body in dataset.tweets(j))
+        rows += add(self.timeline_query, timeline)
+        rows += add(self.celebrity_friends_query, celebrities)
+
+        if self.is_celebrity(dataset, i):
+            statements.append((self.celebrity_query, (username, since)))
+            rows += 1
+
+        # Each user's counters are only written by their own load
+        statements.append(cass._user_stats_update(
+            username, followers=len(dataset.followers[i]),
+            following=len(dataset.friends[i]), tweets=len(tweets)))
+        rows += 1
+
+        self.executor.execute_all(statements)
+        return rows
@@ -0,0 +1,90 @@
+from collections import deque
+from optparse import make_option
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+import cass
+
+class Command(BaseCommand):
+    help = ('Inserts queued tweets into their followers\' timelines, for use '
+            'with FANOUT_MODE = \'queue\'.  Only one worker should work on '
+            'each shard of the queue at a time.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+            help='Number of fan-out threads (defaults to FANOUT_WORKERS).'),
+        make_option('--shards', dest='shards', default=None,
+            help='Comma separated queue shards to work on (defaults to all).'),
+        make_option('--batch', type='int', dest='batch', default=100,
+            help='Number of queued fan-outs to read from a shard at a time.'),
+        make_option('--poll-interval', type='float', dest='poll_interval',
+            default=1.0,
+            help='Seconds to wait when the queue is empty.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['shards']:
+            shards = [int(shard) for shard in options['shards'].split(',')]
+        else:
+            shards = range(settings.FANOUT_QUEUE_SHARDS)
+
+        pool = cass.make_fanout_pool(options['workers'])
+
+        # For each shard, the cursor the queue is read on from, and the
+        # fan-outs that have been handed to the pool, oldest first, as
+        # [cursor, done] pairs.  The checkpoint a restarted worker carries
+        # on from only moves past fan-outs that are done.
+        self.lock = threading.Lock()
+        self.checkpoints = {}
+        cursors = {}
+        pending = {}
+        for shard in shards:
+            cursors[shard] = self.checkpoints[shard] = (
+                cass.get_fanout_checkpoint(shard))
+            pending[shard] = deque()
+
+        print 'Working on shards %s' % (', '.join(map(str, shards)),)
+        try:
+            while True:
+                found = 0
+                for shard in shards:
+                    jobs, cursors[shard] = cass.get_queued_fan_outs(
+                        shard, cursors[shard], options['batch'])
+                    for job in jobs:
+                        found += 1
+                        entry = [(job.bucket, job.queued), False]
+                        with self.lock:
+                            pending[shard].append(entry)
+                        # Blocks while the pool's queue is full
+                        pool.submit(
+                            job.tweet_id, cass.fan_out_tweet,
+                            (job.tweet_id, job.username, job.time),
+                            on_done=self.make_on_done(entry), block=True)
+                    self.save_checkpoint(shard, pending[shard], cursors[shard])
+                if not found:
+                    time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            print 'Finishing off queued fan-outs...'
+            pool.stop()
+            for shard in shards:
+                self.save_checkpoint(shard, pending[shard], cursors[shard])
+
+    def make_on_done(self, entry):
+        def on_done():
+            with self.lock:
+                entry[1] = True
+        return on_done
+
+    def save_checkpoint(self, shard, pending, cursor):
+        with self.lock:
+            checkpoint = None
+            while pending and pending[0][1]:
+                checkpoint = pending.popleft()[0]
+            if not pending:
+                checkpoint = cursor
+        if checkpoint is not None and checkpoint != self.checkpoints[shard]:
+            cass.set_fanout_checkpoint(shard, checkpoint)
+            self.checkpoints[shard] = checkpoint
@@ -0,0 +1,38 @@
+from optparse import make_option
+
+from cassandra.query import SimpleStatement
+from django.core.management.base import BaseCommand
+
+import cass
+
+class Command(BaseCommand):
+    help = ('Adds every user that is already there to the username prefix '
+            'index, for users saved before it existed.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--fetch-size', type='int', dest='fetch_size',
+            default=500,
+            help='Number of users to read at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        backend = cass.get_backend()
+        statement = SimpleStatement(
+            'SELECT username FROM users', fetch_size=options['fetch_size'])
+        users = 0
+        paging_state = None
+        while True:
+            results = backend.execute(statement, paging_state=paging_state)
+            inserts = []
+            for row in results.current_rows:
+                inserts.extend(cass._username_prefix_inserts(row.username))
+            # Index inserts are idempotent, so this can be run again at any
+            # time
+            cass.executor.execute_all(inserts)
+            users += len(results.current_rows)
+            print 'Indexed %d users' % (users,)
+
+            paging_state = results.paging_state
+            if paging_state is None:
+                break
+        print 'All done!'
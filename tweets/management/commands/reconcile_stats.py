@@ -0,0 +1,86 @@
+from collections import defaultdict
+from optparse import make_option
+
+from cassandra.query import SimpleStatement
+from django.core.management.base import BaseCommand
+
+import cass
+from promises import gather
+
+class Command(BaseCommand):
+    help = ('Recounts every user\'s followers, friends and tweets from the '
+            'friends, followers and tweets tables, and corrects their '
+            'user_stats counters to match.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--fetch-size', type='int', dest='fetch_size',
+            default=1000,
+            help='Number of rows to read at a time.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False,
+            help='Only print the users whose counters are wrong.'),
+    )
+
+    def handle(self, *args, **options):
+        self.backend = cass.get_backend()
+        self.fetch_size = options['fetch_size']
+
+        print 'Counting followers...'
+        followers = self.count('SELECT username FROM followers')
+        print 'Counting friends...'
+        following = self.count('SELECT username FROM friends')
+        print 'Counting tweets...'
+        tweets = self.count('SELECT username FROM tweets')
+
+        users = corrected = 0
+        for usernames in self.pages('SELECT username FROM users'):
+            stats = gather(
+                cass.get_user_stats_async(username) for username in usernames)
+            updates = []
+            for username, current in zip(usernames, stats.result()):
+                actual = cass.UserStats(
+                    followers.get(username, 0), following.get(username, 0),
+                    tweets.get(username, 0))
+                if actual == current:
+                    continue
+                print '%s: %s, should be %s' % (
+                    username, tuple(current), tuple(actual))
+                # Counters can only be added to, so they're corrected by the
+                # difference.  Anything that changed them since they were
+                # read here is counted again by the next run.
+                updates.append(cass._user_stats_update(
+                    username,
+                    followers=actual.followers - current.followers,
+                    following=actual.following - current.following,
+                    tweets=actual.tweets - current.tweets))
+            if not options['dry_run']:
+                cass.executor.execute_all(updates)
+            users += len(usernames)
+            corrected += len(updates)
+            print 'Checked %d users, %d wrong' % (users, corrected)
+        print 'All done!'
+
+    def pages(self, query):
+        """
+        Yields the usernames a query reads, a page at a time.
+        """
+        statement = SimpleStatement(query, fetch_size=self.fetch_size)
+        paging_state = None
+        while True:
+            results = self.backend.execute(
+                statement, paging_state=paging_state)
+            yield [row.username for row in results.current_rows]
+
+            paging_state = results.paging_state
+            if paging_state is None:
+                break
+
+    def count(self, query):
+        """
+        Gets the number of rows a query reads for each username.
+        """
+        counts = defaultdict(int)
+        for usernames in self.pages(query):
+            for username in usernames:
+                counts[username] += 1
+        return counts
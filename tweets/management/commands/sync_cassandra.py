@@ -1,10 +1,22 @@
+from optparse import make_option
+
 from cassandra.cluster import Cluster
+from django.conf import settings
 from django.core.management.base import NoArgsCommand
 
+import schema
+
 class Command(NoArgsCommand):
 
+    option_list = NoArgsCommand.option_list + (
+        make_option('--denormalized', action='store_true', dest='denormalized',
+            default=False,
+            help='Store the author and body of each tweet in the userline and '
+                 'timeline rows, for use with DENORMALIZED_LINES = True.'),
+    )
+
     def handle_noargs(self, **options):
-        cluster = Cluster(['127.0.0.1'])
+        cluster = Cluster(settings.CASSANDRA_HOSTS, port=settings.CASSANDRA_PORT)
         session = cluster.connect()
 
         rows = session.execute(
@@ -20,63 +32,12 @@ class Command(NoArgsCommand):
                 return
             session.execute("DROP KEYSPACE twissandra")
 
-        session.execute("""
-            CREATE KEYSPACE twissandra
-            WITH replication = {'class': 'SimpleStrategy', 'replication_factor': '1'}
-            """)
+        session.execute(schema.KEYSPACE)
 
         # create tables
         session.set_keyspace("twissandra")
 
-        session.execute("""
-            CREATE TABLE users (
-                username text PRIMARY KEY,
-                password text
-            )
-            """)
-
-        session.execute("""
-            CREATE TABLE friends (
-                username text,
-                friend text,
-                since timestamp,
-                PRIMARY KEY (username, friend)
-            )
-            """)
-
-        session.execute("""
-            CREATE TABLE followers (
-                username text,
-                follower text,
-                since timestamp,
-                PRIMARY KEY (username, follower)
-            )
-            """)
-
-        session.execute("""
-            CREATE TABLE tweets (
-                tweet_id uuid PRIMARY KEY,
-                username text,
-                body text
-            )
-            """)
-
-        session.execute("""
-            CREATE TABLE userline (
-                username text,
-                time timeuuid,
-                tweet_id uuid,
-                PRIMARY KEY (username, time)
-            ) WITH CLUSTERING ORDER BY (time DESC)
-            """)
-
-        session.execute("""
-            CREATE TABLE timeline (
-                username text,
-                time timeuuid,
-                tweet_id uuid,
-                PRIMARY KEY (username, time)
-            ) WITH CLUSTERING ORDER BY (time DESC)
-            """)
+        for table in schema.get_tables(options['denormalized']):
+            session.execute(table)
 
         print 'All done!'
@@ -0,0 +1,138 @@
+import binascii
+import json
+from optparse import make_option
+import os
+import time
+
+from cassandra.query import SimpleStatement
+from django.core.management.base import BaseCommand, CommandError
+
+import cass
+
+class Command(BaseCommand):
+    help = ('Deletes all but the newest rows of every userline or timeline '
+            'partition, a partition at a time, at a limited rate.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--keep', type='int', dest='keep', default=1000,
+            help='Number of rows to keep in each partition.'),
+        make_option('--tables', dest='tables', default='timeline',
+            help='Comma separated tables to trim, out of userline and '
+                 'timeline.'),
+        make_option('--rate', type='float', dest='rate', default=100,
+            help='Most partitions to trim a second.'),
+        make_option('--fetch-size', type='int', dest='fetch_size',
+            default=100,
+            help='Number of partition keys, or of rows to delete, to read '
+                 'at a time.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+            help='File to record progress in after each page of partitions, '
+                 'and to carry on from if it is already there.'),
+    )
+
+    def handle(self, *args, **options):
+        tables = options['tables'].split(',')
+        for table in tables:
+            if table not in ('userline', 'timeline'):
+                raise CommandError('Can only trim userline and timeline')
+        if options['keep'] < 1:
+            raise CommandError('--keep must be at least 1')
+
+        self.checkpoint = options['checkpoint']
+        self.progress = {}
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                self.progress = json.load(f)
+            print 'Carrying on from %s' % (self.checkpoint,)
+
+        for table in tables:
+            self.trim(table, options['keep'], options['rate'],
+                      options['fetch_size'])
+
+    def save_progress(self):
+        if not self.checkpoint:
+            return
+        # Written to the side and renamed, so a kill can't leave half a file
+        with open(self.checkpoint + '.tmp', 'w') as f:
+            json.dump(self.progress, f)
+        os.rename(self.checkpoint + '.tmp', self.checkpoint)
+
+    def trim(self, table, keep, rate, fetch_size):
+        progress = self.progress.setdefault(table, {
+            'paging_state': None, 'done': False, 'partitions': 0,
+            'trimmed': 0})
+        if progress['done']:
+            print '%s: already trimmed' % (table,)
+            return
+
+        backend = cass.get_backend()
+        newest_query = backend.prepare(
+            'SELECT time FROM %s WHERE username=? LIMIT ?' % (table,))
+        older_query = backend.prepare(
+            'SELECT time FROM %s WHERE username=? AND time<? LIMIT ?' % (
+                table,))
+        # Range deletes on clustering columns need Cassandra 3.0, so the rows
+        # are deleted one at a time
+        trim_query = backend.prepare(
+            'DELETE FROM %s WHERE username=? AND time=?' % (table,))
+        keys_statement = SimpleStatement(
+            'SELECT DISTINCT username FROM %s' % (table,),
+            fetch_size=fetch_size)
+
+        paging_state = progress['paging_state']
+        if paging_state is not None:
+            paging_state = binascii.unhexlify(paging_state)
+
+        started = time.time()
+        done = 0
+        while True:
+            results = backend.execute(keys_statement, paging_state=paging_state)
+            for row in results.current_rows:
+                # The public userline is already split up by time bucket
+                if row.username.startswith(cass.PUBLIC_USERLINE_KEY):
+                    continue
+
+                # Keep to the rate, however quickly the partitions go by
+                done += 1
+                delay = started + done / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+                deleted = self.trim_partition(
+                    backend, (newest_query, older_query, trim_query),
+                    row.username, keep, fetch_size)
+                progress['partitions'] += 1
+                if deleted:
+                    progress['trimmed'] += 1
+
+            paging_state = results.paging_state
+            if paging_state is None:
+                progress['paging_state'] = None
+                progress['done'] = True
+            else:
+                progress['paging_state'] = binascii.hexlify(paging_state)
+            self.save_progress()
+            print '%s: trimmed %d of %d partitions' % (
+                table, progress['trimmed'], progress['partitions'])
+            if paging_state is None:
+                break
+
+    def trim_partition(self, backend, queries, username, keep, fetch_size):
+        """
+        Deletes all but the newest keep rows of a partition, and returns the
+        number deleted.  A partition that's already small enough only takes
+        the one read.
+        """
+        newest_query, older_query, trim_query = queries
+        rows = list(backend.execute(newest_query, (username, keep + 1)))
+        rows = rows[keep:]
+        deleted = 0
+        while rows:
+            cass.executor.execute_all(
+                (trim_query, (username, row.time)) for row in rows)
+            deleted += len(rows)
+            # Carry on from the oldest row deleted, rather than paging past
+            # the ones that are gone
+            rows = list(backend.execute(
+                older_query, (username, rows[-1].time, fetch_size)))
+        return deleted
@@ -0,0 +1,276 @@
+"""
+The apps have no models, which manage.py test needs, so these are run with
+
+    DJANGO_SETTINGS_MODULE=settings python -m unittest tweets.tests
+"""
+import threading
+import uuid
+
+from cassandra import OperationTimedOut
+from django.core.management import call_command
+from django.test import SimpleTestCase
+from django.test.client import Client
+from django.test.utils import override_settings
+
+import cass
+import fanout
+
+
+@override_settings(CASSANDRA_BACKEND='memory')
+class MemoryTestCase(SimpleTestCase):
+    """
+    Runs each test against an empty in-memory backend, with empty caches.
+    """
+
+    def setUp(self):
+        # The next statement looked up connects to a new one
+        cass.shutdown()
+        cass.cache.clear()
+        for lru in (cass.tweet_cache, cass.user_cache, cass.timeline_cache,
+                    cass.hot_prefixes, cass._known_buckets):
+            lru.clear()
+
+
+class ConnectTests(MemoryTestCase):
+
+    def test_first_lookup_connects(self):
+        # Nothing has connected since setUp, as in a process that didn't
+        # load wsgi.py
+        self.assertEqual(Client().get('/public/').status_code, 200)
+        self.assertRaises(cass.NotFound, cass.get_user_by_username, 'alice')
+
+
+class CursorTests(MemoryTestCase):
+
+    def test_parse_timeuuid(self):
+        timeuuid = uuid.uuid1()
+        self.assertEqual(cass.parse_timeuuid(str(timeuuid)), timeuuid)
+        for value in ('nonsense', str(uuid.uuid4()),
+                      '00000000-0000-1000-8000-000000000000'):
+            self.assertRaises(ValueError, cass.parse_timeuuid, value)
+
+    def test_uuid4_cursor(self):
+        client = Client()
+        response = client.get(
+            '/api/tags/x/', {'start': str(uuid.uuid4())})
+        self.assertEqual(response.status_code, 400)
+        response = client.get('/public/', {'start': str(uuid.uuid4())})
+        self.assertEqual(response.status_code, 404)
+
+
+class MemoryTweetsTestCase(MemoryTestCase):
+    """
+    Adds helpers for saving tweets and checking the lines they are on.
+    """
+
+    def save_tweets(self, username, bodies):
+        """
+        Saves a tweet for each body, oldest first, and returns their ids.
+        """
+        tweet_ids = []
+        for body in bodies:
+            tweet_id = uuid.uuid4()
+            cass.save_tweet(tweet_id, username, body)
+            tweet_ids.append(tweet_id)
+        return tweet_ids
+
+    def assertLine(self, entries, tweet_ids):
+        self.assertEqual([entry.tweet_id for entry in entries], tweet_ids)
+
+
+class ExecutorTests(MemoryTestCase):
+
+    def test_limit_and_release(self):
+        backend = cass.get_backend()
+        backend.set_latency(0.05, 0)
+        executor = cass.Executor(2, backend)
+        promises = [executor.submit(cass.statements['get_user'], ('alice',))
+                    for i in range(5)]
+        stats = executor.stats()
+        self.assertEqual((stats['in_flight'], stats['queued']), (2, 3))
+
+        for promise in promises:
+            self.assertEqual(list(promise.result()), [])
+        stats = executor.stats()
+        self.assertEqual((stats['in_flight'], stats['queued']), (0, 0))
+        self.assertEqual(stats['executed'], 5)
+
+        # Every slot was given back
+        self.assertEqual(executor.execute_all(
+            (cass.statements['get_user'], ('alice',)) for i in range(4)), 4)
+        self.assertEqual(executor.stats()['in_flight'], 0)
+
+    def test_release_on_error(self):
+        executor = cass.Executor(1, cass.get_backend())
+        promise = executor.submit('SELECT * FROM nonsense')
+        self.assertRaises(Exception, promise.result)
+        self.assertEqual(executor.stats()['in_flight'], 0)
+        self.assertEqual(
+            list(executor.submit(cass.statements['get_user'],
+                                 ('alice',)).result()), [])
+
+
+class MemcassTests(MemoryTestCase):
+
+    def test_timeout(self):
+        backend = cass.get_backend()
+        backend.set_latency(0.5, 0)
+        future = backend.execute_async(cass.statements['get_user'], ('alice',))
+        self.assertRaises(OperationTimedOut, future.result, 0.01)
+        self.assertEqual(list(future.result()), [])
+
+    def test_failing_callback(self):
+        backend = cass.get_backend()
+        backend.set_latency(0.01, 0)
+        results = []
+        done = threading.Event()
+
+        def fail(rows):
+            raise ValueError('callback failed')
+
+        future = backend.execute_async(cass.statements['get_user'], ('alice',))
+        future.add_callback(fail)
+        future.add_callback(results.append)
+        future.add_callback(lambda rows: done.set())
+        self.assertTrue(done.wait(1))
+        self.assertEqual(results, [[]])
+
+        # The scheduler thread is still running requests
+        self.assertEqual(list(backend.execute_async(
+            cass.statements['get_user'], ('alice',)).result()), [])
+
+
+@override_settings(FANOUT_MODE='sync')
+class PagingTests(MemoryTweetsTestCase):
+
+    def test_userline(self):
+        tweet_ids = self.save_tweets('alice', ['one', 'two', 'three', 'four'])
+        tweet_ids.reverse()
+
+        first, next = cass.get_userline('alice', limit=3)
+        self.assertLine(first, tweet_ids[:3])
+        entries, next = cass.get_userline('alice', start=next, limit=3)
+        self.assertLine(entries, tweet_ids[3:])
+        self.assertEqual(next, None)
+
+        entries, next = cass.get_userline('alice', since=str(first[-1].time))
+        self.assertLine(entries, tweet_ids[:2])
+        entries, next = cass.get_userline('alice', since=str(first[0].time))
+        self.assertLine(entries, [])
+
+    def test_public_page(self):
+        tweet_ids = self.save_tweets('alice', ['one', 'two', 'three'])
+        tweet_ids.reverse()
+
+        page = cass.get_public_page(limit=2)
+        self.assertLine(page.entries, tweet_ids[:2])
+        page = cass.get_public_page(start=page.next, limit=2)
+        self.assertLine(page.entries, tweet_ids[2:])
+        self.assertEqual(page.next, None)
+
+        # The first page is read again once there's a new tweet
+        tweet_ids[:0] = self.save_tweets('alice', ['four'])
+        self.assertLine(cass.get_public_page(limit=2).entries, tweet_ids[:2])
+
+
+@override_settings(FANOUT_MODE='sync', CELEBRITY_FOLLOWER_THRESHOLD=1)
+class CelebrityTests(MemoryTweetsTestCase):
+
+    def test_merge(self):
+        cass.add_friends('bob', ['alice'])
+        cass.add_friends('carol', ['alice'])
+        tweet_ids = self.save_tweets('bob', ['one'])
+        tweet_ids += self.save_tweets('alice', ['two'])
+        tweet_ids += self.save_tweets('bob', ['three'])
+        tweet_ids.reverse()
+
+        # Alice has too many followers for her tweet to be fanned out, so
+        # it's merged into the timelines as they're read
+        self.assertTrue(cass.is_celebrity('alice'))
+        self.assertLine(cass.get_userline('bob')[0], tweet_ids[::2])
+        self.assertLine(cass.get_timeline('bob')[0], tweet_ids)
+        self.assertLine(cass.get_timeline('carol')[0], tweet_ids[1:2])
+
+        entries, next = cass.get_timeline('bob', limit=2)
+        self.assertLine(entries, tweet_ids[:2])
+        entries, next = cass.get_timeline('bob', start=next, limit=2)
+        self.assertLine(entries, tweet_ids[2:])
+
+
+@override_settings(FANOUT_MODE='sync')
+class StatsTests(MemoryTestCase):
+
+    def test_follows_counted_once(self):
+        cass.add_friends('bob', ['alice', 'alice', 'carol'])
+        threads = [threading.Thread(target=cass.add_friends,
+                                    args=('bob', ['alice']))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cass.get_user_stats('alice'), (1, 0, 0))
+        self.assertEqual(cass.get_user_stats('bob'), (0, 2, 0))
+
+        cass.remove_friends('bob', ['alice', 'alice', 'dave'])
+        cass.remove_friends('bob', ['alice'])
+        self.assertEqual(cass.get_user_stats('alice'), (0, 0, 0))
+        self.assertEqual(cass.get_user_stats('bob'), (0, 1, 0))
+        self.assertEqual(cass.get_friend_usernames('bob'), ['carol'])
+
+
+@override_settings(FANOUT_MODE='inprocess')
+class FanoutTests(MemoryTweetsTestCase):
+
+    def test_inprocess(self):
+        cass.add_friends('bob', ['alice'])
+        cass.add_friends('carol', ['alice'])
+        cass.get_follow_pool().join()
+        # With some jitter, the QUEUED status could land after DONE if the
+        # worker didn't wait for it
+        cass.get_backend().set_latency(0.002, 0.005)
+        tweet_id, = self.save_tweets('alice', ['one'])
+        cass.get_fanout_pool().join()
+
+        for username in ('alice', 'bob', 'carol'):
+            self.assertLine(cass.get_timeline(username)[0], [tweet_id])
+        status = cass.get_fanout_status(tweet_id)
+        self.assertEqual(status.state, fanout.DONE)
+        self.assertEqual(status.delivered, 2)
+
+
+@override_settings(FANOUT_MODE='sync', TIMELINE_TTL=1000)
+class DenormalizeTests(MemoryTweetsTestCase):
+
+    def test_backfill_keeps_ttl(self):
+        tweet_id, = self.save_tweets('alice', ['one'])
+        call_command('denormalize_lines')
+
+        backend = cass.get_backend()
+        query = 'SELECT tweet_id, body, TTL(tweet_id) FROM %s WHERE username=?'
+        row, = backend.execute(backend.prepare(query % 'timeline'), ('alice',))
+        self.assertEqual((row.tweet_id, row.body), (tweet_id, 'one'))
+        self.assertTrue(0 < row.ttl_tweet_id <= 1000)
+        row, = backend.execute(backend.prepare(query % 'userline'), ('alice',))
+        self.assertEqual((row.tweet_id, row.body), (tweet_id, 'one'))
+        self.assertEqual(row.ttl_tweet_id, None)
+
+    def test_pool_reports(self):
+        reports = []
+        pool = fanout.FanoutPool(
+            1, 10, 1, retry_delay=0, status=lambda *args: reports.append(args))
+        pool.start()
+        failures = ['first try']
+
+        def job():
+            if failures:
+                raise ValueError(failures.pop())
+            return 3
+
+        pool.submit('job', job)
+        pool.stop()
+        # Whoever submits the job records that it's queued
+        self.assertEqual(reports, [
+            ('job', fanout.RETRYING, 1, 0, 'first try'),
+            ('job', fanout.DONE, 2, 3, None),
+        ])
@@ -3,5 +3,14 @@ from django.conf.urls.defaults import patterns, url
 urlpatterns = patterns('tweets.views',
     url(r'^/?$', 'timeline', name='timeline'),
     url(r'^public/$', 'publicline', name='publicline'),
+    url(r'^api/timeline/$', 'timeline_json', name='timeline_json'),
+    url(r'^api/public/$', 'publicline_json', name='publicline_json'),
+    url(r'^api/users/(?P<username>\w+)/$', 'userline_json',
+        name='userline_json'),
+    url(r'^api/users/(?P<username>\w+)/mentions/$', 'mentions_json',
+        name='mentions_json'),
+    url(r'^api/tags/(?P<tag>\w+)/$', 'tagline_json', name='tagline_json'),
+    url(r'^tags/(?P<tag>\w+)/$', 'tagline', name='tagline'),
+    url(r'^(?P<username>\w+)/mentions/$', 'mentions', name='mentions'),
     url(r'^(?P<username>\w+)/$', 'userline', name='userline'),
 )
\ No newline at end of file
@@ -1,29 +1,74 @@
+import json
 import uuid
 
 from django.shortcuts import render_to_response
 from django.template import RequestContext
-from django.http import HttpResponseRedirect, Http404
+from django.http import (
+    HttpResponseBadRequest, HttpResponseRedirect, Http404,
+    StreamingHttpResponse)
 from django.core.urlresolvers import reverse
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_cookie
 
 from tweets.forms import TweetForm
 
 import cass
+from promises import Promise, gather
 
 NUM_PER_PAGE = 40
 
+def _start(request):
+    # A cursor that isn't a TimeUUID can't point to a page of anything
+    start = request.GET.get('start') or None
+    if start is not None:
+        try:
+            cass.parse_timeuuid(start)
+        except ValueError:
+            raise Http404
+    return start
+
+def _public_page(request):
+    # Read once per request, for the ETag, Last-Modified and the view itself
+    if not hasattr(request, '_public_page'):
+        request._public_page = cass.get_public_page(
+            start=_start(request), limit=NUM_PER_PAGE)
+    return request._public_page
+
+def _public_etag(request, *args, **kwargs):
+    # The header shows who's logged in, so that's part of the page too
+    page = _public_page(request)
+    return '%s-%s-%s' % (page.newest, page.next, request.session.get('username'))
+
+def _public_last_modified(request, *args, **kwargs):
+    return _public_page(request).modified
+
+def _anonymous_only(func):
+    # Logged in users get their own timeline rather than the public one
+    def wrapper(request, *args, **kwargs):
+        if request.user['is_authenticated']:
+            return None
+        return func(request, *args, **kwargs)
+    return wrapper
+
+@vary_on_cookie
+@condition(etag_func=_anonymous_only(_public_etag),
+           last_modified_func=_anonymous_only(_public_last_modified))
 def timeline(request):
     form = TweetForm(request.POST or None)
     if request.user['is_authenticated'] and form.is_valid():
         tweet_id = uuid.uuid4()
-        cass.save_tweet(tweet_id, request.session['username'], form.cleaned_data['body'])
+        cass.save_tweet(
+            tweet_id, request.session['username'],
+            form.cleaned_data['body'])
         return HttpResponseRedirect(reverse('timeline'))
-    start = request.GET.get('start')
+    start = _start(request)
     if request.user['is_authenticated']:
-        tweets, next_timeuuid = cass.get_timeline(
-            request.session['username'], start=start, limit=NUM_PER_PAGE)
+        tweets, next_timeuuid = cass.get_timeline_async(
+            request.session['username'], start=start,
+            limit=NUM_PER_PAGE).result()
     else:
-        tweets, next_timeuuid = cass.get_userline(
-            cass.PUBLIC_USERLINE_KEY, start=start, limit=NUM_PER_PAGE)
+        page = _public_page(request)
+        tweets, next_timeuuid = page.entries, page.next
     context = {
         'form': form,
         'tweets': tweets,
@@ -33,42 +78,176 @@ def timeline(request):
         'tweets/timeline.html', context, context_instance=RequestContext(request))
 
 
+@vary_on_cookie
+@condition(etag_func=_public_etag, last_modified_func=_public_last_modified)
 def publicline(request):
-    start = request.GET.get('start')
-    tweets, next_timeuuid = cass.get_userline(
-        cass.PUBLIC_USERLINE_KEY, start=start, limit=NUM_PER_PAGE)
+    page = _public_page(request)
     context = {
-        'tweets': tweets,
-        'next': next_timeuuid,
+        'tweets': page.entries,
+        'next': page.next,
     }
     return render_to_response(
         'tweets/publicline.html', context, context_instance=RequestContext(request))
 
 
 def userline(request, username=None):
-    try:
-        user = cass.get_user_by_username(username)
-    except cass.DatabaseError:
-        raise Http404
+    # Everything the page needs is read at once, then waited for
+    user = cass.get_user_by_username_async(username)
 
-    # Query for the friend ids
-    friend_usernames = []
+    # Whether the currently logged-in user is friends with the user
+    is_friend = Promise.resolved(False)
     if request.user['is_authenticated']:
-        friend_usernames = cass.get_friend_usernames(username) + [username]
+        is_friend = cass.is_following_async(
+            request.session['username'], username)
 
-    # Add a property on the user to indicate whether the currently logged-in
-    # user is friends with the user
-    is_friend = username in friend_usernames
+    start = _start(request)
+    line = cass.get_userline_async(username, start=start, limit=NUM_PER_PAGE)
+    stats = cass.get_user_stats_async(username)
 
-    start = request.GET.get('start')
-    tweets, next_timeuuid = cass.get_userline(username, start=start, limit=NUM_PER_PAGE)
+    try:
+        user = user.result()
+    except cass.DatabaseError:
+        raise Http404
+    is_friend = is_friend.result()
+    tweets, next_timeuuid = line.result()
     context = {
         'user': user,
         'username': username,
+        'stats': stats.result(),
         'tweets': tweets,
         'next': next_timeuuid,
         'is_friend': is_friend,
-        'friend_usernames': friend_usernames,
     }
     return render_to_response(
         'tweets/userline.html', context, context_instance=RequestContext(request))
+
+
+def tagline(request, tag=None):
+    start = _start(request)
+    tweets, next_timeuuid = cass.get_tagline_async(
+        tag, start=start, limit=NUM_PER_PAGE).result()
+    context = {
+        'tag': tag,
+        'tweets': tweets,
+        'next': next_timeuuid,
+    }
+    return render_to_response(
+        'tweets/tagline.html', context, context_instance=RequestContext(request))
+
+
+def mentions(request, username=None):
+    user = cass.get_user_by_username_async(username)
+    start = _start(request)
+    line = cass.get_mentions_async(username, start=start, limit=NUM_PER_PAGE)
+
+    try:
+        user.result()
+    except cass.DatabaseError:
+        raise Http404
+    tweets, next_timeuuid = line.result()
+    context = {
+        'username': username,
+        'tweets': tweets,
+        'next': next_timeuuid,
+    }
+    return render_to_response(
+        'tweets/mentions.html', context, context_instance=RequestContext(request))
+
+
+# The fields of a tweet the JSON views can give, in the order they're given
+JSON_FIELDS = ('time', 'tweet_id', 'username', 'body')
+
+def _json_field(entry, field):
+    value = getattr(entry, field)
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+def _stream_json(fields, entries, next_timeuuid):
+    # Each tweet is an array of the fields, written out as it's serialized
+    yield '{"fields":%s,"tweets":[' % (
+        json.dumps(fields, separators=(',', ':')),)
+    for i, entry in enumerate(entries):
+        row = [_json_field(entry, field) for field in fields]
+        yield (',' if i else '') + json.dumps(row, separators=(',', ':'))
+    yield '],"next":%s}' % (json.dumps(next_timeuuid),)
+
+def _json_line(request, get_line):
+    """
+    Responds with a page of tweets as JSON, from the promise that
+    get_line(start, since) returns.
+
+    ?fields= picks which of JSON_FIELDS each tweet has, ?start= gets the
+    page that next pointed to, and ?since= only gets the tweets newer than
+    the one with that time.
+    """
+    fields = list(JSON_FIELDS)
+    if request.GET.get('fields'):
+        fields = request.GET['fields'].split(',')
+        if not set(fields).issubset(JSON_FIELDS):
+            return HttpResponseBadRequest(
+                'fields can be any of %s' % (', '.join(JSON_FIELDS),))
+    cursors = {}
+    for name in ('start', 'since'):
+        value = request.GET.get(name) or None
+        if value is not None:
+            try:
+                cass.parse_timeuuid(value)
+            except ValueError:
+                return HttpResponseBadRequest('%s is not a TimeUUID' % (name,))
+        cursors[name] = value
+
+    entries, next_timeuuid = get_line(
+        cursors['start'], cursors['since']).result()
+    return StreamingHttpResponse(
+        _stream_json(fields, entries, next_timeuuid),
+        content_type='application/json')
+
+def _public_json(start, since):
+    if since:
+        return cass.get_userline_async(
+            cass.PUBLIC_USERLINE_KEY, start=start, limit=NUM_PER_PAGE,
+            since=since)
+    page = cass.get_public_page(start=start, limit=NUM_PER_PAGE)
+    return Promise.resolved((page.entries, page.next))
+
+def timeline_json(request):
+    if not request.user['is_authenticated']:
+        return _json_line(request, _public_json)
+    username = request.session['username']
+    return _json_line(request, lambda start, since: cass.get_timeline_async(
+        username, start=start, limit=NUM_PER_PAGE, since=since))
+
+def publicline_json(request):
+    return _json_line(request, _public_json)
+
+def userline_json(request, username=None):
+    # The user is looked up while the userline is read
+    user = cass.get_user_by_username_async(username)
+
+    def get_line(start, since):
+        line = cass.get_userline_async(
+            username, start=start, limit=NUM_PER_PAGE, since=since)
+        return gather([user, line]).then(lambda results: results[1])
+
+    try:
+        return _json_line(request, get_line)
+    except cass.DatabaseError:
+        raise Http404
+
+def tagline_json(request, tag=None):
+    return _json_line(request, lambda start, since: cass.get_tagline_async(
+        tag, start=start, limit=NUM_PER_PAGE, since=since))
+
+def mentions_json(request, username=None):
+    user = cass.get_user_by_username_async(username)
+
+    def get_line(start, since):
+        line = cass.get_mentions_async(
+            username, start=start, limit=NUM_PER_PAGE, since=since)
+        return gather([user, line]).then(lambda results: results[1])
+
+    try:
+        return _json_line(request, get_line)
+    except cass.DatabaseError:
+        raise Http404
@@ -2,6 +2,7 @@ from django.conf.urls.defaults import *
 from django.conf import settings
 
 urlpatterns = patterns('',
+    url('^metrics$', 'metrics.metrics_view', name='metrics'),
     url('^auth/', include('users.urls')),
     url('', include('tweets.urls')),
 )
@@ -10,7 +10,8 @@ class LoginForm(forms.Form):
         username = self.cleaned_data['username']
         password = self.cleaned_data['password']
         try:
-            user = cass.get_user_by_username(username)
+            # Read past the cache, so an old password stops working at once
+            user = cass.get_user_by_username(username, cached=False)
         except cass.DatabaseError:
             raise forms.ValidationError(u'Invalid username and/or password')
         if user.password != password:
@@ -20,6 +21,9 @@ class LoginForm(forms.Form):
     def get_username(self):
         return self.cleaned_data['username']
 
+    def get_password(self):
+        return self.cleaned_data['password']
+
 
 class RegistrationForm(forms.Form):
     username = forms.RegexField(regex=r'^\w+$', max_length=30)
@@ -29,7 +33,7 @@ class RegistrationForm(forms.Form):
     def clean_username(self):
         username = self.cleaned_data['username']
         try:
-            cass.get_user_by_username(username)
+            cass.get_user_by_username(username, cached=False)
             raise forms.ValidationError(u'Username is already taken')
         except cass.DatabaseError:
             pass
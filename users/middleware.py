@@ -1,16 +1,38 @@
+from django.utils.crypto import constant_time_compare, salted_hmac
+
 import cass
 
+def get_password_hash(password):
+    """
+    Gets a digest of a password to keep in the session, so that changing the
+    password ends the sessions that were logged in with the old one.
+    """
+    return salted_hmac('users.middleware.get_password_hash', password).hexdigest()
+
+def log_in(request, username, password):
+    request.session['username'] = username
+    request.session['password_hash'] = get_password_hash(password)
+
+def log_out(request):
+    request.session.pop('username', None)
+    request.session.pop('password_hash', None)
+
 def get_user(request):
-    if 'username' in request.session:
+    # The user record normally comes from cass.user_cache, so most requests
+    # don't read the users table at all
+    if 'username' in request.session and 'password_hash' in request.session:
         try:
             user = cass.get_user_by_username(request.session['username'])
-            return {
-                'username': user.username,
-                'password': user.password,
-                'is_authenticated': True
-            }
         except cass.DatabaseError:
             pass
+        else:
+            if constant_time_compare(request.session['password_hash'],
+                                     get_password_hash(user.password)):
+                return {
+                    'username': user.username,
+                    'password': user.password,
+                    'is_authenticated': True
+                }
     return {
         'password': None,
         'is_authenticated': False,
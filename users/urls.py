@@ -4,5 +4,6 @@ urlpatterns = patterns('users.views',
     url('^login/$', 'login', name='login'),
     url('^logout/$', 'logout', name='logout'),
     url(r'^find-friends/$', 'find_friends', name='find_friends'),
+    url(r'^usernames/$', 'usernames_json', name='usernames_json'),
     url(r'^modify-friend/$', 'modify_friend', name='modify_friend'),
 )
\ No newline at end of file
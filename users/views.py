@@ -1,11 +1,17 @@
+import json
+
 from django.shortcuts import render_to_response
 from django.template import RequestContext
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect
 
 from users.forms import LoginForm, RegistrationForm
+from users.middleware import log_in, log_out
 
 import cass
 
+# The most usernames shown for a search
+NUM_MATCHES = 10
+
 def login(request):
     login_form = LoginForm()
     register_form = RegistrationForm()
@@ -14,8 +20,8 @@ def login(request):
         if request.POST['kind'] == 'login':
             login_form = LoginForm(request.POST)
             if login_form.is_valid():
-                username = login_form.get_username()
-                request.session['username'] = username
+                log_in(request, login_form.get_username(),
+                       login_form.get_password())
                 if next:
                     return HttpResponseRedirect(next)
                 return HttpResponseRedirect('/')
@@ -23,7 +29,8 @@ def login(request):
             register_form = RegistrationForm(request.POST)
             if register_form.is_valid():
                 username = register_form.save()
-                request.session['username'] = username
+                log_in(request, username,
+                       register_form.cleaned_data['password1'])
                 if next:
                     return HttpResponseRedirect(next)
                 return HttpResponseRedirect('/')
@@ -36,37 +43,47 @@ def login(request):
         'users/login.html', context, context_instance=RequestContext(request))
 
 def logout(request):
-    request.session.pop('username', None)
+    log_out(request)
     return render_to_response(
         'users/logout.html', {}, context_instance=RequestContext(request))
 
 def find_friends(request):
-    friend_usernames = []
-    if request.user['is_authenticated']:
-        friend_usernames = cass.get_friend_usernames(
-            request.session['username']) + [request.session['username']]
     q = request.GET.get('q')
     result = None
+    matches = []
     searched = False
     if q is not None:
         searched = True
+        # The friendship and the usernames starting with q are looked up
+        # along with the user
+        user = cass.get_user_by_username_async(q)
+        friend = None
+        if request.user['is_authenticated']:
+            friend = cass.is_following_async(request.session['username'], q)
+        search = cass.search_usernames_async(q, NUM_MATCHES + 1)
+        matches = [username for username in search.result() if username != q]
+        matches = matches[:NUM_MATCHES]
         try:
-            result = cass.get_user_by_username(q)
             result = {
-                'username': result.username,
-                'friend': q in friend_usernames
+                'username': user.result().username,
+                'friend': friend is not None and friend.result(),
             }
         except cass.DatabaseError:
             pass
     context = {
         'q': q,
         'result': result,
+        'matches': matches,
         'searched': searched,
-        'friend_usernames': friend_usernames,
     }
     return render_to_response(
         'users/add_friends.html', context, context_instance=RequestContext(request))
 
+def usernames_json(request):
+    # For autocompleting usernames as they're typed
+    usernames = cass.search_usernames(request.GET.get('q', ''), NUM_MATCHES)
+    return HttpResponse(json.dumps(usernames), content_type='application/json')
+
 def modify_friend(request):
     next = request.REQUEST.get('next')
     added = False
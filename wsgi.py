@@ -0,0 +1,21 @@
+"""
+The WSGI application, for runserver (see WSGI_APPLICATION) and for any other
+WSGI server, e.g. `gunicorn wsgi:application`.
+
+The backend is connected, and every statement cass.py runs is prepared, as
+each worker process loads this, so that the first requests after a deploy
+don't have to wait for it.  Servers that fork workers from a preloaded
+parent should load this in the workers, the driver can't be used across a
+fork.
+"""
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+from django.core.wsgi import get_wsgi_application
+
+import cass
+
+application = get_wsgi_application()
+
+cass.get_backend()